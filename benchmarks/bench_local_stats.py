@@ -0,0 +1,222 @@
+"""
+Benchmarks for the local statistics.
+
+Written in the style of asv: each class is parametrised by the number of
+units, the graph and the number of permutations, with `time_fit` and
+`peakmem_fit` measuring one call to `fit`. The module can also be run
+directly, timing with `time.perf_counter` and, in a second fit, measuring
+the peak of the memory traced by `tracemalloc` (numpy arrays, not numba
+internals):
+
+    python -m <package>.benchmarks.bench_local_stats --sizes 1000 10000
+
+Graphs are built directly as sparse matrices so that construction does
+not dominate at 1e6 units: rook and queen lattices, and k-nearest
+neighbors of uniform random points (k=6 and k=20).
+"""
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+from libpysal.weights.util import lat2SW
+
+from ..local_geary import Local_Geary
+from ..local_geary_mv import Local_Geary_MV
+from ..local_join_count import Local_Join_Count
+from ..local_join_count_bv import Local_Join_Count_BV
+from ..local_join_count_mv import Local_Join_Count_MV
+from ..losh import LOSH
+from ..local_stats_suite import LocalStatsSuite
+from ..prepared_weights import PreparedWeights
+
+SIZES = [1000, 10000, 100000, 1000000]
+GRAPHS = ['rook', 'queen', 'knn6', 'knn20']
+PERMUTATIONS = [0, 99, 999]
+SEED = 12345
+
+
+def make_graph(n, graph):
+    """
+    Sparse weights of about n units
+
+    Arguments
+    ---------
+    n                : int
+                       number of units. Lattices use the largest
+                       square with at most n cells.
+    graph            : str
+                       one of "rook", "queen", "knnK" for K nearest
+                       neighbors
+
+    Returns
+    -------
+    (n, n) scipy.sparse.csr_matrix of binary weights
+    """
+    if graph in ('rook', 'queen'):
+        side = int(np.sqrt(n))
+        return lat2SW(side, side, criterion=graph).tocsr().astype('float')
+    if graph.startswith('knn'):
+        k = int(graph[3:])
+        points = np.random.RandomState(SEED).random_sample((n, 2))
+        _, neighbors = cKDTree(points).query(points, k=k + 1)
+        # the nearest neighbor of each point is itself
+        neighbors = neighbors[:, 1:]
+        return sparse.csr_matrix(
+            (np.ones(n * k), neighbors.ravel(), np.arange(0, n * k + 1, k)),
+            shape=(n, n)
+        )
+    raise ValueError(f'Unknown graph {graph}')
+
+
+def make_data(n):
+    """
+    Continuous and binary variables of n units
+    """
+    rng = np.random.RandomState(SEED)
+    return {
+        'y1': rng.standard_normal(n),
+        'y2': rng.standard_normal(n),
+        'x1': (rng.random_sample(n) < 0.3).astype('float'),
+        'x2': (rng.random_sample(n) < 0.3).astype('float'),
+        'x3': (rng.random_sample(n) < 0.5).astype('float'),
+    }
+
+
+# Each entry fits an estimator on prepared weights w and data d
+# with a given number of permutations. Simulations are not kept,
+# so that memory reflects the estimators rather than the
+# (n, permutations) matrix of draws.
+ESTIMATORS = {
+    'Local_Geary': lambda w, d, p: Local_Geary(
+        connectivity=w, permutations=p, keep_simulations=False, seed=SEED
+    ).fit(d['y1']),
+    'Local_Geary_MV': lambda w, d, p: Local_Geary_MV(
+        connectivity=w, permutations=p, keep_simulations=False, seed=SEED
+    ).fit([d['y1'], d['y2']]),
+    'Local_Join_Count': lambda w, d, p: Local_Join_Count(
+        connectivity=w, permutations=p, keep_simulations=False, seed=SEED
+    ).fit(d['x1']),
+    'Local_Join_Count_BV_BJC': lambda w, d, p: Local_Join_Count_BV(
+        connectivity=w, permutations=p, keep_simulations=False, seed=SEED
+    ).fit(d['x1'], 1 - d['x1'], case='BJC'),
+    'Local_Join_Count_BV_CLC': lambda w, d, p: Local_Join_Count_BV(
+        connectivity=w, permutations=p, keep_simulations=False, seed=SEED
+    ).fit(d['x1'], d['x2'], case='CLC'),
+    'Local_Join_Count_MV': lambda w, d, p: Local_Join_Count_MV(
+        connectivity=w, permutations=p, keep_simulations=False, seed=SEED
+    ).fit([d['x1'], d['x2'], d['x3']]),
+    'LOSH': lambda w, d, p: LOSH(
+        connectivity=w, inference='permutation' if p else 'chi-square',
+        permutations=p, keep_simulations=False, seed=SEED
+    ).fit(d['y1']),
+    'LocalStatsSuite': lambda w, d, p: LocalStatsSuite(
+        connectivity=w, threshold=0, permutations=p, keep_simulations=False,
+        seed=SEED
+    ).fit(d['y1']),
+}
+
+
+class _EstimatorBenchmark(object):
+
+    """Times one estimator over sizes, graphs and permutations"""
+
+    estimator = None
+    params = [SIZES, GRAPHS, PERMUTATIONS]
+    param_names = ['n', 'graph', 'permutations']
+    timeout = 3600
+
+    def setup(self, n, graph, permutations):
+        self.w = PreparedWeights(make_graph(n, graph))
+        self.data = make_data(self.w.n)
+        # compile the numba functions outside of the measurement, on
+        # the measured data: a small random input may have no joins
+        # to randomise, leaving the kernels to compile in the first
+        # measured fit
+        ESTIMATORS[self.estimator](self.w, self.data, min(permutations, 9))
+
+    def time_fit(self, n, graph, permutations):
+        ESTIMATORS[self.estimator](self.w, self.data, permutations)
+
+    def peakmem_fit(self, n, graph, permutations):
+        ESTIMATORS[self.estimator](self.w, self.data, permutations)
+
+
+class Local_Geary_Suite(_EstimatorBenchmark):
+    estimator = 'Local_Geary'
+
+
+class Local_Geary_MV_Suite(_EstimatorBenchmark):
+    estimator = 'Local_Geary_MV'
+
+
+class Local_Join_Count_Suite(_EstimatorBenchmark):
+    estimator = 'Local_Join_Count'
+
+
+class Local_Join_Count_BV_BJC_Suite(_EstimatorBenchmark):
+    estimator = 'Local_Join_Count_BV_BJC'
+
+
+class Local_Join_Count_BV_CLC_Suite(_EstimatorBenchmark):
+    estimator = 'Local_Join_Count_BV_CLC'
+
+
+class Local_Join_Count_MV_Suite(_EstimatorBenchmark):
+    estimator = 'Local_Join_Count_MV'
+
+
+class LOSH_Suite(_EstimatorBenchmark):
+    estimator = 'LOSH'
+
+
+class LocalStatsSuite_Suite(_EstimatorBenchmark):
+    estimator = 'LocalStatsSuite'
+
+
+def run(estimators=None, sizes=SIZES, graphs=GRAPHS,
+        permutations=PERMUTATIONS):
+    """
+    Time each estimator on each combination of parameters, then measure
+    its peak memory in a separate fit
+
+    Returns
+    -------
+    list of (estimator, n, graph, permutations, seconds, peak MB)
+    tuples, which are also printed as they are measured.
+    """
+    results = []
+    for name in estimators or ESTIMATORS:
+        for n in sizes:
+            for graph in graphs:
+                for p in permutations:
+                    bench = _EstimatorBenchmark()
+                    bench.estimator = name
+                    bench.setup(n, graph, p)
+                    # timed and traced in separate fits, as asv does,
+                    # so that tracing does not slow down the timing
+                    start = time.perf_counter()
+                    bench.time_fit(n, graph, p)
+                    seconds = time.perf_counter() - start
+                    tracemalloc.start()
+                    bench.peakmem_fit(n, graph, p)
+                    peak = tracemalloc.get_traced_memory()[1] / 2**20
+                    tracemalloc.stop()
+                    row = (name, bench.w.n, graph, p, seconds, peak)
+                    print('{:<24} {:>8} {:>6} {:>4} {:>10.3f}s {:>9.1f}MB'
+                          .format(*row), flush=True)
+                    results.append(row)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--estimators', nargs='+', choices=list(ESTIMATORS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES)
+    parser.add_argument('--graphs', nargs='+', default=GRAPHS)
+    parser.add_argument('--permutations', nargs='+', type=int,
+                        default=PERMUTATIONS)
+    args = parser.parse_args()
+    run(args.estimators, args.sizes, args.graphs, args.permutations)
@@ -0,0 +1,890 @@
+"""
+Conditional randomisation engine for the local statistics. Numba accelerated.
+
+Mirrors the interface of `esda.crand.crand`, but accepts `z` with any
+number of columns so that multivariate statistics can be randomised
+with the same machinery.
+"""
+
+import os
+import warnings
+import numpy as np
+from scipy import stats
+from esda.crand import njit
+
+from .kernels import _as_csr, _row_blocks, _reorder
+from .prepared_weights import BlockCSR
+
+__all__ = ["crand", "crand_nonzero", "hypergeom_pvalues"]
+
+#######################################################################
+#                   Utilities for all functions                       #
+#######################################################################
+
+
+@njit(fastmath=True)
+def vec_permutations(max_card, n, k_replications, seed):
+    """
+    Generate `max_card` permuted IDs, sampled from `n-1` without
+    replacement, `k_replications` times
+
+    Arguments
+    ---------
+    max_card         : int
+                       number of permuted IDs to generate per sample
+    n                : int
+                       size of the sample to sample IDs from
+    k_replications   : int
+                       number of samples of permuted IDs to perform
+    seed             : int
+                       seed to ensure reproducibility of conditional
+                       randomizations
+
+    Returns
+    -------
+    (k_replications, max_card) array with permuted IDs
+    """
+    np.random.seed(seed)
+    result = np.empty((k_replications, max_card), dtype=np.int64)
+    for k in range(k_replications):
+        result[k] = np.random.choice(n - 1, size=max_card, replace=False)
+    return result
+
+
+@njit(fastmath=True)
+def _prepare_univariate(i, z, permuted_ids, weights_i):
+    """
+    Gather the values of the random neighbors of observation i
+
+    The permuted IDs are drawn from the n-1 observations other than i,
+    so IDs at or above i are shifted by one rather than copying z
+    without its i-th element.
+
+    Arguments
+    ---------
+    i                : int
+                       position of the observation in z
+    z                : numpy.ndarray
+                       (n,) array of standardized values
+    permuted_ids     : numpy.ndarray
+                       (permutations, max_card) array of permuted IDs
+    weights_i        : numpy.ndarray
+                       (cardinality,) weights of the neighbors of i
+
+    Returns
+    -------
+    zi               : float
+                       value of observation i
+    zrand            : numpy.ndarray
+                       (permutations, cardinality) values of the
+                       random neighbors of i
+    """
+    cardinality = weights_i.shape[0]
+    ids = permuted_ids[:, :cardinality]
+    p = ids.shape[0]
+    zrand = np.empty((p, cardinality), dtype=z.dtype)
+    for r in range(p):
+        for c in range(cardinality):
+            j = ids[r, c]
+            zrand[r, c] = z[j + (j >= i)]
+    return z[i], zrand
+
+
+@njit(fastmath=True)
+def _prepare_multivariate(i, z, permuted_ids, weights_i):
+    """
+    Gather the values of the random neighbors of observation i
+
+    The permuted IDs are drawn from the n-1 observations other than i,
+    so IDs at or above i are shifted by one rather than copying z
+    without its i-th row.
+
+    Arguments
+    ---------
+    i                : int
+                       position of the observation in z
+    z                : numpy.ndarray
+                       (n, k) array of standardized values
+    permuted_ids     : numpy.ndarray
+                       (permutations, max_card) array of permuted IDs
+    weights_i        : numpy.ndarray
+                       (cardinality,) weights of the neighbors of i
+
+    Returns
+    -------
+    zi               : numpy.ndarray
+                       (k,) values of observation i
+    zrand            : numpy.ndarray
+                       (permutations, cardinality, k) values of the
+                       random neighbors of i
+    """
+    cardinality = weights_i.shape[0]
+    ids = permuted_ids[:, :cardinality]
+    ids = ids + (ids >= i)
+    p, k = ids.shape[0], z.shape[1]
+    zrand = np.empty((p, cardinality, k), dtype=z.dtype)
+    for r in range(p):
+        for c in range(cardinality):
+            zrand[r, c] = z[ids[r, c]]
+    return z[i], zrand
+
+
+@njit(fastmath=True)
+def _neighbor_sum(zrand, weights_i):
+    """
+    Weighted sum over the random neighbors of i, zrand @ weights_i,
+    written out so that zrand may hold uint8 binary values
+
+    Arguments
+    ---------
+    zrand            : numpy.ndarray
+                       (permutations, cardinality) values of the
+                       random neighbors of i
+    weights_i        : numpy.ndarray
+                       (cardinality,) weights of the neighbors of i
+
+    Returns
+    -------
+    (permutations,) float array
+    """
+    out = np.zeros(zrand.shape[0])
+    for c in range(weights_i.shape[0]):
+        out += zrand[:, c] * weights_i[c]
+    return out
+
+
+def _prepare_weights(adj_matrix, start=0, ids=None):
+    """
+    Split a CSR block of rows, starting at row `start`, into the
+    cardinalities and the flat weights buffer of the neighbors of each
+    observation, excluding i itself. If ids is given, the rows of the
+    block are those of the observations at positions `ids`.
+    """
+    if ids is not None:
+        counts = np.diff(adj_matrix.indptr)
+        drop = ((adj_matrix.indices == np.repeat(ids, counts))
+                | (adj_matrix.data == 0))
+        rows = np.repeat(np.arange(len(ids)), counts)
+        cardinalities = np.bincount(rows[~drop], minlength=len(ids))
+        other_weights = adj_matrix.data[~drop]
+        return cardinalities, _as_float(other_weights)
+    # only copy if there are self-weights or explicit zeros to drop
+    if adj_matrix.diagonal(k=start).any() or (adj_matrix.data == 0).any():
+        adj_matrix = adj_matrix.copy()
+        with warnings.catch_warnings():
+            # massive changes to sparsity incur a cost, but it's not
+            # large for simply changing the diag
+            warnings.simplefilter("ignore")
+            adj_matrix.setdiag(0, k=start)
+        adj_matrix.eliminate_zeros()
+    cardinalities = np.diff(adj_matrix.indptr)
+    return cardinalities, _as_float(adj_matrix.data)
+
+
+def _as_float(data):
+    """
+    Weights data as float64, unless they are float32 already
+    """
+    if data.dtype == np.float32:
+        return data
+    return data.astype('float', copy=False)
+
+
+def _weights_blocks(w):
+    """
+    Yield (start, ids, cardinalities, other_weights) for each block of
+    rows of the weights, where ids are the positions of its rows
+    """
+    for start, stop, block in _row_blocks(w):
+        yield ((start, np.arange(start, stop))
+               + _prepare_weights(block, start))
+
+
+def _subset_blocks(w, ids):
+    """
+    Yield (start, ids, cardinalities, other_weights) for the rows at the
+    sorted positions ids falling in each block of rows of the weights,
+    where start is the offset of these rows in ids
+    """
+    for start, stop, block in _row_blocks(w):
+        lo, hi = np.searchsorted(ids, [start, stop])
+        if hi > lo:
+            block_ids = ids[lo:hi]
+            yield ((lo, block_ids)
+                   + _prepare_weights(block[block_ids - start],
+                                      ids=block_ids))
+
+
+#######################################################################
+#                   Conditional Randomisation                         #
+#######################################################################
+
+
+def crand(z, w, observed, permutations, keep, n_jobs, stat_func,
+          scaling=None, seed=None, chunk_size=None, ids=None,
+          early_stopping=None, batch_size=100, pool=None, local_pool=None):
+    """
+    Conduct conditional randomization of a given input using the provided
+    statistic function. Numba accelerated.
+
+    Arguments
+    ---------
+    z                : numpy.ndarray
+                       (n,) or (n, k) array with standardized observed
+                       values. uint8 (binary) and float32 arrays are
+                       randomised as they are; anything else as float64.
+                       With float32 values, the weights, the statistics
+                       and the simulations are float32 as well.
+    w                : libpysal.weights.W, scipy.sparse matrix or BlockCSR
+                       spatial weights. A BlockCSR is randomised one
+                       block of rows at a time.
+    observed         : numpy.ndarray
+                       (n,) array with observed values, or (n, m) array
+                       to randomise m statistics at once with the same
+                       permuted IDs
+    permutations     : int
+                       number of permutations for conditional randomisation
+    keep             : Boolean
+                       If True, store simulation; else do not return
+                       randomised statistics
+    n_jobs           : int
+                       Number of cores to be used in the conditional
+                       randomisation. If -1, all available cores are used.
+    stat_func        : callable
+                       numba function implementing the local statistic to
+                       be evaluated under conditional randomisation, with
+                       signature (i, z, permuted_ids, weights_i, scaling)
+                       and returning a (permutations,) array, or a
+                       (permutations, m) array if observed is (n, m).
+    scaling          : float
+                       Scaling value to apply to every local statistic.
+                       Passed through to stat_func, 1 by default.
+    seed             : None/int
+                       Seed to ensure reproducibility of conditional
+                       randomizations. The permuted IDs are drawn once
+                       from the seed and shared by every chunk, so the
+                       results do not depend on n_jobs or chunk_size.
+    chunk_size       : None/int
+                       Number of consecutive observations randomised by
+                       each task. If None, each block of rows is split
+                       into n_jobs chunks.
+    ids              : None/numpy.ndarray
+                       sorted positions of the observations to randomise.
+                       If given, observed and the results only hold these
+                       rows, and their p-values are those of a full
+                       randomisation with the same seed.
+    early_stopping   : None/float
+                       significance level. If given, permutations are run
+                       in batches and stop for each observation as soon as
+                       its pseudo p-value is known to exceed this level,
+                       so that significance at this level is decided
+                       exactly as with all permutations. The p-values of
+                       the observations that stopped early are
+                       Besag-Clifford estimates, which may be below the
+                       p-values of all permutations, so that p_sim is
+                       only decision-equivalent at this level. Only (n,)
+                       observed values are supported.
+    batch_size       : int
+                       (default=100)
+                       number of permutations per batch when
+                       early_stopping is given
+    pool             : None/PermutationPool
+                       permuted IDs drawn beforehand, to be used in place
+                       of those drawn from the seed, which is then
+                       ignored (see permutation_pool.PermutationPool)
+    local_pool       : None/LocalPool
+                       candidate neighbors of each observation under a
+                       spatially-constrained null (see
+                       local_null.LocalPool). The random neighbors of
+                       observation i are drawn from its candidates,
+                       from the seed plus i, rather than from the
+                       whole map. Only (n,) observed values are
+                       supported, without early_stopping nor pool.
+
+    Returns
+    -------
+    p_sim            : numpy.ndarray
+                       (n,) or (n, m) array with pseudo p-values from
+                       conditional permutation
+    rlocals          : numpy.ndarray
+                       If keep=True, (n, permutations) or
+                       (n, permutations, m) array with simulated values
+                       of stat_func under the null of spatial
+                       randomness; else, empty (1, 1) array. With
+                       early_stopping, permutations that were not run
+                       are NaN.
+    used             : numpy.ndarray
+                       Only returned if early_stopping is given. (n,)
+                       array with the number of permutations run for
+                       each observation.
+    """
+    z = np.asarray(z)
+    if z.dtype == np.bool_:
+        z = z.astype(np.uint8)
+    elif z.dtype not in (np.uint8, np.float32):
+        z = z.astype('float', copy=False)
+    dtype = np.float32 if z.dtype == np.float32 else np.float64
+    observed = np.asarray(observed, dtype=dtype)
+    n = z.shape[0]
+    scaling = 1.0 if scaling is None else float(scaling)
+
+    if seed is None:
+        seed = np.random.randint(12345, 12345000)
+
+    if local_pool is not None:
+        if pool is not None:
+            raise ValueError('A local pool draws its own neighbor ids, '
+                             'and cannot be combined with a pool')
+        if early_stopping is not None or observed.ndim == 2:
+            raise NotImplementedError('The local null does not support '
+                                      'early stopping nor several '
+                                      'statistics')
+        return _crand_local(z, w, observed, permutations, keep, n_jobs,
+                            stat_func, scaling, seed, chunk_size, ids,
+                            local_pool)
+
+    if ids is not None:
+        ids = np.asarray(ids, dtype=np.int64)
+        # the largest cardinality of all rows, so that the
+        # permuted IDs are those of a full randomisation
+        max_card = max(cardinalities.max(initial=0)
+                       for _, _, cardinalities, _ in _weights_blocks(w))
+        blocks = _subset_blocks(w, ids)
+        n_rows = len(ids)
+    elif isinstance(_as_csr(w), BlockCSR):
+        # a first pass over the blocks of rows finds the largest
+        # cardinality, the second one does the randomisation
+        max_card = max(cardinalities.max(initial=0)
+                       for _, _, cardinalities, _ in _weights_blocks(w))
+        blocks = _weights_blocks(w)
+        n_rows = n
+    else:
+        blocks = list(_weights_blocks(w))
+        max_card = blocks[0][2].max()
+        n_rows = n
+    if pool is None:
+        permuted_ids = vec_permutations(max_card, n, permutations, seed)
+    else:
+        # a few rows of ids, copied out of a memory-mapped pool
+        permuted_ids = np.ascontiguousarray(
+            pool.take(n, permutations, max_card), dtype=np.int64
+        )
+
+    n_jobs = _check_n_jobs(n_jobs)
+
+    extra_args = ()
+    if early_stopping is not None:
+        if observed.ndim == 2:
+            raise NotImplementedError('Early stopping is only supported '
+                                      'for a single statistic')
+        # Once the folded count of draws reaches stop_count, the p-value
+        # with all permutations, (count + 1)/(permutations + 1), exceeds
+        # the significance level whatever the remaining draws
+        stop_count = max(int(np.floor(early_stopping * (permutations + 1))),
+                         1)
+        chunk_func = compute_chunk_sequential
+        extra_args = (int(batch_size), stop_count)
+        used = np.empty(observed.shape, dtype=np.int64)
+    elif observed.ndim == 2:
+        chunk_func = compute_chunk_many
+    else:
+        chunk_func = compute_chunk
+
+    larger = np.empty(observed.shape, dtype=np.int64)
+    if keep:
+        rlocals = np.empty((n_rows, permutations) + observed.shape[1:],
+                           dtype=dtype)
+    else:
+        rlocals = np.empty((1, 1))
+    for start, block_ids, cardinalities, other_weights in blocks:
+        stop = start + len(cardinalities)
+        other_weights = other_weights.astype(dtype, copy=False)
+        if n_jobs == 1 and chunk_size is None:
+            out = chunk_func(
+                block_ids, z, observed[start:stop], cardinalities,
+                other_weights, permuted_ids, scaling, keep, stat_func,
+                *extra_args
+            )
+        else:
+            out = parallel_crand(
+                z, observed[start:stop], cardinalities, other_weights,
+                permuted_ids, scaling, min(n_jobs, stop - start), keep,
+                stat_func, chunk_func, block_ids=block_ids,
+                chunk_size=chunk_size, extra_args=extra_args
+            )
+        larger[start:stop] = out[0]
+        if keep:
+            rlocals[start:stop] = out[1]
+        if early_stopping is not None:
+            used[start:stop] = out[2]
+
+    if early_stopping is None:
+        low_extreme = (permutations - larger) < larger
+        larger[low_extreme] = permutations - larger[low_extreme]
+        p_sim = (larger + 1.0) / (permutations + 1.0)
+        return p_sim, rlocals
+
+    low_extreme = (used - larger) < larger
+    larger[low_extreme] = used[low_extreme] - larger[low_extreme]
+    p_sim = (larger + 1.0) / (permutations + 1.0)
+    # Besag-Clifford p-values of the observations that stopped early,
+    # never below the smallest p-value all permutations could give
+    stopped = used < permutations
+    p_sim[stopped] = np.maximum(larger[stopped] / used[stopped],
+                                p_sim[stopped])
+    return p_sim, rlocals, used
+
+
+def _check_n_jobs(n_jobs):
+    """
+    Number of processes to randomise with, 1 if joblib is missing
+    """
+    if n_jobs != 1:
+        try:
+            import joblib  # noqa: F401
+        except (ModuleNotFoundError, ImportError):
+            warnings.warn(
+                f"Parallel processing is requested (n_jobs={n_jobs}),"
+                f" but joblib cannot be imported. n_jobs will be set"
+                f" to 1.",
+                stacklevel=3,
+            )
+            n_jobs = 1
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    return n_jobs
+
+
+def _crand_local(z, w, observed, permutations, keep, n_jobs, stat_func,
+                 scaling, seed, chunk_size, ids, local_pool):
+    """
+    crand under the spatially-constrained null of local_pool
+
+    z, the weights and the observations are put in the order of the
+    pool, where the candidates of each observation are close together,
+    randomised by block of rows as in crand and put back in their
+    original order. Each observation is randomised from its own seed,
+    so the results do not depend on the order, n_jobs or chunk_size.
+    """
+    n = z.shape[0]
+    if local_pool.n != n:
+        raise ValueError(f'The local pool is for {local_pool.n} '
+                         f'observations, not {n}')
+    W = _as_csr(w)
+    if isinstance(W, BlockCSR):
+        raise NotImplementedError('The local null needs in-memory weights')
+    n_jobs = _check_n_jobs(n_jobs)
+    order = local_pool.order
+    z = z[order]
+    W = _reorder(W, order, local_pool.inverse)
+    if ids is None:
+        observed = observed[order]
+        blocks = _weights_blocks(W)
+        # results are put back from the pool order
+        back = local_pool.inverse
+    else:
+        rows = local_pool.inverse[np.asarray(ids, dtype=np.int64)]
+        sort = np.argsort(rows)
+        observed = observed[sort]
+        blocks = _subset_blocks(W, rows[sort])
+        back = np.argsort(sort)
+    n_rows = observed.shape[0]
+    seeds = (seed + order) % 2**32
+    candidates = np.diff(local_pool.indptr)
+    # only the number of permutations is read by the chunk functions
+    permuted_ids = np.empty((permutations, 0), dtype=np.int64)
+    extra_args = (local_pool.indptr, local_pool.indices, seeds)
+
+    larger = np.empty(n_rows, dtype=np.int64)
+    if keep:
+        rlocals = np.empty((n_rows, permutations), dtype=observed.dtype)
+    else:
+        rlocals = np.empty((1, 1))
+    for start, block_ids, cardinalities, other_weights in blocks:
+        if (candidates[block_ids] < cardinalities).any():
+            raise ValueError('Observations have fewer candidates in the '
+                             'local pool than neighbors')
+        stop = start + len(cardinalities)
+        other_weights = other_weights.astype(observed.dtype, copy=False)
+        if n_jobs == 1 and chunk_size is None:
+            out = compute_chunk_local(
+                block_ids, z, observed[start:stop], cardinalities,
+                other_weights, permuted_ids, scaling, keep, stat_func,
+                *extra_args
+            )
+        else:
+            out = parallel_crand(
+                z, observed[start:stop], cardinalities, other_weights,
+                permuted_ids, scaling, min(n_jobs, stop - start), keep,
+                stat_func, compute_chunk_local, block_ids=block_ids,
+                chunk_size=chunk_size, extra_args=extra_args
+            )
+        larger[start:stop] = out[0]
+        if keep:
+            rlocals[start:stop] = out[1]
+
+    low_extreme = (permutations - larger) < larger
+    larger[low_extreme] = permutations - larger[low_extreme]
+    p_sim = (larger + 1.0) / (permutations + 1.0)
+    return p_sim[back], rlocals[back] if keep else rlocals
+
+
+def crand_nonzero(z, w, observed, permutations, keep, n_jobs, stat_func,
+                  ids=None, **kwargs):
+    """
+    Conditional randomisation of the observations with a nonzero
+    statistic only, e.g. the focal units of join counts, whose other
+    statistics are zero whatever the neighbors. The others are neither
+    randomised nor allocated in the randomisation, and get NaN p-values
+    and simulations.
+
+    Arguments are those of `crand`, with observed holding the statistics
+    of all rows, or of the sorted rows ids if given. Rows of (n, m)
+    observed values are randomised if any of their values is nonzero.
+
+    Returns
+    -------
+    The outputs of `crand`, for all rows of observed. Rows that are not
+    randomised have NaN p-values, NaN simulations if keep=True and no
+    permutations run if early_stopping is given.
+    """
+    observed = np.asarray(observed, dtype='float')
+    nonzero = observed != 0
+    if observed.ndim == 2:
+        nonzero = nonzero.any(axis=1)
+    positions = np.flatnonzero(nonzero)
+    n_rows = observed.shape[0]
+
+    p_sim = np.full(observed.shape, np.nan)
+    if keep:
+        rlocals = np.full((n_rows, permutations) + observed.shape[1:],
+                          np.nan)
+    else:
+        rlocals = np.empty((1, 1))
+    used = np.zeros(n_rows, dtype=np.int64)
+    if positions.size:
+        candidates = positions if ids is None else np.asarray(ids)[positions]
+        result = crand(z, w, observed[positions], permutations, keep,
+                       n_jobs, stat_func, ids=candidates, **kwargs)
+        p_sim[positions] = result[0]
+        if keep:
+            rlocals[positions] = result[1]
+        if len(result) > 2:
+            used[positions] = result[2]
+    if kwargs.get('early_stopping') is not None:
+        return p_sim, rlocals, used
+    return p_sim, rlocals
+
+
+@njit(fastmath=True)
+def compute_chunk(chunk_ids, z, observed, cardinalities, other_weights,
+                  permuted_ids, scaling, keep, stat_func):
+    """
+    Compute conditional randomisation for a single chunk of
+    observations, at positions `chunk_ids`
+
+    The number of draws at least as large as the observed value is
+    accumulated per observation, so the (n_chunk, permutations) matrix
+    of simulated values is only allocated when keep=True.
+
+    Returns
+    -------
+    larger           : numpy.ndarray
+                       (n_chunk,) array with number of random draws under
+                       the null larger than observed value of statistic
+    rlocals          : numpy.ndarray
+                       (n_chunk, permutations) array with local
+                       statistics simulated under the null of spatial
+                       randomness if keep=True; else, empty (1, 1) array
+    """
+    chunk_n = cardinalities.shape[0]
+    larger = np.zeros((chunk_n,), dtype=np.int64)
+    if keep:
+        rlocals = np.empty((chunk_n, permuted_ids.shape[0]),
+                           dtype=observed.dtype)
+    else:
+        rlocals = np.empty((1, 1), dtype=observed.dtype)
+
+    wloc = 0
+    for i in range(chunk_n):
+        cardinality = cardinalities[i]
+        # this chomps the next `cardinality` weights off of `weights`
+        weights_i = other_weights[wloc:(wloc + cardinality)]
+        wloc += cardinality
+        rstats = stat_func(chunk_ids[i], z, permuted_ids,
+                           weights_i, scaling)
+        if keep:
+            rlocals[i] = rstats
+        larger[i] = np.sum(rstats >= observed[i])
+    return larger, rlocals
+
+
+@njit(fastmath=True)
+def compute_chunk_many(chunk_ids, z, observed, cardinalities,
+                       other_weights, permuted_ids, scaling, keep,
+                       stat_func):
+    """
+    Compute conditional randomisation for a single chunk of
+    observations and m statistics sharing the same permuted IDs
+
+    Same as `compute_chunk`, with observed of shape (n_chunk, m) and
+    stat_func returning a (permutations, m) array.
+    """
+    chunk_n, m = observed.shape
+    larger = np.zeros((chunk_n, m), dtype=np.int64)
+    if keep:
+        rlocals = np.empty((chunk_n, permuted_ids.shape[0], m),
+                           dtype=observed.dtype)
+    else:
+        rlocals = np.empty((1, 1, 1), dtype=observed.dtype)
+
+    wloc = 0
+    for i in range(chunk_n):
+        cardinality = cardinalities[i]
+        weights_i = other_weights[wloc:(wloc + cardinality)]
+        wloc += cardinality
+        rstats = stat_func(chunk_ids[i], z, permuted_ids,
+                           weights_i, scaling)
+        if keep:
+            rlocals[i] = rstats
+        for j in range(m):
+            larger[i, j] = np.sum(rstats[:, j] >= observed[i, j])
+    return larger, rlocals
+
+
+@njit(fastmath=True)
+def compute_chunk_sequential(chunk_ids, z, observed, cardinalities,
+                             other_weights, permuted_ids, scaling, keep,
+                             stat_func, batch_size, stop_count):
+    """
+    Compute conditional randomisation for a single chunk of observations,
+    running the permutations in batches of `batch_size` and stopping for
+    each observation once its folded count of draws reaches `stop_count`
+
+    Returns
+    -------
+    larger           : numpy.ndarray
+                       (n_chunk,) array with number of random draws under
+                       the null larger than observed value of statistic
+    rlocals          : numpy.ndarray
+                       (n_chunk, permutations) array with local
+                       statistics simulated under the null of spatial
+                       randomness, NaN where not run, if keep=True;
+                       else, empty (1, 1) array
+    used             : numpy.ndarray
+                       (n_chunk,) array with the number of permutations
+                       run for each observation
+    """
+    chunk_n = cardinalities.shape[0]
+    permutations = permuted_ids.shape[0]
+    larger = np.zeros((chunk_n,), dtype=np.int64)
+    used = np.full((chunk_n,), permutations, dtype=np.int64)
+    if keep:
+        rlocals = np.full((chunk_n, permutations), np.nan,
+                          dtype=observed.dtype)
+    else:
+        rlocals = np.empty((1, 1), dtype=observed.dtype)
+
+    wloc = 0
+    for i in range(chunk_n):
+        cardinality = cardinalities[i]
+        weights_i = other_weights[wloc:(wloc + cardinality)]
+        wloc += cardinality
+        count = 0
+        for start in range(0, permutations, batch_size):
+            stop = min(start + batch_size, permutations)
+            rstats = stat_func(chunk_ids[i], z, permuted_ids[start:stop],
+                               weights_i, scaling)
+            if keep:
+                rlocals[i, start:stop] = rstats
+            count += np.sum(rstats >= observed[i])
+            if min(count, stop - count) >= stop_count:
+                used[i] = stop
+                break
+        larger[i] = count
+    return larger, rlocals, used
+
+
+@njit(fastmath=True)
+def _splitmix64(state):
+    """
+    Next state and 64 random bits of a splitmix64 generator, which is
+    cheap to seed for each observation, unlike numpy's Mersenne Twister
+    """
+    state = state + np.uint64(0x9E3779B97F4A7C15)
+    x = state
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return state, x ^ (x >> np.uint64(31))
+
+
+@njit(fastmath=True)
+def _local_permutations(i, candidates, cardinality, permutations, seed):
+    """
+    Draw `cardinality` of the candidates of observation i without
+    replacement, `permutations` times, by partial Fisher-Yates shuffles
+
+    Returns
+    -------
+    (permutations, cardinality) array of IDs in the convention of
+    vec_permutations, i.e. shifted down past i
+    """
+    # the stream starts from the mixed seed, so that those of
+    # consecutive seeds do not overlap
+    _, state = _splitmix64(np.uint64(seed))
+    pool = candidates.copy()
+    size = pool.shape[0]
+    result = np.empty((permutations, cardinality), dtype=np.int64)
+    for r in range(permutations):
+        for c in range(cardinality):
+            state, bits = _splitmix64(state)
+            # uniform in [c, size) from the top 53 bits
+            k = c + np.int64(np.float64(bits >> np.uint64(11))
+                             * 2.0**-53 * (size - c))
+            j = pool[k]
+            pool[k] = pool[c]
+            pool[c] = j
+            result[r, c] = j - (j > i)
+    return result
+
+
+@njit(fastmath=True)
+def compute_chunk_local(chunk_ids, z, observed, cardinalities,
+                        other_weights, permuted_ids, scaling, keep,
+                        stat_func, pool_indptr, pool_indices, seeds):
+    """
+    Compute conditional randomisation for a single chunk of observations
+    under a spatially-constrained null, drawing the random neighbors of
+    each observation from its candidates in the local pool
+
+    Same as `compute_chunk`, with permuted_ids only giving the number of
+    permutations, and the (n,) seeds of the observations by position.
+    """
+    chunk_n = cardinalities.shape[0]
+    permutations = permuted_ids.shape[0]
+    larger = np.zeros((chunk_n,), dtype=np.int64)
+    if keep:
+        rlocals = np.empty((chunk_n, permutations), dtype=observed.dtype)
+    else:
+        rlocals = np.empty((1, 1), dtype=observed.dtype)
+
+    wloc = 0
+    for i in range(chunk_n):
+        cardinality = cardinalities[i]
+        weights_i = other_weights[wloc:(wloc + cardinality)]
+        wloc += cardinality
+        position = chunk_ids[i]
+        local_ids = _local_permutations(
+            position,
+            pool_indices[pool_indptr[position]:pool_indptr[position + 1]],
+            cardinality, permutations, seeds[position]
+        )
+        rstats = stat_func(position, z, local_ids, weights_i, scaling)
+        if keep:
+            rlocals[i] = rstats
+        larger[i] = np.sum(rstats >= observed[i])
+    return larger, rlocals
+
+
+#######################################################################
+#                   Parallel Implementation                           #
+#######################################################################
+
+
+def parallel_crand(z, observed, cardinalities, other_weights, permuted_ids,
+                   scaling, n_jobs, keep, stat_func,
+                   chunk_func=compute_chunk, block_ids=None,
+                   chunk_size=None, extra_args=()):
+    """
+    Conduct conditional randomization in parallel using numba, with
+    contiguous chunks of `chunk_size` observations of a block of rows,
+    at positions `block_ids` (by default, the first rows), farmed out
+    to joblib workers
+
+    Every chunk reads the same permuted IDs and the results are
+    concatenated in order, so they are identical for any n_jobs and
+    chunk_size. If n_jobs=1, the chunks are computed in this process.
+    extra_args are passed to chunk_func after stat_func, and any outputs
+    of chunk_func beyond (larger, rlocals) are concatenated as well.
+    """
+    n = cardinalities.shape[0]
+    if block_ids is None:
+        block_ids = np.arange(n)
+    if chunk_size is None:
+        chunk_size = n // n_jobs + 1
+    starts = np.arange(0, n, chunk_size)
+    offsets = np.concatenate(([0], np.cumsum(cardinalities)))
+    tasks = (
+        (
+            block_ids[start:start + chunk_size],
+            z,
+            observed[start:start + chunk_size],
+            cardinalities[start:start + chunk_size],
+            other_weights[
+                offsets[start]:offsets[min(start + chunk_size, n)]
+            ],
+            permuted_ids,
+            scaling,
+            keep,
+            stat_func,
+        ) + tuple(extra_args)
+        for start in starts
+    )
+
+    if n_jobs == 1:
+        worker_out = [chunk_func(*task) for task in tasks]
+    else:
+        from joblib import Parallel, delayed, parallel_backend
+
+        with parallel_backend("loky", inner_max_num_threads=1):
+            worker_out = Parallel(n_jobs=n_jobs)(
+                delayed(chunk_func)(*task) for task in tasks
+            )
+    outputs = list(zip(*worker_out))
+    larger = np.concatenate(outputs[0])
+    rlocals = np.concatenate(outputs[1]) if keep else np.empty((1, 1))
+    return (larger, rlocals) + tuple(np.concatenate(o) for o in outputs[2:])
+
+
+#######################################################################
+#                   Analytic Conditional Randomisation                #
+#######################################################################
+
+
+def hypergeom_pvalues(observed, cardinalities, ones, n):
+    """
+    Exact p-values of binary join counts under conditional
+    randomisation, without permutations
+
+    With binary weights, the join count of a focal unit i under
+    conditional randomisation is the number of ones among the
+    `cardinalities[i]` neighbors drawn without replacement from the
+    n-1 other units, `ones[i]` of which are ones. It is therefore
+    hypergeometric, and the p-values are folded as in `crand`, as
+    the smaller of P(J >= observed) and P(J < observed).
+
+    Arguments
+    ---------
+    observed         : numpy.ndarray
+                       (n,) or (n, m) array with observed join counts
+    cardinalities    : numpy.ndarray
+                       (n,) array with the number of neighbors of
+                       each unit, excluding itself
+    ones             : numpy.ndarray
+                       (n,) or (n, m) array with the number of ones
+                       among the units other than i
+    n                : int
+                       number of units
+
+    Returns
+    -------
+    p_analytic       : numpy.ndarray
+                       (n,) or (n, m) array with exact p-values
+    """
+    observed = np.asarray(observed, dtype='float')
+    cardinalities = np.asarray(cardinalities)
+    if observed.ndim == 2:
+        cardinalities = cardinalities[:, None]
+    upper = stats.hypergeom.sf(observed - 1, n - 1, ones, cardinalities)
+    lower = stats.hypergeom.cdf(observed - 1, n - 1, ones, cardinalities)
+    return np.minimum(upper, lower)
@@ -0,0 +1,273 @@
+from contextlib import contextmanager
+import numpy as np
+from scipy import sparse
+from esda.crand import njit, prange
+from .prepared_weights import BlockCSR
+
+# --------------------------------------------------------------
+# Sparse (CSR) kernels shared by the local statistics
+# --------------------------------------------------------------
+
+# These replace the adjacency list + pandas groupby approach. Rows
+# and columns of `w.sparse` follow `w.id_order`, which is also the
+# order of the input arrays, so no relabelling of values is needed.
+# Weights may also be a BlockCSR, in which case the kernels stream
+# over blocks of rows. With n_jobs other than 1, the sparse products
+# run on numba threads, splitting the rows of each block.
+
+
+def _as_csr(w):
+    """
+    Return the CSR matrix behind a libpysal W or a scipy.sparse matrix.
+    A BlockCSR is returned as is.
+    """
+    if isinstance(w, BlockCSR):
+        return w
+    if sparse.issparse(w):
+        return sparse.csr_matrix(w)
+    return w.sparse.tocsr()
+
+
+def _row_blocks(w):
+    """
+    Yield (start, stop, block) for the blocks of rows of the weights,
+    a single block holding every row unless w is a BlockCSR
+    """
+    W = _as_csr(w)
+    if isinstance(W, BlockCSR):
+        yield from W.blocks()
+    else:
+        yield 0, W.shape[0], W
+
+
+def _reorder(W, order, inverse):
+    """
+    CSR matrix W with rows and columns in the given order, where inverse
+    is the inverse permutation of order. The entries of each row keep
+    their order, rather than being sorted by their new columns.
+    """
+    counts = np.diff(W.indptr)[order]
+    indptr = np.concatenate(([0], np.cumsum(counts))).astype(W.indptr.dtype)
+    # position in W of each entry of the reordered rows
+    entries = (np.repeat(W.indptr[order] - indptr[:-1], counts)
+               + np.arange(indptr[-1]))
+    return sparse.csr_matrix(
+        (W.data[entries], inverse[W.indices[entries]], indptr),
+        shape=W.shape
+    )
+
+
+@njit(parallel=True)
+def _csr_product(indptr, indices, data, x, out):
+    """
+    out = W @ x for the CSR arrays of W and (n, k) x, with the rows
+    of W split across threads
+    """
+    for i in prange(indptr.shape[0] - 1):
+        for p in range(indptr[i], indptr[i + 1]):
+            j = indices[p]
+            for c in range(x.shape[1]):
+                out[i, c] += data[p] * x[j, c]
+
+
+@contextmanager
+def _num_threads(n_jobs):
+    """
+    Run numba parallel code on n_jobs threads (all of them if -1)
+    """
+    try:
+        import numba
+    except (ModuleNotFoundError, ImportError):
+        yield
+        return
+    previous = numba.get_num_threads()
+    available = numba.config.NUMBA_NUM_THREADS
+    numba.set_num_threads(available if n_jobs == -1
+                          else max(1, min(n_jobs, available)))
+    try:
+        yield
+    finally:
+        numba.set_num_threads(previous)
+
+
+def _product(W, x, n_jobs=1):
+    """
+    W @ x, with scipy if n_jobs=1 and on numba threads otherwise
+    """
+    if n_jobs == 1:
+        return W @ x
+    x = np.asarray(x)
+    if x.dtype not in (np.float32, np.float64):
+        x = x.astype('float')
+    x2d = x.reshape(x.shape[0], -1)
+    out = np.zeros((W.shape[0], x2d.shape[1]), dtype=x.dtype)
+    with _num_threads(n_jobs):
+        for start, stop, block in _row_blocks(W):
+            _csr_product(block.indptr, block.indices,
+                         block.data.astype(x.dtype, copy=False), x2d,
+                         out[start:stop])
+    return out.reshape((W.shape[0],) + x.shape[1:])
+
+
+def spatial_lag(w, x, n_jobs=1):
+    """
+    Spatial lag of x, i.e. W @ x
+
+    Arguments
+    ---------
+    w                : libpysal.weights.W, scipy.sparse matrix or BlockCSR
+                       spatial weights
+    x                : numpy.ndarray
+                       (n,) or (n, k) array of values
+    n_jobs           : int
+                       (default=1)
+                       number of threads. If -1, all available threads
+                       are used.
+
+    Returns
+    -------
+    (n,) or (n, k) array containing the spatial lag of x.
+    """
+    return _product(_as_csr(w), x, n_jobs)
+
+
+def local_geary(w, z, rows=None, n_jobs=1):
+    """
+    Local Geary kernel using the expanded identity
+
+        sum_j w_ij (z_i - z_j)^2 = z_i^2 r_i - 2 z_i (Wz)_i + (W z^2)_i
+
+    where r_i is the row sum of W.
+
+    Arguments
+    ---------
+    w                : libpysal.weights.W, scipy.sparse matrix or BlockCSR
+                       spatial weights
+    z                : numpy.ndarray
+                       (n,) or (n, k) array of (standardized) values
+    rows             : None/numpy.ndarray
+                       positions of the observations to compute the
+                       statistic for. If None, all of them.
+    n_jobs           : int
+                       (default=1)
+                       number of threads. If -1, all available threads
+                       are used.
+
+    Returns
+    -------
+    (n,) or (n, k) array with the local Geary value of each
+    column of z, or (len(rows),) or (len(rows), k) if rows is given.
+    """
+    z2 = z**2
+    # Lags of z and z^2 are found in a single pass over the rows of W,
+    # from an (n, 2k) operand built once for all the blocks of rows
+    n, k = z.shape[0], z[0].size
+    zz2 = np.column_stack((z.reshape(n, k), z2.reshape(n, k)))
+    if rows is not None:
+        return _local_geary_rows(_as_csr(w)[rows], z, z2, zz2, rows)
+    out = np.empty(z.shape, dtype=z.dtype)
+    for start, stop, W in _row_blocks(w):
+        out[start:stop] = _local_geary_rows(W, z, z2, zz2,
+                                            slice(start, stop), n_jobs)
+    return out
+
+
+def _local_geary_rows(W, z, z2, zz2, rows, n_jobs=1):
+    """
+    Local Geary of the rows of z selected by rows, given the
+    matching rows W of the weights and the stacked [z, z^2]
+    """
+    rowsum = np.asarray(W.sum(axis=1)).flatten()
+    if z.ndim == 2:
+        rowsum = rowsum[:, None]
+    k = zz2.shape[1] // 2
+    lags = _product(W, zz2, n_jobs)
+    shape = (W.shape[0],) + z.shape[1:]
+    return (z2[rows] * rowsum - 2 * z[rows] * lags[:, :k].reshape(shape)
+            + lags[:, k:].reshape(shape))
+
+
+def local_join_count(w, focal, neighbor=None, rows=None, n_jobs=1):
+    """
+    Local join count kernel, focal_i * sum_j w_ij neighbor_j
+
+    Arguments
+    ---------
+    w                : libpysal.weights.W, scipy.sparse matrix or BlockCSR
+                       binary spatial weights with a zero diagonal
+    focal            : numpy.ndarray
+                       (n,) binary (0/1) array for the focal units
+    neighbor         : numpy.ndarray
+                       (n,) binary (0/1) array for the neighboring
+                       units. If None, focal is used.
+    rows             : None/numpy.ndarray
+                       positions of the units to count the joins of.
+                       If None, all of them.
+    n_jobs           : int
+                       (default=1)
+                       number of threads. If -1, all available threads
+                       are used.
+
+    Returns
+    -------
+    (n,) float array with the number of joins of each unit, or
+    (len(rows),) if rows is given.
+    """
+    if neighbor is None:
+        neighbor = focal
+    if rows is not None:
+        return np.asarray(focal[rows] * (_as_csr(w)[rows] @ neighbor),
+                          dtype='float')
+    return np.asarray(focal * _product(_as_csr(w), neighbor, n_jobs),
+                      dtype='float')
+
+
+# Number of bits set in each byte
+_POPCOUNT = np.array([bin(b).count('1') for b in range(256)], dtype=np.uint8)
+
+
+def pack_binary(variables):
+    """
+    Pack k binary variables into bits, one row of ceil(k/8) bytes per
+    unit. Unused bits of the last byte are set, so that a unit has
+    all of the variables equal to 1 when all of its bits are set.
+
+    Arguments
+    ---------
+    variables        : list or numpy.ndarray
+                       k binary (0/1) arrays of n values, any dtype
+
+    Returns
+    -------
+    (n, ceil(k/8)) uint8 array
+    """
+    k = len(variables)
+    n = len(variables[0])
+    packed = np.full((n, (k + 7) // 8), 255, dtype=np.uint8)
+    # One variable at a time, so that the k x n values are never
+    # stacked together
+    for j, v in enumerate(variables):
+        byte, bit = divmod(j, 8)
+        packed[:, byte] ^= (np.asarray(v) != 1).astype(np.uint8) << (7 - bit)
+    return packed
+
+
+def colocation(packed):
+    """
+    Co-location indicator of bit-packed binary variables, 1 for the
+    units where all of the variables are 1
+
+    Arguments
+    ---------
+    packed           : numpy.ndarray
+                       (n, nbytes) uint8 array as given by pack_binary
+
+    Returns
+    -------
+    (n,) uint8 array
+    """
+    packed = np.asarray(packed, dtype=np.uint8)
+    if packed.ndim == 1:
+        packed = packed.reshape(-1, 1)
+    bits = _POPCOUNT[packed].sum(axis=1, dtype=np.intp)
+    return (bits == 8 * packed.shape[1]).astype(np.uint8)
@@ -0,0 +1,105 @@
+"""
+Classification of units by significance and type of local association.
+
+Labels are integer-coded, as uint8, and shared by every estimator:
+
+    0 = undefined (no p-value, or on the mean)
+    1 = outlier
+    2 = cluster
+    3 = other
+    4 = non-significant
+
+Each estimator documents what cluster, outlier and other mean for its
+statistic.
+"""
+
+import numpy as np
+from esda.crand import njit as _njit
+from .multiple_testing import threshold
+
+UNDEFINED, OUTLIER, CLUSTER, OTHER, NOT_SIGNIFICANT = range(5)
+
+
+def local_labels(p, sig=0.05, correction=None, stat=None, x=None,
+                 below=CLUSTER, above=OTHER):
+    """
+    Label units in a single pass over their p-values and statistics.
+
+    Significant units are labelled by their statistic: below if it is
+    lower than the mean of the statistic, above if higher. If x is
+    given, significant units below the mean are further split into
+    outliers, with x above its mean, and clusters, with x below. Without
+    a statistic, every significant unit is a cluster.
+
+    Arguments
+    ---------
+    p                : numpy.ndarray
+                       (n,) or (n, m) array of p-values, NaN for units
+                       that are not tested. Columns are labelled
+                       separately.
+    sig              : float
+                       (default=0.05)
+                       significance level
+    correction       : None/str
+                       (default=None)
+                       multiple testing correction of the threshold,
+                       see multiple_testing.threshold
+    stat             : None/numpy.ndarray
+                       (default=None)
+                       statistic, shaped as p
+    x                : None/numpy.ndarray
+                       (default=None)
+                       data, shaped as p
+    below            : int
+                       (default=CLUSTER)
+                       label of significant units below the mean
+    above            : int
+                       (default=OTHER)
+                       label of significant units above the mean
+
+    Returns
+    -------
+    numpy.ndarray of uint8, shaped as p
+    """
+    p = np.asarray(p)
+    shape = p.shape
+    p = p.reshape(shape[0], -1)
+    m = p.shape[1]
+    cutoff = np.array([threshold(p[:, j], sig, correction)
+                       for j in range(m)], dtype='float64')
+    # Missing stat or x are passed on empty
+    if stat is None:
+        stat = np.empty((0, m))
+        below = CLUSTER
+    stat = np.asarray(stat).reshape(-1, m)
+    if x is None:
+        x = np.empty((0, m))
+    x = np.asarray(x).reshape(-1, m)
+    stat_mean = stat.mean(axis=0) if stat.size else np.zeros(m)
+    x_mean = x.mean(axis=0) if x.size else np.zeros(m)
+    labs = _labels(p, cutoff, stat, stat_mean, x, x_mean, below, above)
+    return labs.reshape(shape)
+
+
+@_njit
+def _labels(p, cutoff, stat, stat_mean, x, x_mean, below, above):
+    n, m = p.shape
+    labs = np.zeros((n, m), dtype=np.uint8)
+    for i in range(n):
+        for j in range(m):
+            if not p[i, j] <= cutoff[j]:
+                # NaN p-values are left undefined
+                if p[i, j] == p[i, j]:
+                    labs[i, j] = NOT_SIGNIFICANT
+            elif stat.shape[0] == 0:
+                labs[i, j] = below
+            elif stat[i, j] < stat_mean[j]:
+                if x.shape[0] == 0:
+                    labs[i, j] = below
+                elif x[i, j] > x_mean[j]:
+                    labs[i, j] = OUTLIER
+                elif x[i, j] < x_mean[j]:
+                    labs[i, j] = CLUSTER
+            elif stat[i, j] > stat_mean[j]:
+                labs[i, j] = above
+    return labs
@@ -5,10 +5,17 @@ from scipy import sparse
 from scipy import stats
 from sklearn.base import BaseEstimator
 import libpysal as lp
-from esda.crand import (
+from esda.crand import njit as _njit
+from . import kernels as _kernels
+from .prepared_weights import PreparedWeights
+from .profiling import FitProfiler, permutations_run
+from .local_null import as_local_pool as _as_local_pool
+from .multiple_testing import correct as _correct
+from .labels import local_labels as _local_labels
+from .crand import (
     crand as _crand_plus,
-    njit as _njit,
-    _prepare_univariate
+    _prepare_univariate,
+    _prepare_multivariate
 )
 
 
@@ -18,21 +25,24 @@ class Local_Geary(BaseEstimator):
 
     def __init__(self, connectivity=None, labels=False, sig=0.05,
                  permutations=999, n_jobs=1, keep_simulations=True,
-                 seed=None):
+                 seed=None, early_stopping=None, dtype='float64',
+                 correction=None, local_pool=None, chunk_size=None):
         """
         Initialize a Local_Geary estimator
         Arguments
         ---------
-        connectivity     : scipy.sparse matrix object
+        connectivity     : libpysal.weights.W or PreparedWeights
                            the connectivity structure describing
                            the relationships between observed units.
-                           Need not be row-standardized.
+                           Need not be row-standardized, and is not
+                           modified.
         labels           : boolean
                            (default=False)
                            If True use, label if an observation
                            belongs to an outlier, cluster, other,
                            or non-significant group. 1 = outlier,
-                           2 = cluster, 3 = other, 4 = non-significant.
+                           2 = cluster, 3 = other, 4 = non-significant,
+                           0 = undefined (see labels.local_labels).
                            Note that this is not the exact same as the
                            cluster map produced by GeoDa.
         sig              : float
@@ -46,7 +56,14 @@ class Local_Geary(BaseEstimator):
         n_jobs           : int
                            (default=1)
                            Number of cores to be used in the conditional
-                           randomisation. If -1, all available cores are used.
+                           randomisation and the observed statistic. If -1,
+                           all available cores are used.
+        chunk_size       : None/int
+                           (default=None)
+                           Number of consecutive units randomised by each
+                           task of the conditional randomisation. If None,
+                           the units are split into n_jobs chunks. The
+                           p-values do not depend on n_jobs nor chunk_size.
         keep_simulations : Boolean
                            (default=True)
                            If True, the entire matrix of replications under
@@ -58,6 +75,43 @@ class Local_Geary(BaseEstimator):
                            of the function, since numba does not correctly
                            interpret external seeds nor
                            numpy.random.RandomState instances.
+        early_stopping   : None/float
+                           (default=None)
+                           If a significance level, permutations are run
+                           in batches and stop for each observation once
+                           its pseudo p-value is known to exceed it, so
+                           that significance at that level is unchanged.
+                           The number of permutations run for each
+                           observation is stored in n_permutations, and
+                           the observations that stopped early are
+                           marked in stopped. Their p_sim is the
+                           Besag-Clifford estimate from the permutations
+                           run, which exceeds the level as the p-value
+                           of all permutations does, but is not that
+                           p-value and may be below it. p_sim is thus
+                           only decision-equivalent at this level, and
+                           should not be compared at another one.
+        dtype            : str
+                           (default='float64')
+                           Floating point type of the data, weights and
+                           simulations, e.g. 'float32' to halve their
+                           memory at the cost of precision.
+        correction       : None/str
+                           (default=None)
+                           Multiple testing correction of the p-values:
+                           'bonferroni', 'fdr_bh' or 'fdr_by'. If given,
+                           the adjusted p-values are stored in p_adjusted
+                           (see multiple_testing.adjust), and the labels
+                           are those of p_adjusted at sig.
+        local_pool       : None/int/LocalPool
+                           (default=None)
+                           If given, permutation inference is under a
+                           spatially-constrained null, drawing the random
+                           neighbors of each unit from its candidates
+                           rather than the whole map: its neighbors up to
+                           this order in connectivity if an int (see
+                           local_null.LocalPool). Used by fit and update,
+                           without early_stopping.
 
         Attributes
         ----------
@@ -67,8 +121,23 @@ class Local_Geary(BaseEstimator):
         p_sim           : numpy array
                           array containing the simulated
                           p-values for each unit.
+        p_adjusted      : numpy array
+                          p_sim adjusted for multiple testing,
+                          if correction is given.
         labs            : numpy array
-                          array containing the labels for if each observation.
+                          uint8 array containing the labels for if each
+                          observation.
+        rlocalG         : numpy array
+                          (n, permutations) array of the simulated
+                          Local Geary values, if keep_simulations=True.
+        n_permutations  : numpy array
+                          number of permutations run for each unit,
+                          if early_stopping is given.
+        stopped         : numpy array
+                          boolean array of the units that stopped
+                          before all permutations, whose p_sim is a
+                          Besag-Clifford estimate, if early_stopping is
+                          given.
         """
 
         self.connectivity = connectivity
@@ -78,13 +147,29 @@ class Local_Geary(BaseEstimator):
         self.n_jobs = n_jobs
         self.keep_simulations = keep_simulations
         self.seed = seed
+        self.early_stopping = early_stopping
+        self.dtype = dtype
+        self.correction = correction
+        self.local_pool = local_pool
+        self.chunk_size = chunk_size
 
-    def fit(self, x):
+    def fit(self, x, pool=None, profile=False):
         """
         Arguments
         ---------
         x                : numpy.ndarray
                            array containing continuous data
+        pool             : None/PermutationPool
+                           (default=None)
+                           permuted neighbor ids to randomise against,
+                           drawn beforehand in place of the seed (see
+                           permutation_pool.PermutationPool).
+        profile          : bool
+                           (default=False)
+                           If True, the wall time, memory and numba
+                           compilation time of each phase of the fit,
+                           and the permutations performed, are recorded
+                           in fit_stats_ (see profiling.FitProfiler).
 
         Returns
         -------
@@ -107,74 +192,265 @@ class Local_Geary(BaseEstimator):
         >>> lG.localG[0:5]
         >>> lG.p_sim[0:5]
         """
-        x = np.asarray(x).flatten()
+        with FitProfiler(profile) as profiler:
+            x = np.asarray(x, dtype=self.dtype).flatten()
+
+            prepared = PreparedWeights.from_w(self.connectivity)
+            local_pool = _as_local_pool(self.local_pool, prepared)
+            w = prepared.sparse_as(self.dtype, 'row_standardized')
+            profiler.lap('weights')
+
+            permutations = self.permutations
+            sig = self.sig
+            keep_simulations = self.keep_simulations
+            n_jobs = self.n_jobs
+            seed = self.seed
+
+            self.localG = self._statistic(x, w, n_jobs)
+            profiler.lap('statistic')
+
+            if permutations:
+                result = _crand_plus(
+                    z=(x - np.mean(x))/np.std(x),
+                    w=w,
+                    observed=self.localG,
+                    permutations=permutations,
+                    keep=keep_simulations,
+                    n_jobs=n_jobs,
+                    chunk_size=self.chunk_size,
+                    stat_func=_local_geary,
+                    seed=seed,
+                    pool=pool,
+                    local_pool=local_pool,
+                    early_stopping=self.early_stopping
+                )
+                self.p_sim, rlocalG = result[:2]
+                if self.early_stopping is not None:
+                    self.n_permutations = result[2]
+                    self.stopped = self.n_permutations < permutations
+                if keep_simulations:
+                    self.rlocalG = rlocalG
+            if permutations:
+                # Labels are those of the adjusted p-values, if any
+                p = _correct(self)
+            profiler.lap('inference')
+
+            if self.labels and permutations:
+                self.labs = self._labels(self.localG, x, p, sig)
+                profiler.lap('labels')
+
+            if profile:
+                self.fit_stats_ = profiler.stats(permutations=permutations_run(
+                    getattr(self, 'p_sim', None), permutations,
+                    getattr(self, 'n_permutations', None)
+                ))
+
+        # State needed by update
+        self._x = x
+        self._prepared = prepared
+        self._fit_params = dict(
+            permutations=permutations, keep_simulations=keep_simulations,
+            n_jobs=n_jobs, chunk_size=self.chunk_size, seed=seed,
+            early_stopping=self.early_stopping,
+            sig=sig, labels=self.labels, dtype=self.dtype,
+            correction=self.correction, pool=pool,
+            local_pool=local_pool
+        )
+
+        del (self.keep_simulations, self.n_jobs, self.chunk_size,
+             self.permutations, self.seed,
+             self.connectivity, self.early_stopping,
+             self.labels, self.dtype)
+
+        return self
+
+    def update(self, changed_ids, new_values):
+        """
+        Update an estimator fitted with fit after the values of a few
+        observations changed, without refitting from scratch.
+
+        The local Geary of an observation is a weighted sum of squared
+        differences with its neighbors, divided by the variance of x.
+        Only the changed observations and those that have them as
+        neighbors are recomputed, along with their pseudo p-values; the
+        other values are rescaled to the new variance. Their p-values
+        are kept, ignoring the change in the few values they are
+        randomised against.
+
+        Arguments
+        ---------
+        changed_ids      : list
+                           ids of the changed observations, as in the
+                           id_order of the weights (positions if the
+                           weights are a scipy.sparse matrix)
+        new_values       : numpy.ndarray
+                           new values of the changed observations
+
+        Returns
+        -------
+        the updated estimator.
+        """
+        if not hasattr(self, '_x'):
+            raise ValueError('update requires an estimator fitted with fit')
+        prepared, params = self._prepared, self._fit_params
+        w = prepared.sparse_as(params['dtype'], 'row_standardized')
+
+        changed = prepared.positions(changed_ids)
+        x = self._x.copy()
+        x[changed] = new_values
+        rows = prepared.neighbors_of(changed)
+
+        # Differences between neighbors only change
+        # scale with the variance of x
+        scale = np.std(self._x)**2 / np.std(x)**2
+        z = (x - np.mean(x))/np.std(x)
+        localG = self.localG * scale
+        localG[rows] = _kernels.local_geary(w, z, rows=rows)
+        self.localG = localG
+
+        if params['permutations']:
+            result = _crand_plus(
+                z=z,
+                w=w,
+                observed=localG[rows],
+                permutations=params['permutations'],
+                keep=params['keep_simulations'],
+                n_jobs=params['n_jobs'],
+                chunk_size=params['chunk_size'],
+                stat_func=_local_geary,
+                seed=params['seed'],
+                pool=params['pool'],
+                local_pool=params['local_pool'],
+                ids=rows,
+                early_stopping=params['early_stopping']
+            )
+            p_sim, rlocalG = result[:2]
+            self.p_sim = self.p_sim.copy()
+            self.p_sim[rows] = p_sim
+            if params['early_stopping'] is not None:
+                self.n_permutations = self.n_permutations.copy()
+                self.n_permutations[rows] = result[2]
+                self.stopped = (self.n_permutations
+                                < params['permutations'])
+            if params['keep_simulations']:
+                self.rlocalG = self.rlocalG * scale
+                self.rlocalG[rows] = rlocalG
+
+        if params['permutations']:
+            p = _correct(self)
+
+        if params['labels'] and params['permutations']:
+            self.labs = self._labels(localG, x, p, params['sig'])
+
+        self._x = x
+
+        return self
+
+    def fit_many(self, X, pool=None):
+        """
+        Fit the Local Geary to several variables sharing the same
+        weights. The weights are prepared once and all columns are
+        randomised in a single pass over the same permuted neighbor ids.
+
+        Arguments
+        ---------
+        X                : numpy.ndarray or pandas.DataFrame
+                           (n, m) array containing m columns of
+                           continuous data
+        pool             : None/PermutationPool
+                           (default=None)
+                           permuted neighbor ids to randomise against,
+                           drawn beforehand in place of the seed (see
+                           permutation_pool.PermutationPool).
+
+        Returns
+        -------
+        the fitted estimator, with localG, p_sim, p_adjusted, rlocalG
+        and labs stacked by column. For a given seed, column j matches
+        fit(X[:, j]). All permutations are run, whatever
+        early_stopping. The local null (local_pool) is not supported.
+
+        Examples
+        --------
+        >>> import libpysal
+        >>> w = libpysal.io.open(libpysal.examples.get_path("stl.gal")).read()
+        >>> f = libpysal.io.open(libpysal.examples.get_path("stl_hom.txt"))
+        >>> X = np.column_stack([f.by_col['HR8893'], f.by_col['HR8488']])
+        >>> lG = Local_Geary(connectivity=w).fit_many(X)
+        >>> lG.localG.shape
+        (78, 2)
+        """
+        if self.local_pool is not None:
+            raise NotImplementedError('The local null does not support '
+                                      'several variables, fit them '
+                                      'one at a time')
+        # Column-major, so that column moments are reduced
+        # exactly as for a single variable in fit
+        X = np.asfortranarray(X, dtype=self.dtype)
+        if X.ndim == 1:
+            X = X.reshape(-1, 1)
+
+        w = PreparedWeights.from_w(self.connectivity).sparse_as(
+            self.dtype, 'row_standardized'
+        )
 
-        w = self.connectivity
-        w.transform = 'r'
-        
         permutations = self.permutations
         sig = self.sig
         keep_simulations = self.keep_simulations
         n_jobs = self.n_jobs
         seed = self.seed
 
-        self.localG = self._statistic(x, w)
+        self.localG = self._statistic(X, w, n_jobs)
 
         if permutations:
-            self.p_sim, self.rlocalG = _crand_plus(
-                z=(x - np.mean(x))/np.std(x),
+            self.p_sim, rlocalG = _crand_plus(
+                z=np.ascontiguousarray(
+                    (X - np.mean(X, axis=0))/np.std(X, axis=0)
+                ),
                 w=w,
                 observed=self.localG,
                 permutations=permutations,
                 keep=keep_simulations,
                 n_jobs=n_jobs,
-                stat_func=_local_geary
+                chunk_size=self.chunk_size,
+                stat_func=_local_geary_many,
+                seed=seed,
+                pool=pool
             )
+            if keep_simulations:
+                self.rlocalG = rlocalG
+
+        if permutations:
+            p = _correct(self, by_column=True)
+
+        if self.labels and permutations:
+            self.labs = self._labels(self.localG, X, p, sig)
 
-        if self.labels:
-            Eij_mean = np.mean(self.localG)
-            x_mean = np.mean(x)
-            # Create empty vector to fill
-            self.labs = np.empty(len(x)) * np.nan
-            # Outliers
-            self.labs[(self.localG < Eij_mean) &
-                      (x > x_mean) &
-                      (self.p_sim <= sig)] = 1
-            # Clusters
-            self.labs[(self.localG < Eij_mean) &
-                      (x < x_mean) &
-                      (self.p_sim <= sig)] = 2
-            # Other
-            self.labs[(self.localG > Eij_mean) &
-                      (self.p_sim <= sig)] = 3
-            # Non-significant
-            self.labs[self.p_sim > sig] = 4
-
-        del (self.keep_simulations, self.n_jobs,
-             self.permutations, self.seed, self.rlocalG,
-             self.connectivity, self.labels)
+        del (self.keep_simulations, self.n_jobs, self.chunk_size,
+             self.permutations, self.seed,
+             self.connectivity, self.early_stopping,
+             self.labels, self.dtype)
 
         return self
 
     @staticmethod
-    def _statistic(x, w):
-        # Caclulate z-scores for x
-        zscore_x = (x - np.mean(x))/np.std(x)
-        # Create focal (xi) and neighbor (zi) values
-        adj_list = w.to_adjlist(remove_symmetric=False)
-        zseries = pd.Series(zscore_x, index=w.id_order)
-        zi = zseries.loc[adj_list.focal].values
-        zj = zseries.loc[adj_list.neighbor].values
-        # Carry out local Geary calculation
-        gs = adj_list.weight.values * (zi-zj)**2
-        # Reorganize data
-        adj_list_gs = pd.DataFrame(adj_list.focal.values, gs).reset_index()
-        adj_list_gs.columns = ['gs', 'ID']
-        adj_list_gs = adj_list_gs.groupby(by='ID').sum()
-
-        localG = adj_list_gs.gs.values
-
-        return (localG)
+    def _labels(localG, x, p, sig):
+        # Similar neighbors, with a low localG, are outliers or
+        # clusters as x is above or below its mean. Means are
+        # taken by column so that (n, m) inputs from fit_many
+        # are labelled per variable
+        return _local_labels(p, sig, stat=localG, x=x)
+
+    @staticmethod
+    def _statistic(x, w, n_jobs=1):
+        # Caclulate z-scores for x, by column
+        # if x is (n, m)
+        zscore_x = (x - np.mean(x, axis=0))/np.std(x, axis=0)
+        # Carry out local Geary calculation on the
+        # sparse weights, sum_j w_ij (z_i - z_j)^2
+        localG = _kernels.local_geary(w, zscore_x, n_jobs=n_jobs)
+
+        return (localG.astype(x.dtype, copy=False))
 
 # --------------------------------------------------------------
 # Conditional Randomization Function Implementations
@@ -185,4 +461,14 @@ class Local_Geary(BaseEstimator):
 @_njit(fastmath=True)
 def _local_geary(i, z, permuted_ids, weights_i, scaling):
     zi, zrand = _prepare_univariate(i, z, permuted_ids, weights_i)
-    return (zi-zrand)**2 @ weights_i
\ No newline at end of file
+    return (zi-zrand)**2 @ weights_i
+
+
+@_njit(fastmath=True)
+def _local_geary_many(i, z, permuted_ids, weights_i, scaling):
+    zi, zrand = _prepare_multivariate(i, z, permuted_ids, weights_i)
+    out = np.empty((zrand.shape[0], zrand.shape[2]), dtype=z.dtype)
+    # same reduction as _local_geary, column by column
+    for j in range(zrand.shape[2]):
+        out[:, j] = (zi[j]-zrand[:, :, j])**2 @ weights_i
+    return out
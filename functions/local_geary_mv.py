@@ -5,25 +5,79 @@ from scipy import sparse
 from scipy import stats
 from sklearn.base import BaseEstimator
 import libpysal as lp
+from esda.crand import njit as _njit
+from . import kernels as _kernels
+from .prepared_weights import PreparedWeights
+from .profiling import FitProfiler, permutations_run
+from .multiple_testing import correct as _correct
+from .labels import local_labels as _local_labels
+from .crand import (
+    crand as _crand_plus,
+    _prepare_multivariate
+)
 
 
 class Local_Geary_MV(BaseEstimator):
 
     """Local Geary - Multivariate"""
 
-    def __init__(self, connectivity=None, permutations=999):
+    def __init__(self, connectivity=None, permutations=999, n_jobs=1,
+                 keep_simulations=True, seed=None, dtype='float64',
+                 labels=False, sig=0.05, correction=None):
         """
         Initialize a Local_Geary_MV estimator
         Arguments
         ---------
-        connectivity     : scipy.sparse matrix object
+        connectivity     : libpysal.weights.W or PreparedWeights
                            the connectivity structure describing
                            the relationships between observed units.
-                           Need not be row-standardized.
+                           Need not be row-standardized, and is not
+                           modified.
         permutations     : int
                            (default=999)
                            number of random permutations for calculation
                            of pseudo p_values
+        n_jobs           : int
+                           (default=1)
+                           Number of cores to be used in the conditional
+                           randomisation and the observed statistic. If -1,
+                           all available cores are used.
+        keep_simulations : Boolean
+                           (default=True)
+                           If True, the entire matrix of replications under
+                           the null is stored in memory and accessible;
+                           otherwise, replications are not saved
+        seed             : None/int
+                           Seed to ensure reproducibility of conditional
+                           randomizations. Must be set here, and not outside
+                           of the function, since numba does not correctly
+                           interpret external seeds nor
+                           numpy.random.RandomState instances.
+        dtype            : str
+                           (default='float64')
+                           Floating point type of the data, weights and
+                           simulations, e.g. 'float32' to halve their
+                           memory at the cost of precision.
+        labels           : boolean
+                           (default=False)
+                           If True, label if an observation belongs to a
+                           cluster (similar neighbors, localG below its
+                           mean), other (localG above its mean) or
+                           non-significant group. 2 = cluster, 3 = other,
+                           4 = non-significant, 0 = undefined (see
+                           labels.local_labels).
+        sig              : float
+                           (default=0.05)
+                           Default significance threshold used for
+                           creation of labels groups.
+        correction       : None/str
+                           (default=None)
+                           Multiple testing correction of the p-values:
+                           'bonferroni', 'fdr_bh' or 'fdr_by'. If given,
+                           the adjusted p-values are stored in p_adjusted
+                           (see multiple_testing.adjust), and the labels
+                           are those of p_adjusted at sig.
+
         Attributes
         ----------
         localG          : numpy array
@@ -32,17 +86,44 @@ class Local_Geary_MV(BaseEstimator):
         p_sim           : numpy array
                           array containing the simulated
                           p-values for each unit.
+        p_adjusted      : numpy array
+                          p_sim adjusted for multiple testing,
+                          if correction is given.
+        labs            : numpy array
+                          uint8 array containing the labels for if each
+                          observation, if labels=True.
+        rlocalG         : numpy array
+                          (n, permutations) array of the simulated
+                          Local Geary values, if keep_simulations=True.
         """
 
         self.connectivity = connectivity
         self.permutations = permutations
-
-    def fit(self, variables):
+        self.n_jobs = n_jobs
+        self.keep_simulations = keep_simulations
+        self.seed = seed
+        self.dtype = dtype
+        self.labels = labels
+        self.sig = sig
+        self.correction = correction
+
+    def fit(self, variables, pool=None, profile=False):
         """
         Arguments
         ---------
         variables        : numpy.ndarray
                            array containing continuous data
+        pool             : None/PermutationPool
+                           (default=None)
+                           permuted neighbor ids to randomise against,
+                           drawn beforehand in place of the seed (see
+                           permutation_pool.PermutationPool).
+        profile          : bool
+                           (default=False)
+                           If True, the wall time, memory and numba
+                           compilation time of each phase of the fit,
+                           and the permutations performed, are recorded
+                           in fit_stats_ (see profiling.FitProfiler).
 
         Returns
         -------
@@ -71,98 +152,85 @@ class Local_Geary_MV(BaseEstimator):
         >>> lG_mv.localG[0:5]
         >>> lG_mv.p_sim[0:5]
         """
-        self.variables = np.array(variables, dtype='float')
-
-        w = self.connectivity
-        w.transform = 'r'
-
-        self.n = len(variables[0])
-        self.w = w
-        
-        permutations = self.permutations
-
-        # Caclulate z-scores for input variables
-        # to be used in _statistic and _crand
-        zvariables = [stats.zscore(i) for i in variables]
-
-        self.localG = self._statistic(variables, zvariables, w)
-
-        if permutations:
-            self._crand(zvariables)
-            sim = np.transpose(self.Gs)
-            above = sim >= self.localG
-            larger = above.sum(0)
-            low_extreme = (permutations - larger) < larger
-            larger[low_extreme] = permutations - larger[low_extreme]
-            self.p_sim = (larger + 1.0) / (permutations + 1.0)
-
-        del (self.n, self.permutations, self.Gs,
-             self.connectivity)
+        with FitProfiler(profile) as profiler:
+            variables = np.array(variables, dtype=self.dtype)
+
+            w = PreparedWeights.from_w(self.connectivity).sparse_as(
+                self.dtype, 'row_standardized'
+            )
+            profiler.lap('weights')
+
+            self.n = len(variables[0])
+            self.w = w
+
+            permutations = self.permutations
+            keep_simulations = self.keep_simulations
+            n_jobs = self.n_jobs
+            seed = self.seed
+
+            # Caclulate z-scores for input variables
+            # to be used in _statistic and _crand
+            zvariables = [stats.zscore(i) for i in variables]
+
+            self.localG = self._statistic(variables, zvariables, w, n_jobs)
+            profiler.lap('statistic')
+
+            if permutations:
+                self.p_sim, rlocalG = _crand_plus(
+                    z=np.column_stack(zvariables),
+                    w=w,
+                    observed=self.localG,
+                    permutations=permutations,
+                    keep=keep_simulations,
+                    n_jobs=n_jobs,
+                    stat_func=_local_geary_mv,
+                    seed=seed,
+                    pool=pool
+                )
+                if keep_simulations:
+                    self.rlocalG = rlocalG
+            if permutations:
+                # Labels are those of the adjusted p-values, if any
+                p = _correct(self)
+            profiler.lap('inference')
+
+            if self.labels and permutations:
+                self.labs = _local_labels(p, self.sig, stat=self.localG)
+                profiler.lap('labels')
+
+            if profile:
+                self.fit_stats_ = profiler.stats(permutations=permutations_run(
+                    getattr(self, 'p_sim', None), permutations
+                ))
+
+        del (self.n, self.keep_simulations, self.n_jobs,
+             self.permutations, self.seed, self.w, self.connectivity,
+             self.dtype, self.labels)
 
         return self
 
     @staticmethod
-    def _statistic(variables, zvariables, w):
+    def _statistic(variables, zvariables, w, n_jobs=1):
         # Define denominator adjustment
         k = len(variables)
-        # Create focal and neighbor values
-        adj_list = w.to_adjlist(remove_symmetric=False)
-        zseries = [pd.Series(i, index=w.id_order) for i in zvariables]
-        focal = [zseries[i].loc[adj_list.focal].values for
-                 i in range(len(variables))]
-        neighbor = [zseries[i].loc[adj_list.neighbor].values for
-                    i in range(len(variables))]
-        # Carry out local Geary calculation
-        gs = adj_list.weight.values * \
-            (np.array(focal) - np.array(neighbor))**2
-        # Reorganize data
-        temp = pd.DataFrame(gs).T
-        temp['ID'] = adj_list.focal.values
-        adj_list_gs = temp.groupby(by='ID').sum()
-        localG = np.array(adj_list_gs.sum(axis=1)/k)
-
-        return (localG)
-
-    def _crand(self, zvariables):
-        """
-        conditional randomization
-
-        for observation i with ni neighbors,  the candidate set cannot include
-        i (we don't want i being a neighbor of i). we have to sample without
-        replacement from a set of ids that doesn't include i. numpy doesn't
-        directly support sampling wo replacement and it is expensive to
-        implement this. instead we omit i from the original ids,  permute the
-        ids and take the first ni elements of the permuted ids as the
-        neighbors to i in each randomization.
-
-        """
-        nvars = self.variables.shape[0]
-        n = self.variables.shape[1]
-        Gs = np.zeros((self.n, self.permutations))
-        n_1 = self.n - 1
-        prange = list(range(self.permutations))
-        k = self.w.max_neighbors + 1
-        nn = self.n - 1
-        rids = np.array([np.random.permutation(nn)[0:k] for i in prange])
-        ids = np.arange(self.w.n)
-        ido = self.w.id_order
-        w = [self.w.weights[ido[i]] for i in ids]
-        wc = [self.w.cardinalities[ido[i]] for i in ids]
-
-        for i in range(self.w.n):
-            idsi = ids[ids != i]
-            np.random.shuffle(idsi)
-            vars_rand = []
-            for j in range(nvars):
-                vars_rand.append(zvariables[j][idsi[rids[:, 0:wc[i]]]])
-            # vars rand as tmp
-            # Calculate diff
-            diff = []
-            for z in range(nvars):
-                diff.append((np.array((zvariables[z][i]-vars_rand[z])**2
-                                      * w[i])).sum(1)/nvars)
-            # add up differences
-            temp = np.array([sum(x) for x in zip(*diff)])
-            # Assign to object to be returned
-            Gs[i] = temp
-        self.Gs = Gs
\ No newline at end of file
+        # Carry out local Geary calculation for every
+        # variable at once on an (n, k) array
+        gs = _kernels.local_geary(w, np.column_stack(zvariables),
+                                  n_jobs=n_jobs)
+        localG = gs.sum(axis=1)/k
+
+        return (localG.astype(gs.dtype, copy=False))
+
+# --------------------------------------------------------------
+# Conditional Randomization Function Implementations
+# --------------------------------------------------------------
+
+# Note: does not using the scaling parameter
+
+@_njit(fastmath=True)
+def _local_geary_mv(i, z, permuted_ids, weights_i, scaling):
+    zi, zrand = _prepare_multivariate(i, z, permuted_ids, weights_i)
+    # (permutations, cardinality) sum of squared differences
+    # over the k variables
+    diff = ((zi - zrand)**2).sum(axis=2)
+    return (diff @ weights_i) / z.shape[1]
@@ -2,10 +2,19 @@ import numpy as np
 import pandas as pd
 from sklearn.base import BaseEstimator
 from libpysal import weights
-from esda.crand import (
-    crand as _crand_plus,
-    njit as _njit,
-    _prepare_univariate
+from esda.crand import njit as _njit
+from . import kernels as _kernels
+from .prepared_weights import PreparedWeights
+from .profiling import FitProfiler, permutations_run
+from .local_null import as_local_pool as _as_local_pool
+from .multiple_testing import correct as _correct
+from .labels import local_labels as _local_labels
+from .crand import (
+    crand_nonzero as _crand_nonzero,
+    hypergeom_pvalues as _hypergeom_pvalues,
+    _neighbor_sum,
+    _prepare_univariate,
+    _prepare_multivariate
 )
 
 
@@ -14,21 +23,30 @@ class Local_Join_Count(BaseEstimator):
     """Univariate Local Join Count Statistic"""
 
     def __init__(self, connectivity=None, permutations=999, n_jobs=1, 
-                 keep_simulations=True, seed=None):
+                 keep_simulations=True, seed=None, inference='permutation',
+                 early_stopping=None, labels=False, sig=0.05,
+                 correction=None, local_pool=None, chunk_size=None):
         """
         Initialize a Local_Join_Count estimator
         Arguments
         ---------
-        connectivity     : scipy.sparse matrix object
+        connectivity     : libpysal.weights.W or PreparedWeights
                            the connectivity structure describing
                            the relationships between observed units.
-                           Need not be row-standardized.
+                           Need not be row-standardized, and is not
+                           modified.
         permutations     : int
                            number of random permutations for calculation of pseudo
                            p_values
         n_jobs           : int
-                           Number of cores to be used in the conditional randomisation. If -1,
-                           all available cores are used.    
+                           Number of cores to be used in the conditional randomisation
+                           and the observed statistic. If -1, all available cores are used.
+        chunk_size       : None/int
+                           (default=None)
+                           Number of consecutive units randomised by each
+                           task of the conditional randomisation. If None,
+                           the units are split into n_jobs chunks. The
+                           p-values do not depend on n_jobs nor chunk_size.
         keep_simulations : Boolean
                            (default=True)
                            If True, the entire matrix of replications under the null 
@@ -39,7 +57,54 @@ class Local_Join_Count(BaseEstimator):
                            Must be set here, and not outside of the function, since numba 
                            does not correctly interpret external seeds 
                            nor numpy.random.RandomState instances.              
-                           
+        inference        : str
+                           (default='permutation')
+                           'permutation' for pseudo p-values from conditional
+                           randomisation, or 'analytic' for their exact
+                           (hypergeometric) counterpart, without permutations.
+        early_stopping   : None/float
+                           (default=None)
+                           If a significance level, permutations are run
+                           in batches and stop for each observation once
+                           its pseudo p-value is known to exceed it, so
+                           that significance at that level is unchanged.
+                           The number of permutations run for each
+                           observation is stored in n_permutations, and
+                           the observations that stopped early are
+                           marked in stopped. Their p_sim is the
+                           Besag-Clifford estimate from the permutations
+                           run, which exceeds the level as the p-value
+                           of all permutations does, but is not that
+                           p-value and may be below it. p_sim is thus
+                           only decision-equivalent at this level, and
+                           should not be compared at another one.
+        labels           : boolean
+                           (default=False)
+                           If True, label if an observation belongs to a
+                           cluster (significant joins) or non-significant
+                           group. 2 = cluster, 4 = non-significant,
+                           0 = undefined, for those without joins (see
+                           labels.local_labels).
+        sig              : float
+                           (default=0.05)
+                           Default significance threshold used for
+                           creation of labels groups.
+        correction       : None/str
+                           (default=None)
+                           Multiple testing correction of the p-values:
+                           'bonferroni', 'fdr_bh' or 'fdr_by'. If given,
+                           the adjusted p-values are stored in p_adjusted
+                           (see multiple_testing.adjust), and the labels
+                           are those of p_adjusted at sig.
+        local_pool       : None/int/LocalPool
+                           (default=None)
+                           If given, permutation inference is under a
+                           spatially-constrained null, drawing the random
+                           neighbors of each unit from its candidates
+                           rather than the whole map: its neighbors up to
+                           this order in connectivity if an int (see
+                           local_null.LocalPool). Used by fit and update,
+                           without early_stopping.
         Attributes
         ----------
         LJC             : numpy array
@@ -48,6 +113,26 @@ class Local_Join_Count(BaseEstimator):
         p_sim           : numpy array
                           array containing the simulated
                           p-values for each unit.
+        p_analytic      : numpy array
+                          array containing the exact p-values
+                          for each unit, if inference='analytic'.
+        p_adjusted      : numpy array
+                          p_sim or p_analytic adjusted for multiple testing,
+                          if correction is given.
+        labs            : numpy array
+                          uint8 array containing the labels for if each
+                          observation, if labels=True.
+        rjoins          : numpy array
+                          (n, permutations) array of the simulated
+                          join counts, if keep_simulations=True.
+        n_permutations  : numpy array
+                          number of permutations run for each unit,
+                          if early_stopping is given.
+        stopped         : numpy array
+                          boolean array of the units that stopped
+                          before all permutations, whose p_sim is a
+                          Besag-Clifford estimate, if early_stopping is
+                          given.
 
         """
 
@@ -56,13 +141,31 @@ class Local_Join_Count(BaseEstimator):
         self.n_jobs = n_jobs
         self.keep_simulations = keep_simulations
         self.seed = seed
+        self.early_stopping = early_stopping
+        self.inference = inference
+        self.labels = labels
+        self.sig = sig
+        self.correction = correction
+        self.local_pool = local_pool
+        self.chunk_size = chunk_size
 
-    def fit(self, x):
+    def fit(self, x, pool=None, profile=False):
         """
         Arguments
         ---------
         x               : numpy.ndarray
                           array containing binary (0/1) data
+        pool            : None/PermutationPool
+                          (default=None)
+                          permuted neighbor ids to randomise against,
+                          drawn beforehand in place of the seed (see
+                          permutation_pool.PermutationPool).
+        profile         : bool
+                          (default=False)
+                          If True, the wall time, memory and numba
+                          compilation time of each phase of the fit,
+                          and the permutations performed, are recorded
+                          in fit_stats_ (see profiling.FitProfiler).
         Returns
         -------
         the fitted estimator.
@@ -93,60 +196,285 @@ class Local_Join_Count(BaseEstimator):
         >>> LJC_uni.LJC
         >>> LJC_uni.p_sim
         """
-        # Need to ensure that the np.array() are of
-        # dtype='float' for numba
-        x = np.array(x, dtype='float')
-
-        w = self.connectivity
-        # Fill the diagonal with 0s
-        w = weights.util.fill_diagonal(w, val=0)
-        w.transform = 'b'
+        # Binary indicator as uint8, which the conditional
+        # randomisation works on directly
+        with FitProfiler(profile) as profiler:
+            x = (np.asarray(x) == 1).astype(np.uint8)
+
+            # Binary weights with a zero diagonal
+            prepared = PreparedWeights.from_w(self.connectivity)
+            local_pool = _as_local_pool(self.local_pool, prepared)
+            w = prepared.binary
+            profiler.lap('weights')
+
+            keep_simulations = self.keep_simulations
+            n_jobs = self.n_jobs
+            seed = self.seed
+
+            permutations = self.permutations
+
+            self.x = x
+            self.n = len(x)
+            self.w = w
+
+            self.LJC = self._statistic(x, w, n_jobs)
+            profiler.lap('statistic')
+
+            if self.inference == 'analytic':
+                ones = (x == 1).astype('float')
+                self.p_analytic = _hypergeom_pvalues(
+                    self.LJC, prepared.cardinalities, ones.sum() - ones, self.n
+                )
+                # Set p-values for those with LJC of 0 to NaN
+                self.p_analytic[self.LJC == 0] = 'NaN'
+            elif self.inference != 'permutation':
+                raise NotImplementedError(f'The requested inference method \
+                ({self.inference}) is not currently supported!')
+            elif permutations:
+                result = _crand_nonzero(
+                    z=self.x, 
+                    w=self.w, 
+                    observed=self.LJC,
+                    permutations=permutations, 
+                    keep=keep_simulations, 
+                    n_jobs=n_jobs,
+                    chunk_size=self.chunk_size,
+                    stat_func=_ljc_uni,
+                    seed=seed,
+                    pool=pool,
+                    local_pool=local_pool,
+                    early_stopping=self.early_stopping
+                )
+                self.p_sim, rjoins = result[:2]
+                if self.early_stopping is not None:
+                    self.n_permutations = result[2]
+                    self.stopped = self.n_permutations < permutations
+                if keep_simulations:
+                    self.rjoins = rjoins
+            if self.inference == 'analytic' or permutations:
+                # Labels are those of the adjusted p-values, if any
+                p = _correct(self, self.inference)
+            profiler.lap('inference')
+
+            if self.labels and (self.inference == 'analytic' or permutations):
+                self.labs = _local_labels(p, self.sig)
+                profiler.lap('labels')
+
+            if profile:
+                self.fit_stats_ = profiler.stats(permutations=permutations_run(
+                    getattr(self, 'p_sim', None), permutations,
+                    getattr(self, 'n_permutations', None)
+                ))
+
+        # State needed by update
+        self._x = x
+        self._prepared = prepared
+        self._fit_params = dict(
+            permutations=permutations, keep_simulations=keep_simulations,
+            n_jobs=n_jobs, chunk_size=self.chunk_size, seed=seed,
+            early_stopping=self.early_stopping,
+            inference=self.inference, labels=self.labels, sig=self.sig,
+            correction=self.correction, pool=pool,
+            local_pool=local_pool
+        )
+
+        del (self.n, self.keep_simulations, self.n_jobs, self.chunk_size,
+             self.permutations, self.seed, self.w, self.x,
+             self.connectivity, self.early_stopping,
+             self.inference, self.labels)
         
+        return self
+
+    def update(self, changed_ids, new_values):
+        """
+        Update an estimator fitted with fit after the values of a few
+        observations changed, without refitting from scratch.
+
+        Only the join counts of the changed observations and of those
+        that have them as neighbors are recomputed, along with their
+        pseudo p-values. The p-values of the other observations are
+        kept, ignoring the change in the few values they are randomised
+        against. Exact p-values (inference='analytic') depend on the
+        total count of ones and are recomputed for all observations.
+
+        Arguments
+        ---------
+        changed_ids      : list
+                           ids of the changed observations, as in the
+                           id_order of the weights (positions if the
+                           weights are a scipy.sparse matrix)
+        new_values       : numpy.ndarray
+                           new binary (0/1) values of the changed
+                           observations
+
+        Returns
+        -------
+        the updated estimator.
+        """
+        if not hasattr(self, '_x'):
+            raise ValueError('update requires an estimator fitted with fit')
+        prepared, params = self._prepared, self._fit_params
+        w = prepared.binary
+
+        changed = prepared.positions(changed_ids)
+        x = self._x.copy()
+        x[changed] = np.asarray(new_values) == 1
+        rows = prepared.neighbors_of(changed)
+
+        LJC = self.LJC.copy()
+        LJC[rows] = _kernels.local_join_count(w, (x == 1).astype('float'),
+                                              rows=rows)
+        self.LJC = LJC
+
+        if params['inference'] == 'analytic':
+            ones = (x == 1).astype('float')
+            self.p_analytic = _hypergeom_pvalues(
+                LJC, prepared.cardinalities, ones.sum() - ones, len(x)
+            )
+            # Set p-values for those with LJC of 0 to NaN
+            self.p_analytic[LJC == 0] = 'NaN'
+        elif params['permutations']:
+            result = _crand_nonzero(
+                z=x,
+                w=w,
+                observed=LJC[rows],
+                permutations=params['permutations'],
+                keep=params['keep_simulations'],
+                n_jobs=params['n_jobs'],
+                chunk_size=params['chunk_size'],
+                stat_func=_ljc_uni,
+                seed=params['seed'],
+                pool=params['pool'],
+                local_pool=params['local_pool'],
+                ids=rows,
+                early_stopping=params['early_stopping']
+            )
+            p_sim, rjoins = result[:2]
+            self.p_sim = self.p_sim.copy()
+            self.p_sim[rows] = p_sim
+            if params['early_stopping'] is not None:
+                self.n_permutations = self.n_permutations.copy()
+                self.n_permutations[rows] = result[2]
+                self.stopped = (self.n_permutations
+                                < params['permutations'])
+            if params['keep_simulations']:
+                self.rjoins = self.rjoins.copy()
+                self.rjoins[rows] = rjoins
+
+        if params['inference'] == 'analytic' or params['permutations']:
+            p = _correct(self, params['inference'])
+
+        if params['labels'] and (params['inference'] == 'analytic'
+                                 or params['permutations']):
+            self.labs = _local_labels(p, params['sig'])
+
+        self._x = x
+
+        return self
+
+    def fit_many(self, X, pool=None):
+        """
+        Fit the univariate local join count to several binary variables
+        sharing the same weights. The weights are prepared once and all
+        columns are randomised in a single pass over the same permuted
+        neighbor ids.
+
+        Arguments
+        ---------
+        X               : numpy.ndarray or pandas.DataFrame
+                          (n, m) array containing m columns of
+                          binary (0/1) data
+        pool            : None/PermutationPool
+                          (default=None)
+                          permuted neighbor ids to randomise against,
+                          drawn beforehand in place of the seed (see
+                          permutation_pool.PermutationPool).
+
+        Returns
+        -------
+        the fitted estimator, with LJC, p_sim (or p_analytic),
+        p_adjusted, rjoins and labs stacked by column. For a given seed, column j matches
+        fit(X[:, j]). All permutations are run, whatever
+        early_stopping. The local null (local_pool) is not supported.
+
+        Examples
+        --------
+        >>> import libpysal
+        >>> w = libpysal.weights.lat2W(4, 4)
+        >>> x = np.ones(16)
+        >>> x[0:8] = 0
+        >>> LJC_uni = Local_Join_Count(connectivity=w).fit_many(np.column_stack((x, 1-x)))
+        >>> LJC_uni.LJC.shape
+        (16, 2)
+        """
+        if self.local_pool is not None:
+            raise NotImplementedError('The local null does not support '
+                                      'several variables, fit them '
+                                      'one at a time')
+        X = (np.asarray(X) == 1).astype(np.uint8)
+        if X.ndim == 1:
+            X = X.reshape(-1, 1)
+
+        # Binary weights with a zero diagonal
+        prepared = PreparedWeights.from_w(self.connectivity)
+        w = prepared.binary
+
         keep_simulations = self.keep_simulations
         n_jobs = self.n_jobs
         seed = self.seed
-        
+
         permutations = self.permutations
-        
-        self.x = x
-        self.n = len(x)
-        self.w = w
 
-        self.LJC = self._statistic(x, w)
-        
-        if permutations:
-            self.p_sim, self.rjoins = _crand_plus(
-                z=self.x, 
-                w=self.w, 
+        self.LJC = self._statistic(X, w, n_jobs)
+
+        if self.inference == 'analytic':
+            ones = (X == 1).astype('float')
+            self.p_analytic = _hypergeom_pvalues(
+                self.LJC, prepared.cardinalities,
+                ones.sum(axis=0) - ones, X.shape[0]
+            )
+            # Set p-values for those with LJC of 0 to NaN
+            self.p_analytic[self.LJC == 0] = 'NaN'
+        elif self.inference != 'permutation':
+            raise NotImplementedError(f'The requested inference method \
+            ({self.inference}) is not currently supported!')
+        elif permutations:
+            self.p_sim, rjoins = _crand_nonzero(
+                z=X,
+                w=w,
                 observed=self.LJC,
-                permutations=permutations, 
-                keep=keep_simulations, 
+                permutations=permutations,
+                keep=keep_simulations,
                 n_jobs=n_jobs,
-                stat_func=_ljc_uni
+                chunk_size=self.chunk_size,
+                stat_func=_ljc_uni_many,
+                seed=seed,
+                pool=pool
             )
             # Set p-values for those with LJC of 0 to NaN
             self.p_sim[self.LJC == 0] = 'NaN'
-        
-        del (self.n, self.keep_simulations, self.n_jobs, 
-             self.permutations, self.seed, self.w, self.x,
-             self.connectivity, self.rjoins)
-        
+            if keep_simulations:
+                self.rjoins = rjoins
+
+        if self.inference == 'analytic' or permutations:
+            p = _correct(self, self.inference, by_column=True)
+
+        if self.labels and (self.inference == 'analytic' or permutations):
+            self.labs = _local_labels(p, self.sig)
+
+        del (self.keep_simulations, self.n_jobs, self.chunk_size,
+             self.permutations, self.seed, self.connectivity,
+             self.early_stopping, self.inference,
+             self.labels)
+
         return self
 
     @staticmethod
-    def _statistic(x, w):
-        # Create adjacency list. Note that remove_symmetric=False - this is
-        # different from the esda.Join_Counts() function.
-        adj_list = w.to_adjlist(remove_symmetric=False)
-        zseries = pd.Series(x, index=w.id_order)
-        focal = zseries.loc[adj_list.focal].values
-        neighbor = zseries.loc[adj_list.neighbor].values
-        LJC = (focal == 1) & (neighbor == 1)
-        adj_list_LJC = pd.DataFrame(adj_list.focal.values,
-                                    LJC.astype('uint8')).reset_index()
-        adj_list_LJC.columns = ['LJC', 'ID']
-        adj_list_LJC = adj_list_LJC.groupby(by='ID').sum()
-        LJC = np.array(adj_list_LJC.LJC.values, dtype='float')
+    def _statistic(x, w, n_jobs=1):
+        # Count the joins on the sparse binary weights,
+        # x_i * sum_j w_ij x_j
+        x = (np.asarray(x) == 1).astype('float')
+        LJC = _kernels.local_join_count(w, x, n_jobs=n_jobs)
         return (LJC)
 
 # --------------------------------------------------------------
@@ -158,4 +486,13 @@ class Local_Join_Count(BaseEstimator):
 @_njit(fastmath=True)
 def _ljc_uni(i, z, permuted_ids, weights_i, scaling):
     zi, zrand = _prepare_univariate(i, z, permuted_ids, weights_i)
-    return zi * (zrand @ weights_i)
\ No newline at end of file
+    return zi * _neighbor_sum(zrand, weights_i)
+
+
+@_njit(fastmath=True)
+def _ljc_uni_many(i, z, permuted_ids, weights_i, scaling):
+    zi, zrand = _prepare_multivariate(i, z, permuted_ids, weights_i)
+    joins = np.zeros((zrand.shape[0], zrand.shape[2]))
+    for c in range(weights_i.shape[0]):
+        joins += zrand[:, c, :] * weights_i[c]
+    return zi * joins
@@ -4,11 +4,19 @@ import warnings
 from scipy import sparse
 from sklearn.base import BaseEstimator
 from libpysal import weights
-from esda.crand import (
-    crand as _crand_plus,
-    njit as _njit,
+from esda.crand import njit as _njit
+from . import kernels as _kernels
+from .prepared_weights import PreparedWeights
+from .profiling import FitProfiler, permutations_run
+from .local_null import as_local_pool as _as_local_pool
+from .multiple_testing import correct as _correct
+from .labels import local_labels as _local_labels
+from .crand import (
+    crand_nonzero as _crand_nonzero,
+    hypergeom_pvalues as _hypergeom_pvalues,
+    _neighbor_sum,
     _prepare_univariate,
-    _prepare_bivariate
+    _prepare_multivariate
 )
 
 
@@ -17,21 +25,30 @@ class Local_Join_Count_BV(BaseEstimator):
     """Univariate Local Join Count Statistic"""
 
     def __init__(self, connectivity=None, permutations=999, n_jobs=1, 
-                 keep_simulations=True, seed=None):
+                 keep_simulations=True, seed=None, inference='permutation',
+                 early_stopping=None, labels=False, sig=0.05,
+                 correction=None, local_pool=None, chunk_size=None):
         """
         Initialize a Local_Join_Count_BV estimator
         Arguments
         ---------
-        connectivity     : scipy.sparse matrix object
+        connectivity     : libpysal.weights.W or PreparedWeights
                            the connectivity structure describing
                            the relationships between observed units.
-                           Need not be row-standardized.
+                           Need not be row-standardized, and is not
+                           modified.
         permutations     : int
                            number of random permutations for calculation of pseudo
                            p_values
         n_jobs           : int
-                           Number of cores to be used in the conditional randomisation. If -1,
-                           all available cores are used.    
+                           Number of cores to be used in the conditional randomisation
+                           and the observed statistic. If -1, all available cores are used.
+        chunk_size       : None/int
+                           (default=None)
+                           Number of consecutive units randomised by each
+                           task of the conditional randomisation. If None,
+                           the units are split into n_jobs chunks. The
+                           p-values do not depend on n_jobs nor chunk_size.
         keep_simulations : Boolean
                            (default=True)
                            If True, the entire matrix of replications under the null 
@@ -42,7 +59,54 @@ class Local_Join_Count_BV(BaseEstimator):
                            Must be set here, and not outside of the function, since numba 
                            does not correctly interpret external seeds 
                            nor numpy.random.RandomState instances.              
-                           
+        inference        : str
+                           (default='permutation')
+                           'permutation' for pseudo p-values from conditional
+                           randomisation, or 'analytic' for their exact
+                           (hypergeometric) counterpart, without permutations.
+        early_stopping   : None/float
+                           (default=None)
+                           If a significance level, permutations are run
+                           in batches and stop for each observation once
+                           its pseudo p-value is known to exceed it, so
+                           that significance at that level is unchanged.
+                           The number of permutations run for each
+                           observation is stored in n_permutations, and
+                           the observations that stopped early are
+                           marked in stopped. Their p_sim is the
+                           Besag-Clifford estimate from the permutations
+                           run, which exceeds the level as the p-value
+                           of all permutations does, but is not that
+                           p-value and may be below it. p_sim is thus
+                           only decision-equivalent at this level, and
+                           should not be compared at another one.
+        labels           : boolean
+                           (default=False)
+                           If True, label if an observation belongs to a
+                           cluster (significant joins) or non-significant
+                           group, in labs. 2 = cluster,
+                           4 = non-significant, 0 = undefined, for those
+                           without joins (see labels.local_labels).
+        sig              : float
+                           (default=0.05)
+                           Default significance threshold used for
+                           creation of labels groups.
+        correction       : None/str
+                           (default=None)
+                           Multiple testing correction of the p-values:
+                           'bonferroni', 'fdr_bh' or 'fdr_by'. If given,
+                           the adjusted p-values are stored in p_adjusted
+                           (see multiple_testing.adjust), and the labels
+                           are those of p_adjusted at sig.
+        local_pool       : None/int/LocalPool
+                           (default=None)
+                           If given, permutation inference is under a
+                           spatially-constrained null, drawing the random
+                           neighbors of each unit from its candidates
+                           rather than the whole map: its neighbors up to
+                           this order in connectivity if an int (see
+                           local_null.LocalPool). Used by fit and update,
+                           without early_stopping.
         """
 
         self.connectivity = connectivity
@@ -50,8 +114,15 @@ class Local_Join_Count_BV(BaseEstimator):
         self.n_jobs = n_jobs
         self.keep_simulations = keep_simulations
         self.seed = seed
+        self.early_stopping = early_stopping
+        self.inference = inference
+        self.labels = labels
+        self.sig = sig
+        self.correction = correction
+        self.local_pool = local_pool
+        self.chunk_size = chunk_size
 
-    def fit(self, x, y, case="CLC"):
+    def fit(self, x, y, case="CLC", pool=None, profile=False):
         """
         Arguments
         ---------
@@ -63,6 +134,17 @@ class Local_Join_Count_BV(BaseEstimator):
                            "BJC" for bivariate local join count,
                            "CLC" for co-location local join count.
                            Details in :cite:`AnselinLi2019`.
+        pool             : None/PermutationPool
+                           (default=None)
+                           permuted neighbor ids to randomise against,
+                           drawn beforehand in place of the seed (see
+                           permutation_pool.PermutationPool).
+        profile          : bool
+                           (default=False)
+                           If True, the wall time, memory and numba
+                           compilation time of each phase of the fit,
+                           and the permutations performed, are recorded
+                           in fit_stats_ (see profiling.FitProfiler).
 
         Returns
         -------
@@ -109,100 +191,134 @@ class Local_Join_Count_BV(BaseEstimator):
         >>> LJC_BV_Case2.LJC
         >>> LJC_BV_Case2.p_sim
         """
-        # Need to ensure that the np.array() are of
-        # dtype='float' for numba
-        x = np.array(x, dtype='float')
-        y = np.array(y, dtype='float')
-
-        w = self.connectivity
-        # Fill the diagonal with 0s
-        w = weights.util.fill_diagonal(w, val=0)
-        w.transform = 'b'
-
-        self.x = x
-        self.y = y
-        self.n = len(x)
-        self.w = w
-        self.case = case
-        
-        keep_simulations = self.keep_simulations
-        n_jobs = self.n_jobs
-        seed = self.seed
-        
-        permutations = self.permutations
-
-        self.LJC = self._statistic(x, y, w, case=case)
-
-        if permutations:
-            if case == "BJC":
-                self.p_sim, self.rjoins = _crand_plus(
-                    z=np.column_stack((x, y)),
-                    w=self.w, 
-                    observed=self.LJC,
-                    permutations=permutations, 
-                    keep=True, 
-                    n_jobs=n_jobs,
-                    stat_func=_ljc_bv_case1
-                )
-                # Set p-values for those with LJC of 0 to NaN
-                self.p_sim[self.LJC == 0] = 'NaN'
-            elif case == "CLC":
-                self.p_sim, self.rjoins = _crand_plus(
-                    z=np.column_stack((x, y)),
-                    w=self.w, 
-                    observed=self.LJC,
-                    permutations=permutations, 
-                    keep=True, 
-                    n_jobs=n_jobs,
-                    stat_func=_ljc_bv_case2
+        with FitProfiler(profile) as profiler:
+            # Binary indicators as uint8, which the conditional
+            # randomisation works on directly
+            x = (np.asarray(x) == 1).astype(np.uint8)
+            y = (np.asarray(y) == 1).astype(np.uint8)
+
+            # Binary weights with a zero diagonal
+            prepared = PreparedWeights.from_w(self.connectivity)
+            local_pool = _as_local_pool(self.local_pool, prepared)
+            w = prepared.binary
+            profiler.lap('weights')
+
+            self.x = x
+            self.y = y
+            self.n = len(x)
+            self.w = w
+            self.case = case
+
+            keep_simulations = self.keep_simulations
+            n_jobs = self.n_jobs
+            seed = self.seed
+
+            permutations = self.permutations
+
+            self.LJC = self._statistic(x, y, w, case=case, n_jobs=n_jobs)
+            profiler.lap('statistic')
+
+            if self.inference == 'analytic':
+                # The randomised neighbor values, as in
+                # _ljc_bv_case1 and _ljc_bv_case2
+                if case == "BJC":
+                    ones = y
+                elif case == "CLC":
+                    ones = x * y
+                else:
+                    raise NotImplementedError(f'The requested LJC method \
+                    ({case}) is not currently supported!')
+                self.p_analytic = _hypergeom_pvalues(
+                    self.LJC, prepared.cardinalities, ones.sum() - ones, self.n
                 )
                 # Set p-values for those with LJC of 0 to NaN
-                self.p_sim[self.LJC == 0] = 'NaN'
-            else:
-                raise NotImplementedError(f'The requested LJC method ({case}) \
-                is not currently supported!')
+                self.p_analytic[self.LJC == 0] = 'NaN'
+            elif self.inference != 'permutation':
+                raise NotImplementedError(f'The requested inference method \
+                ({self.inference}) is not currently supported!')
+            elif permutations:
+                if case == "BJC":
+                    result = _crand_nonzero(
+                        z=np.column_stack((x, y)),
+                        w=self.w, 
+                        observed=self.LJC,
+                        permutations=permutations, 
+                        keep=keep_simulations, 
+                        n_jobs=n_jobs,
+                        chunk_size=self.chunk_size,
+                        stat_func=_ljc_bv_case1,
+                        seed=seed,
+                        pool=pool,
+                        local_pool=local_pool,
+                        early_stopping=self.early_stopping
+                    )
+                    self.p_sim, rjoins = result[:2]
+                    if self.early_stopping is not None:
+                        self.n_permutations = result[2]
+                        self.stopped = self.n_permutations < permutations
+                elif case == "CLC":
+                    result = _crand_nonzero(
+                        z=np.column_stack((x, y)),
+                        w=self.w, 
+                        observed=self.LJC,
+                        permutations=permutations, 
+                        keep=keep_simulations, 
+                        n_jobs=n_jobs,
+                        chunk_size=self.chunk_size,
+                        stat_func=_ljc_bv_case2,
+                        seed=seed,
+                        pool=pool,
+                        local_pool=local_pool,
+                        early_stopping=self.early_stopping
+                    )
+                    self.p_sim, rjoins = result[:2]
+                    if self.early_stopping is not None:
+                        self.n_permutations = result[2]
+                        self.stopped = self.n_permutations < permutations
+                else:
+                    raise NotImplementedError(f'The requested LJC method \
+                    ({case}) is not currently supported!')
+                if keep_simulations:
+                    self.rjoins = rjoins
+            if self.inference == 'analytic' or permutations:
+                # Labels are those of the adjusted p-values, if any
+                p = _correct(self, self.inference)
+            profiler.lap('inference')
+
+            if self.labels and (self.inference == 'analytic' or permutations):
+                self.labs = _local_labels(p, self.sig)
+                profiler.lap('labels')
+
+            if profile:
+                self.fit_stats_ = profiler.stats(permutations=permutations_run(
+                    getattr(self, 'p_sim', None), permutations,
+                    getattr(self, 'n_permutations', None)
+                ))
 
-        del (self.n, self.keep_simulations, self.n_jobs, 
+        del (self.n, self.keep_simulations, self.n_jobs, self.chunk_size,
              self.permutations, self.seed, self.w, self.x,
-             self.y, self.connectivity, self.rjoins)
+             self.y, self.connectivity, self.early_stopping,
+             self.inference, self.labels)
                 
         return self
 
     @staticmethod
-    def _statistic(x, y, w, case):
-        # Create adjacency list. Note that remove_symmetric=False - this is
-        # different from the esda.Join_Counts() function.
-        adj_list = w.to_adjlist(remove_symmetric=False)
-
-        # First, set up a series that maps the values
-        # to the weights table
-        zseries_x = pd.Series(x, index=w.id_order)
-        zseries_y = pd.Series(y, index=w.id_order)
-
-        # Map the values to the focal (i) values
-        focal_x = zseries_x.loc[adj_list.focal].values
-        focal_y = zseries_y.loc[adj_list.focal].values
-
-        # Map the values to the neighbor (j) values
-        neighbor_x = zseries_x.loc[adj_list.neighbor].values
-        neighbor_y = zseries_y.loc[adj_list.neighbor].values
+    def _statistic(x, y, w, case, n_jobs=1):
+        x = np.asarray(x)
+        y = np.asarray(y)
 
         if case == "BJC":
-            BJC = (focal_x == 1) & (focal_y == 0) & \
-                  (neighbor_x == 0) & (neighbor_y == 1)
-            adj_list_BJC = pd.DataFrame(adj_list.focal.values,
-                                        BJC.astype('uint8')).reset_index()
-            adj_list_BJC.columns = ['BJC', 'ID']
-            adj_list_BJC = adj_list_BJC.groupby(by='ID').sum()
-            return (np.array(adj_list_BJC.BJC.values, dtype='float'))
+            # Joins between focal units with x=1, y=0
+            # and neighbors with x=0, y=1
+            focal = ((x == 1) & (y == 0)).astype('float')
+            neighbor = ((x == 0) & (y == 1)).astype('float')
+            return (_kernels.local_join_count(w, focal, neighbor,
+                                              n_jobs=n_jobs))
         elif case == "CLC":
-            CLC = (focal_x == 1) & (focal_y == 1) & \
-                  (neighbor_x == 1) & (neighbor_y == 1)
-            adj_list_CLC = pd.DataFrame(adj_list.focal.values,
-                                        CLC.astype('uint8')).reset_index()
-            adj_list_CLC.columns = ['CLC', 'ID']
-            adj_list_CLC = adj_list_CLC.groupby(by='ID').sum()
-            return (np.array(adj_list_CLC.CLC.values, dtype='float'))
+            # Joins between focal units and neighbors
+            # that both have x=1, y=1
+            focal = ((x == 1) & (y == 1)).astype('float')
+            return (_kernels.local_join_count(w, focal, n_jobs=n_jobs))
         else:
             raise NotImplementedError(f'The requested LJC method ({case}) \
             is not currently supported!')
@@ -218,12 +334,12 @@ def _ljc_bv_case1(i, z, permuted_ids, weights_i, scaling):
     zx = z[:, 0]
     zy = z[:, 1]
     zyi, zyrand = _prepare_univariate(i, zy, permuted_ids, weights_i)
-    return zx[i] * (zyrand @ weights_i)
+    return zx[i] * _neighbor_sum(zyrand, weights_i)
 
 @_njit(fastmath=True)
 def _ljc_bv_case2(i, z, permuted_ids, weights_i, scaling):
     zx = z[:, 0]
     zy = z[:, 1]
-    zxi, zxrand, zyi, zyrand = _prepare_bivariate(i, z, permuted_ids, weights_i)
-    zf = zxrand * zyrand
-    return zy[i] * (zf @ weights_i)
\ No newline at end of file
+    zi, zrand = _prepare_multivariate(i, z, permuted_ids, weights_i)
+    zf = zrand[:, :, 0] * zrand[:, :, 1]
+    return zy[i] * _neighbor_sum(zf, weights_i)
\ No newline at end of file
@@ -3,9 +3,17 @@ import pandas as pd
 from scipy import sparse
 from sklearn.base import BaseEstimator
 from libpysal import weights
-from esda.crand import (
-    crand as _crand_plus,
-    njit as _njit,
+from esda.crand import njit as _njit
+from . import kernels as _kernels
+from .prepared_weights import PreparedWeights
+from .profiling import FitProfiler, permutations_run
+from .local_null import as_local_pool as _as_local_pool
+from .multiple_testing import correct as _correct
+from .labels import local_labels as _local_labels
+from .crand import (
+    crand_nonzero as _crand_nonzero,
+    hypergeom_pvalues as _hypergeom_pvalues,
+    _neighbor_sum,
     _prepare_univariate
 )
 
@@ -15,21 +23,30 @@ class Local_Join_Count_MV(BaseEstimator):
     """Multivariate Local Join Count Statistic"""
 
     def __init__(self, connectivity=None, permutations=999, n_jobs=1, 
-                 keep_simulations=True, seed=None):
+                 keep_simulations=True, seed=None, inference='permutation',
+                 early_stopping=None, labels=False, sig=0.05,
+                 correction=None, local_pool=None, chunk_size=None):
         """
         Initialize a Local_Join_Count_MV estimator
         Arguments
         ---------
-        connectivity     : scipy.sparse matrix object
+        connectivity     : libpysal.weights.W or PreparedWeights
                            the connectivity structure describing
                            the relationships between observed units.
-                           Need not be row-standardized.
+                           Need not be row-standardized, and is not
+                           modified.
         permutations     : int
                            number of random permutations for calculation of pseudo
                            p_values
         n_jobs           : int
-                           Number of cores to be used in the conditional randomisation. If -1,
-                           all available cores are used.    
+                           Number of cores to be used in the conditional randomisation
+                           and the observed statistic. If -1, all available cores are used.
+        chunk_size       : None/int
+                           (default=None)
+                           Number of consecutive units randomised by each
+                           task of the conditional randomisation. If None,
+                           the units are split into n_jobs chunks. The
+                           p-values do not depend on n_jobs nor chunk_size.
         keep_simulations : Boolean
                            (default=True)
                            If True, the entire matrix of replications under the null 
@@ -40,7 +57,54 @@ class Local_Join_Count_MV(BaseEstimator):
                            Must be set here, and not outside of the function, since numba 
                            does not correctly interpret external seeds 
                            nor numpy.random.RandomState instances.              
-                           
+        inference        : str
+                           (default='permutation')
+                           'permutation' for pseudo p-values from conditional
+                           randomisation, or 'analytic' for their exact
+                           (hypergeometric) counterpart, without permutations.
+        early_stopping   : None/float
+                           (default=None)
+                           If a significance level, permutations are run
+                           in batches and stop for each observation once
+                           its pseudo p-value is known to exceed it, so
+                           that significance at that level is unchanged.
+                           The number of permutations run for each
+                           observation is stored in n_permutations, and
+                           the observations that stopped early are
+                           marked in stopped. Their p_sim is the
+                           Besag-Clifford estimate from the permutations
+                           run, which exceeds the level as the p-value
+                           of all permutations does, but is not that
+                           p-value and may be below it. p_sim is thus
+                           only decision-equivalent at this level, and
+                           should not be compared at another one.
+        labels           : boolean
+                           (default=False)
+                           If True, label if an observation belongs to a
+                           cluster (significant joins) or non-significant
+                           group, in labs. 2 = cluster,
+                           4 = non-significant, 0 = undefined, for those
+                           without joins (see labels.local_labels).
+        sig              : float
+                           (default=0.05)
+                           Default significance threshold used for
+                           creation of labels groups.
+        correction       : None/str
+                           (default=None)
+                           Multiple testing correction of the p-values:
+                           'bonferroni', 'fdr_bh' or 'fdr_by'. If given,
+                           the adjusted p-values are stored in p_adjusted
+                           (see multiple_testing.adjust), and the labels
+                           are those of p_adjusted at sig.
+        local_pool       : None/int/LocalPool
+                           (default=None)
+                           If given, permutation inference is under a
+                           spatially-constrained null, drawing the random
+                           neighbors of each unit from its candidates
+                           rather than the whole map: its neighbors up to
+                           this order in connectivity if an int (see
+                           local_null.LocalPool). Used by fit and update,
+                           without early_stopping.
         """
 
         self.connectivity = connectivity
@@ -48,13 +112,38 @@ class Local_Join_Count_MV(BaseEstimator):
         self.n_jobs = n_jobs
         self.keep_simulations = keep_simulations
         self.seed = seed
+        self.early_stopping = early_stopping
+        self.inference = inference
+        self.labels = labels
+        self.sig = sig
+        self.correction = correction
+        self.local_pool = local_pool
+        self.chunk_size = chunk_size
 
-    def fit(self, variables):
+    def fit(self, variables, packed=False, pool=None, profile=False):
         """
         Arguments
         ---------
         variables     : numpy.ndarray
-                        array(s) containing binary (0/1) data
+                        array(s) containing binary (0/1) data, of any
+                        dtype (uint8 and bool avoid a float copy), or
+                        their bits if packed is True
+        packed        : bool
+                        (default=False)
+                        If True, variables is the (n, ceil(k/8)) uint8
+                        array of the k variables packed into bits by
+                        kernels.pack_binary.
+        pool          : None/PermutationPool
+                        (default=None)
+                        permuted neighbor ids to randomise against,
+                        drawn beforehand in place of the seed (see
+                        permutation_pool.PermutationPool).
+        profile       : bool
+                        (default=False)
+                        If True, the wall time, memory and numba
+                        compilation time of each phase of the fit,
+                        and the permutations performed, are recorded
+                        in fit_stats_ (see profiling.FitProfiler).
 
         Returns
         -------
@@ -93,83 +182,101 @@ class Local_Join_Count_MV(BaseEstimator):
         >>> LJC_MV.p_sim
         """
 
-        w = self.connectivity
-        # Fill the diagonal with 0s
-        w = weights.util.fill_diagonal(w, val=0)
-        w.transform = 'b'
-
-        self.n = len(variables[0])
-        self.w = w
-        
-        permutations = self.permutations
-
-        self.variables = np.array(variables, dtype='float')
-        
-        keep_simulations = self.keep_simulations
-        n_jobs = self.n_jobs
-        seed = self.seed
-
-        # Need to ensure that the product is an 
-        # np.array() of dtype='float' for numba
-        self.ext = np.array(np.prod(np.vstack(variables), axis=0), 
-                            dtype='float')
-
-        self.LJC = self._statistic(variables, w)
-
-        if permutations:
-            self.p_sim, self.rjoins = _crand_plus(
-                z=self.ext, 
-                w=self.w, 
-                observed=self.LJC,
-                permutations=permutations, 
-                keep=True, 
-                n_jobs=n_jobs,
-                stat_func=_ljc_mv
-            )
-            # Set p-values for those with LJC of 0 to NaN
-            self.p_sim[self.LJC == 0] = 'NaN'
-        
-        del (self.n, self.keep_simulations, self.n_jobs, 
+        with FitProfiler(profile) as profiler:
+            # Binary weights with a zero diagonal
+            prepared = PreparedWeights.from_w(self.connectivity)
+            local_pool = _as_local_pool(self.local_pool, prepared)
+            w = prepared.binary
+            profiler.lap('weights')
+
+            # The variables are only needed through their co-location,
+            # which is found on their bits rather than on a float stack
+            if not packed:
+                variables = _kernels.pack_binary(variables)
+            # uint8 indicator of units where all variables == 1,
+            # which the conditional randomisation works on directly
+            self.ext = _kernels.colocation(variables)
+
+            self.n = len(self.ext)
+            self.w = w
+
+            permutations = self.permutations
+
+            keep_simulations = self.keep_simulations
+            n_jobs = self.n_jobs
+            seed = self.seed
+
+            self.LJC = self._statistic(variables, w, packed=True,
+                                       n_jobs=n_jobs, focal_all=self.ext)
+            profiler.lap('statistic')
+
+            if self.inference == 'analytic':
+                self.p_analytic = _hypergeom_pvalues(
+                    self.LJC, prepared.cardinalities,
+                    self.ext.sum() - self.ext, self.n
+                )
+                # Set p-values for those with LJC of 0 to NaN
+                self.p_analytic[self.LJC == 0] = 'NaN'
+            elif self.inference != 'permutation':
+                raise NotImplementedError(f'The requested inference method \
+                ({self.inference}) is not currently supported!')
+            elif permutations:
+                result = _crand_nonzero(
+                    z=self.ext, 
+                    w=self.w, 
+                    observed=self.LJC,
+                    permutations=permutations, 
+                    keep=keep_simulations, 
+                    n_jobs=n_jobs,
+                    chunk_size=self.chunk_size,
+                    stat_func=_ljc_mv,
+                    seed=seed,
+                    pool=pool,
+                    local_pool=local_pool,
+                    early_stopping=self.early_stopping
+                )
+                self.p_sim, rjoins = result[:2]
+                if self.early_stopping is not None:
+                    self.n_permutations = result[2]
+                    self.stopped = self.n_permutations < permutations
+                if keep_simulations:
+                    self.rjoins = rjoins
+            if self.inference == 'analytic' or permutations:
+                # Labels are those of the adjusted p-values, if any
+                p = _correct(self, self.inference)
+            profiler.lap('inference')
+
+            if self.labels and (self.inference == 'analytic' or permutations):
+                self.labs = _local_labels(p, self.sig)
+                profiler.lap('labels')
+
+            if profile:
+                self.fit_stats_ = profiler.stats(permutations=permutations_run(
+                    getattr(self, 'p_sim', None), permutations,
+                    getattr(self, 'n_permutations', None)
+                ))
+
+        del (self.n, self.keep_simulations, self.n_jobs, self.chunk_size,
              self.permutations, self.seed, self.w, self.ext,
-             self.variables, self.connectivity, self.rjoins)
+             self.connectivity, self.early_stopping, self.inference,
+             self.labels)
 
         return self
 
     @staticmethod
-    def _statistic(variables, w):
-        # Create adjacency list. Note that remove_symmetric=False -
-        # different from the esda.Join_Counts() function.
-        adj_list = w.to_adjlist(remove_symmetric=False)
-
-        # The zseries
-        zseries = [pd.Series(i, index=w.id_order) for i in variables]
-        # The focal values
-        focal = [zseries[i].loc[adj_list.focal].values for
-                 i in range(len(variables))]
-        # The neighbor values
-        neighbor = [zseries[i].loc[adj_list.neighbor].values for
-                    i in range(len(variables))]
-
-        # Find instances where all surrounding
+    def _statistic(variables, w, packed=False, n_jobs=1, focal_all=None):
+        # Find units where all variables == 1, counting
+        # the bits set in their packed variables, unless
+        # the caller already did
+        if focal_all is None:
+            if not packed:
+                variables = _kernels.pack_binary(variables)
+            focal_all = _kernels.colocation(variables)
+        # Count joins between units where all
         # focal and neighbor values == 1
-        focal_all = np.array(np.all(np.dstack(focal) == 1,
-                                    axis=2))
-        neighbor_all = np.array(np.all(np.dstack(neighbor) == 1,
-                                       axis=2))
-        MCLC = (focal_all == True) & (neighbor_all == True)
-        # Convert list of True/False to boolean array 
-        # and unlist (necessary for building pd.DF)
-        MCLC = list(MCLC*1)
-
-        # Create a df that uses the adjacency list
-        # focal values and the BBs counts
-        adj_list_MCLC = pd.DataFrame(adj_list.focal.values,
-                                     MCLC).reset_index()
-        # Temporarily rename the columns
-        adj_list_MCLC.columns = ['MCLC', 'ID']
-        adj_list_MCLC = adj_list_MCLC.groupby(by='ID').sum()
-
-        return (np.array(adj_list_MCLC.MCLC.values, dtype='float'))
+        MCLC = _kernels.local_join_count(w, focal_all, n_jobs=n_jobs)
+
+        return (MCLC)
 
 # --------------------------------------------------------------
 # Conditional Randomization Function Implementations
@@ -180,4 +287,4 @@ class Local_Join_Count_MV(BaseEstimator):
 @_njit(fastmath=True)
 def _ljc_mv(i, z, permuted_ids, weights_i, scaling):
     zi, zrand = _prepare_univariate(i, z, permuted_ids, weights_i)
-    return zi * (zrand @ weights_i)
\ No newline at end of file
+    return zi * _neighbor_sum(zrand, weights_i)
\ No newline at end of file
@@ -0,0 +1,120 @@
+"""
+Spatially-constrained null for the conditional randomisation.
+
+The conditional randomisation replaces the neighbors of each observation
+by observations drawn from the whole map, so that every draw reads a
+random place of z. Under a spatially-constrained null, they are drawn
+instead from a local pool of candidates of each observation, e.g. its
+neighbors up to the second order, or its k nearest neighbors. This
+tests for local association against nearby rather than map-wide values,
+and, with the observations randomised in an order where candidates are
+close to each other, reads z from memory mostly in cache.
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+from .prepared_weights import PreparedWeights
+from .kernels import _reorder
+
+
+class LocalPool(object):
+
+    """Candidate neighbors of each observation under a local null"""
+
+    def __init__(self, w, order=2, reorder=True):
+        """
+        Gather the candidates of each observation, its neighbors up to
+        the given order, excluding itself
+
+        Arguments
+        ---------
+        w                : libpysal.weights.W, scipy.sparse matrix or
+                           PreparedWeights
+                           weights whose neighbors form the candidates.
+                           With order=1, e.g. KNN or distance band
+                           weights built for the purpose, whatever the
+                           weights of the statistic.
+        order            : int
+                           (default=2)
+                           the candidates are the neighbors, the
+                           neighbors of neighbors and so on up to this
+                           order. They must include the neighbors in the
+                           weights of the statistic, as they do when
+                           these are the same weights.
+        reorder          : bool
+                           (default=True)
+                           If True, observations are randomised in
+                           reverse Cuthill-McKee order of the candidates,
+                           which keeps them close together in memory.
+                           The results do not depend on the order.
+
+        Attributes
+        ----------
+        n                : int
+                           number of observations
+        order            : numpy.ndarray
+                           (n,) positions of the observations in the
+                           order they are randomised in
+        inverse          : numpy.ndarray
+                           (n,) inverse permutation of order
+        indptr, indices  : numpy.ndarray
+                           CSR arrays of the candidates, in the order
+                           they are randomised in, rows and columns alike
+        cardinalities    : numpy.ndarray
+                           (n,) number of candidates of each observation,
+                           in the original order
+        """
+        neighbors = PreparedWeights.from_w(w).binary
+        if not sparse.issparse(neighbors):
+            raise NotImplementedError('A local pool needs in-memory '
+                                      'weights')
+        neighbors = sparse.csr_matrix(neighbors, dtype=np.int32)
+        candidates = neighbors
+        reach = neighbors
+        for _ in range(int(order) - 1):
+            reach = reach @ neighbors
+            reach.data[:] = 1
+            candidates = candidates + reach
+        # observations are not candidates of their own
+        candidates = (sparse.triu(candidates, 1)
+                      + sparse.tril(candidates, -1)).tocsr()
+        candidates.data[:] = 1
+        # candidates are drawn in the order of their original positions,
+        # so that the draws do not depend on the order of randomisation
+        candidates.sort_indices()
+
+        self.n = candidates.shape[0]
+        if reorder:
+            self.order = reverse_cuthill_mckee(
+                candidates, symmetric_mode=False
+            ).astype(np.int64)
+        else:
+            self.order = np.arange(self.n, dtype=np.int64)
+        self.inverse = np.empty_like(self.order)
+        self.inverse[self.order] = np.arange(self.n)
+        self.cardinalities = np.diff(candidates.indptr)
+        candidates = _reorder(candidates, self.order, self.inverse)
+        self.indptr = candidates.indptr.astype(np.int64)
+        self.indices = candidates.indices.astype(np.int64)
+
+
+def as_local_pool(local_pool, w):
+    """
+    LocalPool of the local_pool parameter of an estimator: None, a
+    LocalPool, or the order of the neighbors of w forming the candidates
+
+    Arguments
+    ---------
+    local_pool       : None/int/LocalPool
+    w                : PreparedWeights
+                       weights of the estimator
+
+    Returns
+    -------
+    None/LocalPool
+    """
+    if local_pool is None or isinstance(local_pool, LocalPool):
+        return local_pool
+    return LocalPool(w, order=local_pool)
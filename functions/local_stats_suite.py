@@ -0,0 +1,318 @@
+import numpy as np
+from functools import lru_cache
+from sklearn.base import BaseEstimator
+from esda.crand import njit as _njit
+from . import kernels as _kernels
+from .prepared_weights import PreparedWeights
+from .profiling import FitProfiler, permutations_run
+from .losh import LOSH
+from .crand import crand as _crand_plus
+
+STATISTICS = ('Local_Geary', 'LOSH', 'Local_Join_Count')
+# Attribute holding the observed values of each statistic
+_OBSERVED = {'Local_Geary': 'localG', 'LOSH': 'Hi',
+             'Local_Join_Count': 'LJC'}
+
+
+class LocalStatsSuite(BaseEstimator):
+
+    """Local Geary, LOSH and Local Join Count of one variable, together"""
+
+    def __init__(self, connectivity=None, statistics=STATISTICS,
+                 threshold=None, a=2, permutations=999, n_jobs=1,
+                 keep_simulations=True, seed=None):
+        """
+        Initialize a LocalStatsSuite estimator
+
+        Arguments
+        ---------
+        connectivity     : libpysal.weights.W or PreparedWeights
+                           the connectivity structure describing
+                           the relationships between observed units.
+                           Need not be row-standardized, and is not
+                           modified.
+        statistics       : tuple
+                           (default=('Local_Geary', 'LOSH',
+                           'Local_Join_Count'))
+                           local statistics to compute, named after
+                           their estimators. p_sim and rlocals have
+                           one column per statistic, in this order.
+        threshold        : None/float
+                           (default=None)
+                           The join counts are those of x > threshold,
+                           or of x == 1 if None (binary x).
+        a                : None/int
+                           (default=2)
+                           residual multiplier of LOSH. None is 2, as
+                           in LOSH.
+        permutations     : int
+                           (default=999)
+                           number of random permutations for calculation
+                           of pseudo p_values
+        n_jobs           : int
+                           (default=1)
+                           Number of cores to be used in the conditional
+                           randomisation and the observed statistic. If -1,
+                           all available cores are used.
+        keep_simulations : Boolean
+                           (default=True)
+                           If True, the entire matrix of replications under
+                           the null is stored in memory and accessible;
+                           otherwise, replications are not saved
+        seed             : None/int
+                           Seed to ensure reproducibility of conditional
+                           randomizations. Must be set here, and not outside
+                           of the function, since numba does not correctly
+                           interpret external seeds nor
+                           numpy.random.RandomState instances.
+
+        Attributes
+        ----------
+        localG          : numpy array
+                          Local Geary values, as in Local_Geary.
+        Hi              : numpy array
+                          LOSH values, along with ylag, yresid and
+                          VarHi, as in LOSH.
+        LJC             : numpy array
+                          Local Join Count values, as in
+                          Local_Join_Count.
+        p_sim           : numpy array
+                          (n, len(statistics)) array containing the
+                          simulated p-values for each unit. p-values of
+                          units without joins are NaN.
+        rlocals         : numpy array
+                          (n, permutations, len(statistics)) array of
+                          the simulated statistics, if
+                          keep_simulations=True.
+        """
+
+        self.connectivity = connectivity
+        self.statistics = statistics
+        self.threshold = threshold
+        self.a = a
+        self.permutations = permutations
+        self.n_jobs = n_jobs
+        self.keep_simulations = keep_simulations
+        self.seed = seed
+
+    def fit(self, x, pool=None, profile=False):
+        """
+        Compute the requested statistics of x in a shared pass over the
+        weights. The observed values are the same as those of the
+        individual estimators. With permutations, all the statistics
+        are randomised against the same permuted neighbors, in a single
+        pass, and for a given seed the pseudo p-values match those of
+        the individual estimators.
+
+        Arguments
+        ---------
+        x                : numpy.ndarray
+                           array containing continuous data
+        pool             : None/PermutationPool
+                           (default=None)
+                           permuted neighbor ids to randomise against,
+                           drawn beforehand in place of the seed (see
+                           permutation_pool.PermutationPool).
+        profile          : bool
+                           (default=False)
+                           If True, the wall time, memory and numba
+                           compilation time of each phase of the fit,
+                           and the permutations performed, are recorded
+                           in fit_stats_ (see profiling.FitProfiler).
+
+        Returns
+        -------
+        the fitted estimator.
+
+        Examples
+        --------
+        >>> import libpysal
+        >>> w = libpysal.io.open(libpysal.examples.get_path("stl.gal")).read()
+        >>> f = libpysal.io.open(libpysal.examples.get_path("stl_hom.txt"))
+        >>> y = np.array(f.by_col['HR8893'])
+        >>> suite = LocalStatsSuite(connectivity=w, threshold=y.mean()).fit(y)
+        >>> suite.p_sim.shape
+        (78, 3)
+        """
+        with FitProfiler(profile) as profiler:
+            x = np.asarray(x, dtype='float').flatten()
+            statistics = tuple(self.statistics)
+            unknown = set(statistics) - set(STATISTICS)
+            if unknown:
+                raise NotImplementedError(f'The requested statistics \
+                ({unknown}) are not currently supported!')
+
+            prepared = PreparedWeights.from_w(self.connectivity)
+            profiler.lap('weights')
+
+            a = self.a
+            permutations = self.permutations
+            keep_simulations = self.keep_simulations
+            n_jobs = self.n_jobs
+            seed = self.seed
+
+            if self.threshold is None:
+                binary = (x == 1).astype('float')
+            else:
+                binary = (x > self.threshold).astype('float')
+            z = (x - np.mean(x))/np.std(x)
+
+            self._statistic(x, z, binary, prepared, a, statistics, n_jobs)
+            profiler.lap('statistic')
+
+            if permutations:
+                # One column block per statistic, as read by the
+                # randomisation function built for these statistics
+                columns = []
+                if 'Local_Geary' in statistics:
+                    columns += [z, prepared.rowsum]
+                if 'LOSH' in statistics:
+                    columns += [self.yresid,
+                                prepared.sparse.diagonal() * self.yresid,
+                                np.mean(self.yresid) * prepared.rowsum]
+                if 'Local_Join_Count' in statistics:
+                    columns += [binary]
+                observed = np.column_stack([
+                    getattr(self, _OBSERVED[s]) for s in statistics
+                ])
+                self.p_sim, rlocals = _crand_plus(
+                    z=np.column_stack(columns),
+                    w=prepared.sparse,
+                    observed=observed,
+                    permutations=permutations,
+                    keep=keep_simulations,
+                    n_jobs=n_jobs,
+                    stat_func=_local_stats_func(statistics),
+                    seed=seed,
+                    pool=pool
+                )
+                if 'Local_Join_Count' in statistics:
+                    # Set p-values for those with LJC of 0 to NaN
+                    j = statistics.index('Local_Join_Count')
+                    self.p_sim[self.LJC == 0, j] = np.nan
+                    if keep_simulations:
+                        rlocals[self.LJC == 0, :, j] = np.nan
+                if keep_simulations:
+                    self.rlocals = rlocals
+            profiler.lap('inference')
+
+            if profile:
+                # every statistic of a row shares its permutations
+                p_sim = getattr(self, 'p_sim', None)
+                self.fit_stats_ = profiler.stats(permutations=permutations_run(
+                    None if p_sim is None else p_sim[:, 0], permutations
+                ))
+
+        del (self.keep_simulations, self.n_jobs,
+             self.permutations, self.seed, self.connectivity,
+             self.threshold, self.a)
+
+        return self
+
+    def _statistic(self, x, z, binary, prepared, a, statistics, n_jobs=1):
+        # Every statistic needs spatial lags of x or of its
+        # transformations, which are found together in a single
+        # sparse product over the weights as given
+        W = prepared.sparse
+        rowsum = prepared.rowsum
+        # The join counts share it only if the weights are
+        # already binary with a zero diagonal
+        shared_binary = (
+            not prepared.streaming
+            and not W.diagonal().any()
+            and (W.data == 1).all()
+        )
+        columns = [x]
+        if 'Local_Geary' in statistics:
+            columns += [z, z**2]
+        if 'Local_Join_Count' in statistics and shared_binary:
+            columns += [binary]
+        lags = _kernels.spatial_lag(W, np.column_stack(columns), n_jobs)
+
+        if 'Local_Geary' in statistics:
+            # Expanded identity on the row-standardized weights,
+            # sum_j w_ij/r_i (z_i - z_j)^2, with islands left at 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                localG = (z**2 * rowsum - 2 * z * lags[:, 1]
+                          + lags[:, 2]) / rowsum
+            localG[rowsum == 0] = 0
+            self.localG = localG
+
+        if 'LOSH' in statistics:
+            # As in LOSH._statistic, starting from the shared lag of x
+            if a is None:
+                a = 2
+            ylag = lags[:, 0]/rowsum
+            yresid = abs(x - ylag)**a
+            denom = np.mean(yresid) * rowsum
+            self.Hi = _kernels.spatial_lag(W, yresid, n_jobs) / denom
+            self.ylag, self.yresid = ylag, yresid
+            self.VarHi = LOSH._variance(yresid, denom, rowsum,
+                                        prepared.squared_rowsum)
+
+        if 'Local_Join_Count' in statistics:
+            if shared_binary:
+                self.LJC = binary * lags[:, -1]
+            else:
+                self.LJC = _kernels.local_join_count(prepared.binary,
+                                                     binary, n_jobs=n_jobs)
+
+# --------------------------------------------------------------
+# Conditional Randomization Function Implementations
+# --------------------------------------------------------------
+
+# Note: scaling not used. The weights are those given, without their
+# diagonal, from which each statistic derives its own: divided by the
+# row sum for the Local Geary, as they are for LOSH, and ones for the
+# join counts.
+
+
+@lru_cache(maxsize=None)
+def _local_stats_func(statistics):
+    """
+    Build the randomisation function of the given statistics, which
+    goes over the permuted neighbors once for all of them and returns
+    a (permutations, len(statistics)) array. The columns of z are, for
+    each statistic in turn: z-scores and row sums (Local Geary),
+    residuals, self-weighted residuals and denominators of Hi (LOSH),
+    and binary values (Local Join Count).
+    """
+    geary = 'Local_Geary' in statistics
+    losh = 'LOSH' in statistics
+    join_count = 'Local_Join_Count' in statistics
+    # Output column and first z column of each statistic
+    geary_out = statistics.index('Local_Geary') if geary else -1
+    losh_out = statistics.index('LOSH') if losh else -1
+    join_count_out = (statistics.index('Local_Join_Count')
+                      if join_count else -1)
+    losh_col = 2 * geary
+    join_count_col = losh_col + 3 * losh
+    m = len(statistics)
+
+    @_njit(fastmath=True)
+    def _local_stats(i, z, permuted_ids, weights_i, scaling):
+        cardinality = weights_i.shape[0]
+        out = np.zeros((permuted_ids.shape[0], m))
+        if geary:
+            geary_weights = weights_i / z[i, 1]
+        # A single pass over the permuted neighbors, reading
+        # only the columns that vary with the neighbor
+        for r in range(permuted_ids.shape[0]):
+            for c in range(cardinality):
+                j = permuted_ids[r, c]
+                j = j + (j >= i)
+                if geary:
+                    out[r, geary_out] += ((z[i, 0] - z[j, 0])**2
+                                          * geary_weights[c])
+                if losh:
+                    out[r, losh_out] += z[j, losh_col] * weights_i[c]
+                if join_count:
+                    out[r, join_count_out] += z[j, join_count_col]
+        if losh:
+            out[:, losh_out] = ((z[i, losh_col + 1] + out[:, losh_out])
+                                / z[i, losh_col + 2])
+        if join_count:
+            out[:, join_count_out] *= z[i, join_count_col]
+        return out
+
+    return _local_stats
@@ -1,21 +1,34 @@
 import numpy as np
 import warnings
 from scipy import sparse
-from scipy import stats
+from scipy import special
 from sklearn.base import BaseEstimator
 import libpysal as lp
+from esda.crand import njit as _njit
+from .crand import (
+    crand as _crand_plus,
+    _prepare_univariate
+)
+from . import kernels as _kernels
+from .prepared_weights import PreparedWeights
+from .profiling import FitProfiler, permutations_run
+from .multiple_testing import adjust_columns as _adjust_columns
+from .labels import local_labels as _local_labels
 
 
 class LOSH(BaseEstimator):
     """Local spatial heteroscedasticity (LOSH)"""
 
-    def __init__(self, connectivity=None, inference=None, a=2):
+    def __init__(self, connectivity=None, inference=None, a=2,
+                 permutations=999, n_jobs=1, keep_simulations=True,
+                 seed=None, dtype='float64', labels=False, sig=0.05,
+                 correction=None):
         """
         Initialize a losh estimator
 
         Arguments
         ---------
-        connectivity     : scipy.sparse matrix object
+        connectivity     : libpysal.weights.W or PreparedWeights
                            the connectivity structure describing the
                            relationships between observed units.
         inference        : str
@@ -25,6 +38,51 @@ class LOSH(BaseEstimator):
                            residual multiplier. Default is 2 in order
                            to generate a variance measure. Users may
                            use 1 for absolute deviations.
+        permutations     : int
+                           (default=999)
+                           number of random permutations for calculation
+                           of pseudo p_values when inference="permutation"
+        n_jobs           : int
+                           (default=1)
+                           Number of cores to be used in the conditional
+                           randomisation and the observed statistic. If -1,
+                           all available cores are used.
+        keep_simulations : Boolean
+                           (default=True)
+                           If True, the entire matrix of replications under
+                           the null is stored in memory and accessible;
+                           otherwise, replications are not saved
+        seed             : None/int
+                           Seed to ensure reproducibility of conditional
+                           randomizations. Must be set here, and not outside
+                           of the function, since numba does not correctly
+                           interpret external seeds nor
+                           numpy.random.RandomState instances.
+        dtype            : str
+                           (default='float64')
+                           floating point precision of the statistic, of
+                           the chi-square p-values and of the simulations.
+                           'float32' halves memory traffic at the cost of
+                           precision.
+        labels           : boolean
+                           (default=False)
+                           If True, label if an observation belongs to a
+                           locally homogeneous (Hi below its mean),
+                           heterogeneous (Hi above its mean) or
+                           non-significant group. 2 = homogeneous,
+                           3 = heterogeneous, 4 = non-significant,
+                           0 = undefined (see labels.local_labels).
+        sig              : float
+                           (default=0.05)
+                           Default significance threshold used for
+                           creation of labels groups.
+        correction       : None/str
+                           (default=None)
+                           Multiple testing correction of the p-values:
+                           'bonferroni', 'fdr_bh' or 'fdr_by'. If given,
+                           the adjusted p-values are stored in p_adjusted
+                           (see multiple_testing.adjust), and the labels
+                           are those of p_adjusted at sig.
 
         Attributes
         ----------
@@ -39,18 +97,51 @@ class LOSH(BaseEstimator):
         pval             : numpy array
                            P-values for inference based on either
                            "chi-square" or "permutation" methods.
+        log_pval         : numpy array
+                           Natural logarithm of the chi-square p-values,
+                           accurate where pval underflows to 0.
+        p_adjusted       : numpy array
+                           pval adjusted for multiple testing,
+                           if correction is given.
+        labs             : numpy array
+                           uint8 array containing the labels for if each
+                           observation, if labels=True and there are
+                           p-values.
+        rHi              : numpy array
+                           (n, permutations) array of the simulated
+                           Hi values, if inference="permutation" and
+                           keep_simulations=True.
         """
 
         self.connectivity = connectivity
         self.inference = inference
         self.a = a
+        self.permutations = permutations
+        self.n_jobs = n_jobs
+        self.keep_simulations = keep_simulations
+        self.seed = seed
+        self.dtype = dtype
+        self.labels = labels
+        self.sig = sig
+        self.correction = correction
 
-    def fit(self, x):
+    def fit(self, x, pool=None, profile=False):
         """
         Arguments
         ---------
         x                : numpy.ndarray
                            array containing continuous data
+        pool             : None/PermutationPool
+                           (default=None)
+                           permuted neighbor ids to randomise against,
+                           drawn beforehand in place of the seed (see
+                           permutation_pool.PermutationPool).
+        profile          : bool
+                           (default=False)
+                           If True, the wall time, memory and numba
+                           compilation time of each phase of the fit,
+                           and the permutations performed, are recorded
+                           in fit_stats_ (see profiling.FitProfiler).
 
         Returns
         -------
@@ -80,57 +171,351 @@ class LOSH(BaseEstimator):
         >>> np.round(ls.Hi[0], 3)
         >>> np.round(ls.VarHi[0], 3)
         """
-        x = np.asarray(x).flatten()
+        with FitProfiler(profile) as profiler:
+            x = np.asarray(x, dtype=self.dtype).flatten()
 
-        w = self.connectivity
+            w = PreparedWeights.from_w(self.connectivity)
+            profiler.lap('weights')
 
-        a = self.a
+            a = self.a
 
-        self.Hi, self.ylag, self.yresid, self.VarHi = self._statistic(x, w, a)
+            self.Hi, self.ylag, self.yresid, self.VarHi = self._statistic(
+                x, w, a, self.dtype, self.n_jobs
+            )
+            # State needed by update
+            self._x = x
+            self._pool = pool
+            profiler.lap('statistic')
+
+            if self.inference is None:
+                pass
+            elif self.inference == 'chi-square':
+                if a != 2:
+                    warnings.warn(f'Chi-square inference assumes that \
+                    a=2, but a={a}. This means the inference will be \
+                    invalid!')
+                else:
+                    self.pval, self.log_pval = self._chi_square(self.Hi,
+                                                                self.VarHi)
+            elif self.inference == 'permutation':
+                # Conditional randomization of the neighboring residuals,
+                # holding the residual (and any self-weight) of i fixed
+                z = np.column_stack((
+                    self.yresid,
+                    w.sparse.diagonal() * self.yresid,
+                    np.mean(self.yresid) * w.rowsum
+                )).astype(self.dtype, copy=False)
+                self.pval, rHi = _crand_plus(
+                    z=z,
+                    w=w.sparse_as(self.dtype),
+                    observed=self.Hi,
+                    permutations=self.permutations,
+                    keep=self.keep_simulations,
+                    n_jobs=self.n_jobs,
+                    stat_func=_losh,
+                    seed=self.seed,
+                    pool=pool
+                )
+                if self.keep_simulations:
+                    self.rHi = rHi
+            else:
+                raise NotImplementedError(f'The requested inference method \
+                ({self.inference}) is not currently supported!')
+            self._adjust()
+            profiler.lap('inference')
+
+            if self.labels:
+                self._label()
+                profiler.lap('labels')
+
+            if profile:
+                permutations = (self.permutations
+                                if self.inference == 'permutation' else 0)
+                self.fit_stats_ = profiler.stats(permutations=permutations_run(
+                    getattr(self, 'pval', None), permutations
+                ))
+
+        return self
+
+    def update(self, changed_ids, new_values):
+        """
+        Update an estimator fitted with fit after the values of a few
+        observations changed, without refitting from scratch.
+
+        The spatial lags and residuals are recomputed for the changed
+        observations and those that have them as neighbors, and Hi for
+        the neighbors of these in turn. Hi of the other observations is
+        rescaled to the new mean residual, and VarHi and chi-square
+        p-values, which only depend on the moments of the residuals,
+        are recomputed elementwise. Permutation p-values are recomputed
+        for the rows whose Hi changed and kept for the others.
+
+        Arguments
+        ---------
+        changed_ids      : list
+                           ids of the changed observations, as in the
+                           id_order of the weights (positions if the
+                           weights are a scipy.sparse matrix)
+        new_values       : numpy.ndarray
+                           new values of the changed observations
+
+        Returns
+        -------
+        the updated estimator.
+        """
+        if not hasattr(self, '_x'):
+            raise ValueError('update requires an estimator fitted with fit')
+        w = PreparedWeights.from_w(self.connectivity)
+        a = 2 if self.a is None else self.a
+        W = w.sparse_as(self.dtype)
+        rowsum = w.rowsum.astype(self.dtype, copy=False)
+        squared_rowsum = w.squared_rowsum.astype(self.dtype, copy=False)
+
+        changed = w.positions(changed_ids)
+        x = self._x.copy()
+        x[changed] = new_values
+        # Rows whose spatial lag changes, and rows whose
+        # numerator of Hi changes
+        lag_rows = w.neighbors_of(changed)
+        hi_rows = w.neighbors_of(lag_rows)
+
+        ylag = self.ylag.copy()
+        ylag[lag_rows] = (W[lag_rows] @ x)/rowsum[lag_rows]
+        yresid = self.yresid.copy()
+        yresid[lag_rows] = abs(x[lag_rows]-ylag[lag_rows])**a
+        yresid_mean = np.mean(yresid)
+        denom = yresid_mean * rowsum
+        scale = np.mean(self.yresid) / yresid_mean
+        Hi = self.Hi * scale
+        Hi[hi_rows] = (W[hi_rows] @ yresid) / denom[hi_rows]
+
+        self.ylag, self.yresid, self.Hi = ylag, yresid, Hi
+        self.VarHi = self._variance(yresid, denom, rowsum, squared_rowsum)
+        self._x = x
+
+        if self.inference == 'chi-square' and a == 2:
+            self.pval, self.log_pval = self._chi_square(self.Hi, self.VarHi)
+        elif self.inference == 'permutation':
+            z = np.column_stack((
+                yresid,
+                w.sparse.diagonal() * yresid,
+                yresid_mean * w.rowsum
+            )).astype(self.dtype, copy=False)
+            pval, rHi = _crand_plus(
+                z=z,
+                w=w.sparse_as(self.dtype),
+                observed=Hi[hi_rows],
+                permutations=self.permutations,
+                keep=self.keep_simulations,
+                n_jobs=self.n_jobs,
+                stat_func=_losh,
+                seed=self.seed,
+                pool=self._pool,
+                ids=hi_rows
+            )
+            self.pval = self.pval.copy()
+            self.pval[hi_rows] = pval
+            if self.keep_simulations:
+                self.rHi = self.rHi * scale
+                self.rHi[hi_rows] = rHi
+
+        self._adjust()
+
+        if self.labels:
+            self._label()
+
+        return self
+
+    def fit_many(self, X, a=None):
+        """
+        Fit LOSH to several variables, and optionally several residual
+        multipliers, sharing the same weights. The row sums and squared
+        row sums of the weights are computed once, and each spatial lag
+        is a single sparse product over all columns.
+
+        Arguments
+        ---------
+        X                : numpy.ndarray or pandas.DataFrame
+                           (n, m) array containing m columns of
+                           continuous data
+        a                : None/float/list
+                           residual multiplier(s). If None, the a of the
+                           estimator is used. If a list of q values,
+                           results have a trailing axis of length q.
+
+        Returns
+        -------
+        the fitted estimator, with Hi, yresid, VarHi, pval and
+        p_adjusted of shape (n, m), or (n, m, q) if a is a list, and ylag
+        of shape (n, m). pval is NaN wherever a != 2. Only "chi-square" inference is
+        supported.
+
+        Examples
+        --------
+        >>> import libpysal
+        >>> w = libpysal.io.open(libpysal.examples.get_path("stl.gal")).read()
+        >>> f = libpysal.io.open(libpysal.examples.get_path("stl_hom.txt"))
+        >>> X = np.column_stack([f.by_col['HR8893'], f.by_col['HR8488']])
+        >>> ls = LOSH(connectivity=w, inference="chi-square").fit_many(X, a=[1, 2])
+        >>> ls.Hi.shape
+        (78, 2, 2)
+        """
+        X = np.asarray(X, dtype=self.dtype)
+        if X.ndim == 1:
+            X = X.reshape(-1, 1)
+
+        w = PreparedWeights.from_w(self.connectivity)
+
+        if a is None:
+            a = self.a
+        if np.ndim(a):
+            a = np.asarray(a, dtype=self.dtype)
+
+        self.Hi, self.ylag, self.yresid, self.VarHi = self._statistic(
+            X, w, a, self.dtype, self.n_jobs
+        )
 
         if self.inference is None:
             return self
         elif self.inference == 'chi-square':
-            if a != 2:
+            valid = np.broadcast_to(np.equal(a, 2), self.Hi.shape[-1:])
+            if not valid.all():
                 warnings.warn(f'Chi-square inference assumes that a=2, but \
-                a={a}. This means the inference will be invalid!')
-            else:
-                dof = 2/self.VarHi
-                Zi = (2*self.Hi)/self.VarHi
-                self.pval = 1 - stats.chi2.cdf(Zi, dof)
+                a={a}. p-values are only given for a=2!')
+            self.pval, self.log_pval = self._chi_square(self.Hi, self.VarHi)
+            self.pval[..., ~valid] = np.nan
+            self.log_pval[..., ~valid] = np.nan
         else:
             raise NotImplementedError(f'The requested inference method \
-            ({self.inference}) is not currently supported!')
+            ({self.inference}) is not supported by fit_many!')
+
+        self._adjust()
+
+        if self.labels:
+            self._label()
 
         return self
 
+    def _adjust(self):
+        # p-values of any shape are adjusted by column, as
+        # separate families of tests
+        if (self.correction is not None
+                and getattr(self, 'pval', None) is not None):
+            self.p_adjusted = _adjust_columns(self.pval, self.correction)
+
+    def _label(self):
+        # Hi of any shape is labelled by column, where there
+        # are p-values (none with chi-square inference and a != 2),
+        # by the adjusted p-values if any
+        if getattr(self, 'pval', None) is not None:
+            p = self.pval if self.correction is None else self.p_adjusted
+            self.labs = _local_labels(p, self.sig, stat=self.Hi)
+
+    @staticmethod
+    def _chi_square(Hi, VarHi):
+        # Survival function of the chi-square approximation, rather
+        # than 1 - cdf, so that small p-values keep their precision
+        dof = 2/VarHi
+        Zi = (2*Hi)/VarHi
+        pval = special.chdtrc(dof, Zi)
+        with np.errstate(divide='ignore'):
+            log_pval = np.log(pval)
+        # Where the p-value underflows, evaluate its log directly
+        tail = np.isneginf(log_pval)
+        if tail.any():
+            log_pval[tail] = _log_gammaincc(dof[tail]/2, Zi[tail]/2)
+        return pval, log_pval
+
     @staticmethod
-    def _statistic(x, w, a):
+    def _statistic(x, w, a, dtype='float64', n_jobs=1):
         # Define what type of variance to use
         if a is None:
             a = 2
         else:
             a = a
 
-        rowsum = np.array(w.sparse.sum(axis=1)).flatten()
+        # Row sums and squared row sums are computed once
+        # per weights object and reused across fits
+        w = PreparedWeights.from_w(w)
+        W = w.sparse_as(dtype)
+        rowsum = w.rowsum.astype(dtype, copy=False)
+        squared_rowsum = w.squared_rowsum.astype(dtype, copy=False)
+        n = x.shape[0]
 
-        # Calculate spatial mean
-        ylag = lp.weights.lag_spatial(w, x)/rowsum
-        # Calculate and adjust residuals based on multiplier
-        yresid = abs(x-ylag)**a
+        # Calculate spatial mean, by column if x is (n, m)
+        ylag = _kernels.spatial_lag(W, x, n_jobs)/_by_row(rowsum, x)
+        # Calculate and adjust residuals based on multiplier(s),
+        # one trailing axis per value of a
+        if np.ndim(a):
+            yresid = abs(x-ylag)[..., None]**a
+        else:
+            yresid = abs(x-ylag)**a
         # Calculate denominator of Hi equation
-        denom = np.mean(yresid) * np.array(rowsum)
-        # Carry out final Hi calculation
-        Hi = lp.weights.lag_spatial(w, yresid) / denom
-        # Calculate average of residuals
-        yresid_mean = np.mean(yresid)
-        # Calculate VarHi
-        n = len(x)
-        squared_rowsum = np.asarray(w.sparse.multiply(w.sparse).sum(axis=1)).flatten()
+        yresid_mean = np.mean(yresid, axis=0)
+        denom = yresid_mean * _by_row(rowsum, yresid)
+        # Carry out final Hi calculation, with a
+        # single sparse product over all columns
+        Hi = (_kernels.spatial_lag(W, yresid.reshape(n, -1), n_jobs)
+              .reshape(yresid.shape) / denom)
+        VarHi = LOSH._variance(yresid, denom, rowsum, squared_rowsum)
+
+        return (Hi, ylag, yresid, VarHi)
+
+    @staticmethod
+    def _variance(yresid, denom, rowsum, squared_rowsum):
+        # Calculate VarHi, from the moments of the residuals
+        n = yresid.shape[0]
+        yresid_mean = np.mean(yresid, axis=0)
+        return ((n-1)**-1) * \
+               (denom**-2) * \
+               ((np.sum(yresid**2, axis=0)/n) - yresid_mean**2) * \
+               _by_row((n*squared_rowsum) - (rowsum**2), yresid)
+
+
+def _by_row(v, x):
+    """
+    Reshape the (n,) array v to broadcast along the rows of x
+    """
+    return v.reshape((-1,) + (1,) * (np.ndim(x) - 1))
+
+
+def _log_gammaincc(s, x, max_iter=300):
+    """
+    Log of the regularized upper incomplete gamma function Q(s, x),
+    i.e. of the chi-square survival function with 2s degrees of
+    freedom at 2x, for x > s + 1, evaluated with the continued
+    fraction of Q (Lentz's method) so that it does not underflow
+    """
+    tiny = np.finfo('float64').tiny
+    s = np.asarray(s, dtype='float64')
+    x = np.asarray(x, dtype='float64')
+    b = x + 1 - s
+    c = np.full(x.shape, 1/tiny)
+    d = 1/b
+    h = d.copy()
+    for i in range(1, max_iter + 1):
+        an = -i * (i - s)
+        b = b + 2
+        d = an * d + b
+        d[np.abs(d) < tiny] = tiny
+        c = b + an / c
+        c[np.abs(c) < tiny] = tiny
+        d = 1/d
+        delta = d * c
+        h *= delta
+        if np.all(np.abs(delta - 1) < 1e-15):
+            break
+    return -x + s * np.log(x) - special.gammaln(s) + np.log(h)
+
+# --------------------------------------------------------------
+# Conditional Randomization Function Implementations
+# --------------------------------------------------------------
 
-        VarHi = ((n-1)**-1) * \
-                (denom**-2) * \
-                ((np.sum(yresid**2)/n) - yresid_mean**2) * \
-                ((n*squared_rowsum) - (rowsum**2))
+# Note: does not use the scaling parameter. The columns of z are
+# the residuals, the self-weighted residual of each observation
+# and the denominator of Hi.
 
-        return (Hi, ylag, yresid, VarHi)
\ No newline at end of file
+@_njit(fastmath=True)
+def _losh(i, z, permuted_ids, weights_i, scaling):
+    zi, zrand = _prepare_univariate(i, z[:, 0], permuted_ids, weights_i)
+    return (z[i, 1] + zrand @ weights_i) / z[i, 2]
@@ -0,0 +1,211 @@
+"""
+Multiple testing corrections of the local p-values.
+
+The local statistics test every unit, so that at a significance level
+sig about sig * n units are significant by chance alone. The corrections
+here control the family-wise error rate (Bonferroni) or the false
+discovery rate (Benjamini-Hochberg, Benjamini-Yekutieli) over the units
+with a p-value; NaN p-values, e.g. those of units without joins, are not
+tests and are ignored.
+
+threshold gives the significance threshold of the p-values under a
+correction, and adjust the adjusted p-values themselves, which are
+significant at sig where they are <= sig. adjust can read and write the
+p-values by chunks, for arrays memory-mapped from disk. Estimators given
+a correction store the adjusted p-values in p_adjusted, and label the
+units by them.
+"""
+
+import numpy as np
+from scipy import special
+
+CORRECTIONS = (None, 'bonferroni', 'fdr_bh', 'fdr_by')
+
+
+def threshold(p, sig=0.05, correction=None):
+    """
+    Significance threshold of the p-values p at level sig, under a
+    multiple testing correction. Units with p <= threshold are
+    significant.
+
+    Arguments
+    ---------
+    p                : numpy.ndarray
+                       p-values, NaN for units that are not tested
+    sig              : float
+                       (default=0.05)
+                       significance level, or false discovery rate
+    correction       : None/str
+                       (default=None)
+                       None, 'bonferroni', 'fdr_bh' (Benjamini-Hochberg)
+                       or 'fdr_by' (Benjamini-Yekutieli, valid under any
+                       dependence between the tests)
+
+    Returns
+    -------
+    float
+    """
+    if correction not in CORRECTIONS:
+        raise NotImplementedError(f'The requested correction \
+        ({correction}) is not currently supported!')
+    if correction is None:
+        return sig
+    p = np.asarray(p).ravel()
+    p = p[~np.isnan(p)]
+    m = p.size
+    if m == 0:
+        return sig
+    if correction == 'bonferroni':
+        return sig / m
+    if correction == 'fdr_by':
+        sig = sig / _harmonic(m)
+    # Step-up procedure: the largest p_(k) <= k sig / m, in O(m log m)
+    p = np.sort(p)
+    below = np.flatnonzero(p <= sig * np.arange(1, m + 1) / m)
+    # No p-value is that small, and p-values are not negative
+    return p[below[-1]] if below.size else -np.inf
+
+
+def adjust(p, correction='fdr_bh', chunk_size=None, out=None):
+    """
+    Adjusted p-values of the p-values p under a multiple testing
+    correction, NaN where p is NaN.
+
+    The Benjamini-Hochberg adjusted p-value of a unit with p-value p is
+    the minimum of m p' / R(p') over the p-values p' >= p, where R(p')
+    is the number of p-values <= p', which only depends on the distinct
+    p-values and their counts. These are gathered in a first pass over
+    p, and the adjusted p-values are looked up in a second one.
+
+    Arguments
+    ---------
+    p                : numpy.ndarray
+                       p-values, of any shape, NaN for units that are
+                       not tested
+    correction       : str
+                       (default='fdr_bh')
+                       'bonferroni', 'fdr_bh' (Benjamini-Hochberg) or
+                       'fdr_by' (Benjamini-Yekutieli)
+    chunk_size       : None/int
+                       (default=None)
+                       If given, p is read and out is written chunk_size
+                       values at a time, so that both can be memory-mapped
+                       arrays larger than memory. Memory use is then
+                       proportional to the number of distinct p-values,
+                       at most permutations + 1 for pseudo p-values.
+    out              : None/numpy.ndarray
+                       (default=None)
+                       contiguous float array shaped as p to write the
+                       adjusted p-values to, e.g. a numpy.memmap
+
+    Returns
+    -------
+    numpy.ndarray of the adjusted p-values, out if given
+    """
+    if correction not in CORRECTIONS[1:]:
+        raise NotImplementedError(f'The requested correction \
+        ({correction}) is not currently supported!')
+    p = np.asarray(p)
+    if out is None:
+        out = np.empty(p.shape, dtype='float64')
+    p_flat, out_flat = p.reshape(-1), out.reshape(-1)
+    n = p_flat.size
+    chunks = [slice(start, start + (chunk_size or n))
+              for start in range(0, n, chunk_size or max(n, 1))]
+
+    # Distinct p-values and their counts
+    values = np.empty(0, dtype=p.dtype)
+    counts = np.empty(0, dtype=np.int64)
+    for chunk in chunks:
+        chunk = p_flat[chunk]
+        chunk = chunk[~np.isnan(chunk)]
+        if correction == 'bonferroni':
+            counts = np.append(counts, chunk.size)
+            continue
+        chunk_values, chunk_counts = np.unique(chunk, return_counts=True)
+        values, inverse = np.unique(np.concatenate((values, chunk_values)),
+                                    return_inverse=True)
+        counts = np.bincount(inverse, np.concatenate((counts, chunk_counts)),
+                             values.size).astype(np.int64)
+    m = counts.sum()
+
+    if correction != 'bonferroni':
+        adjusted = values * m / np.cumsum(counts)
+        if correction == 'fdr_by':
+            adjusted *= _harmonic(m)
+        # Step-up: the smallest adjustment over the larger p-values
+        adjusted = np.minimum(np.minimum.accumulate(adjusted[::-1])[::-1], 1)
+
+    for chunk in chunks:
+        p_chunk = p_flat[chunk]
+        if correction == 'bonferroni':
+            out_flat[chunk] = np.minimum(p_chunk * m, 1)
+            continue
+        # Sorted queries are looked up much faster, and NaN
+        # p-values are sorted past the distinct values
+        chunk_values, inverse = np.unique(p_chunk, return_inverse=True)
+        positions = np.searchsorted(values, chunk_values)
+        tested = positions < values.size
+        result = np.full(chunk_values.shape, np.nan)
+        result[tested] = adjusted[positions[tested]]
+        out_flat[chunk] = result[inverse.reshape(-1)]
+    return out
+
+
+def adjust_columns(p, correction='fdr_bh'):
+    """
+    Adjusted p-values of each column of the (n, ...) p-values p, as
+    separate families of tests, e.g. the variables of a fit_many. (n,)
+    p-values are a single family, as in adjust.
+
+    Returns
+    -------
+    numpy.ndarray of the adjusted p-values, shaped as p
+    """
+    p = np.asarray(p)
+    columns = p.reshape(p.shape[0], -1)
+    out = np.empty(columns.shape, dtype='float64', order='F')
+    for j in range(columns.shape[1]):
+        adjust(columns[:, j], correction, out=out[:, j])
+    return out.reshape(p.shape)
+
+
+def correct(estimator, inference='permutation', by_column=False):
+    """
+    Adjust the p-values of a fitted estimator under its correction,
+    storing them in p_adjusted, and return the p-values its units are
+    labelled by: p_adjusted if the estimator has a correction, its
+    p-values as they are otherwise.
+
+    Arguments
+    ---------
+    estimator        : fitted estimator
+                       with a correction attribute, and p_analytic or
+                       p_sim
+    inference        : str
+                       (default='permutation')
+                       'analytic' for the p-values in p_analytic, else
+                       those in p_sim
+    by_column        : bool
+                       (default=False)
+                       If True, the columns of (n, m) p-values are
+                       adjusted as separate families (see
+                       adjust_columns), e.g. for fit_many.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    p = estimator.p_analytic if inference == 'analytic' else estimator.p_sim
+    if estimator.correction is None:
+        return p
+    adjust_func = adjust_columns if by_column else adjust
+    estimator.p_adjusted = adjust_func(p, estimator.correction)
+    return estimator.p_adjusted
+
+
+def _harmonic(m):
+    """
+    m-th harmonic number, sum_k=1..m 1/k, without allocating m values
+    """
+    return special.digamma(m + 1) + np.euler_gamma
@@ -0,0 +1,143 @@
+"""
+Permuted neighbor ids drawn once and shared by conditional randomisations.
+
+Every conditional randomisation draws a (permutations, max_card) table of
+ids sampled without replacement from the n-1 other observations, which
+costs O(n) per permutation. A PermutationPool draws the table once, for
+the largest number of permutations and cardinality it is to serve, and
+can be written to disk and memory-mapped back, so that repeated fits on
+the same n skip the draws and are randomised against the same ids.
+
+The first permutations rows and max_card columns of a table are
+themselves a table of permutations draws of max_card ids without
+replacement, so a pool serves any fit with at most as many permutations
+and neighbors. A fit with a pool drawn for exactly its permutations and
+largest cardinality gives the same results as a fit with the pool seed.
+"""
+
+import os
+import numpy as np
+
+from .crand import vec_permutations
+from .prepared_weights import PreparedWeights
+
+
+class PermutationPool(object):
+
+    """Table of permuted neighbor ids, reusable across fits"""
+
+    def __init__(self, n, permutations, max_card, seed=None):
+        """
+        Draw the permuted ids for observations with up to max_card
+        neighbors among n
+
+        Arguments
+        ---------
+        n                : int
+                           number of observations
+        permutations     : int
+                           largest number of permutations to serve
+        max_card         : int
+                           largest cardinality to serve
+        seed             : None/int
+                           Seed of the draws. If None, a random one is
+                           drawn and stored in seed.
+
+        Attributes
+        ----------
+        permuted_ids     : numpy.ndarray
+                           (permutations, max_card) array of ids in
+                           [0, n-1), each to be shifted past the
+                           randomised observation
+        """
+        if seed is None:
+            seed = np.random.randint(12345, 12345000)
+        self.n = int(n)
+        self.seed = int(seed)
+        self.permuted_ids = vec_permutations(int(max_card), self.n,
+                                             int(permutations), self.seed)
+
+    @classmethod
+    def from_weights(cls, w, permutations=999, seed=None):
+        """
+        Draw a pool serving every fit on the weights w with up to
+        permutations permutations
+
+        Arguments
+        ---------
+        w                : libpysal.weights.W, scipy.sparse matrix or
+                           PreparedWeights
+        permutations     : int
+                           (default=999)
+                           largest number of permutations to serve
+        seed             : None/int
+                           Seed of the draws
+
+        Returns
+        -------
+        PermutationPool
+        """
+        prepared = PreparedWeights.from_w(w)
+        return cls(prepared.n, permutations,
+                   prepared.cardinalities.max(initial=0), seed)
+
+    @classmethod
+    def from_npy(cls, path, mmap_mode='r'):
+        """
+        Read a pool written by to_npy, memory-mapping the permuted ids
+
+        Arguments
+        ---------
+        path             : str
+                           directory containing the .npy files
+        mmap_mode        : None/str
+                           (default='r')
+                           passed to numpy.load. If None, the ids are
+                           read into memory.
+
+        Returns
+        -------
+        PermutationPool
+        """
+        pool = cls.__new__(cls)
+        pool.n, pool.seed = np.load(os.path.join(path, 'pool.npy')).tolist()
+        pool.permuted_ids = np.load(os.path.join(path, 'permuted_ids.npy'),
+                                    mmap_mode=mmap_mode)
+        return pool
+
+    def to_npy(self, path):
+        """
+        Write the pool to path/permuted_ids.npy and path/pool.npy, to be
+        read by from_npy
+
+        Arguments
+        ---------
+        path             : str
+                           directory to write the .npy files to. It is
+                           created if it does not exist.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'permuted_ids.npy'), self.permuted_ids)
+        np.save(os.path.join(path, 'pool.npy'),
+                np.array([self.n, self.seed], dtype=np.int64))
+
+    def take(self, n, permutations, max_card):
+        """
+        Permuted ids of a randomisation of n observations with the given
+        permutations and largest cardinality
+
+        Returns
+        -------
+        (permutations, max_card) array, a view of the pool
+        """
+        if n != self.n:
+            raise ValueError(f'The pool was drawn for {self.n} '
+                             f'observations, not {n}')
+        available, available_card = self.permuted_ids.shape
+        if permutations > available or max_card > available_card:
+            raise ValueError(
+                f'The pool serves up to {available} permutations of '
+                f'{available_card} neighbors, not {permutations} of '
+                f'{max_card}'
+            )
+        return self.permuted_ids[:permutations, :max_card]
@@ -0,0 +1,614 @@
+import itertools
+import os
+import weakref
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Prepared weights are cached by the identity of the W they were built
+# from, so that alternating estimators on the same W reuse them. The
+# cache does not keep W objects alive.
+_CACHE = weakref.WeakKeyDictionary()
+
+
+class BlockCSR(object):
+
+    """CSR weights read and transformed in blocks of rows"""
+
+    def __init__(self, indptr, indices, data, block_size=100000,
+                 transform=None):
+        """
+        A CSR matrix whose arrays may be memory-mapped, exposing the
+        few operations the local statistics need by streaming over
+        blocks of rows, so that only one block of edges is held in
+        memory at a time.
+
+        Arguments
+        ---------
+        indptr           : numpy.ndarray or numpy.memmap
+                           (n+1,) CSR row pointer
+        indices          : numpy.ndarray or numpy.memmap
+                           (nnz,) CSR column indices
+        data             : numpy.ndarray or numpy.memmap
+                           (nnz,) CSR weights
+        block_size       : int
+                           (default=100000)
+                           number of rows per block
+        transform        : None/str
+                           applied to each block as it is read. One of
+                           None, "zero_diagonal", "binary" (binary,
+                           zero diagonal) or "row_standardized".
+        """
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.block_size = int(block_size)
+        self.transform = transform
+        n = len(indptr) - 1
+        self.shape = (n, n)
+
+    def with_transform(self, transform):
+        """
+        The same arrays, read with another transform
+        """
+        return BlockCSR(self.indptr, self.indices, self.data,
+                        self.block_size, transform)
+
+    def blocks(self):
+        """
+        Yield (start, stop, block) for consecutive blocks of rows, where
+        block is the (stop-start, n) scipy.sparse.csr_matrix of the rows
+        with the transform applied
+        """
+        n = self.shape[0]
+        for start in range(0, n, self.block_size):
+            stop = min(start + self.block_size, n)
+            lo, hi = int(self.indptr[start]), int(self.indptr[stop])
+            indptr = np.asarray(self.indptr[start:stop + 1]) - lo
+            indices = np.asarray(self.indices[lo:hi])
+            data = np.asarray(self.data[lo:hi], dtype='float')
+            if self.transform in ('zero_diagonal', 'binary'):
+                rows = np.repeat(np.arange(stop - start), np.diff(indptr))
+                keep = indices != rows + start
+                if self.transform == 'binary':
+                    keep &= data != 0
+                indptr = np.concatenate(([0], np.cumsum(
+                    np.bincount(rows[keep], minlength=stop - start)
+                )))
+                indices, data = indices[keep], data[keep]
+                if self.transform == 'binary':
+                    data = np.ones_like(data)
+            block = sparse.csr_matrix((data, indices, indptr),
+                                      shape=(stop - start, n))
+            if self.transform == 'row_standardized':
+                rowsum = np.asarray(block.sum(axis=1)).flatten()
+                block.data = block.data / np.repeat(rowsum,
+                                                    np.diff(block.indptr))
+            yield start, stop, block
+
+    def __matmul__(self, x):
+        out = np.empty((self.shape[0],) + np.shape(x)[1:])
+        for start, stop, block in self.blocks():
+            out[start:stop] = block @ x
+        return out
+
+    def sum(self, axis=1):
+        """
+        Row sums, as a (n, 1) array. Only axis=1 is supported.
+        """
+        if axis != 1:
+            raise NotImplementedError('BlockCSR only supports row sums')
+        return self._rows(lambda block: block.sum(axis=1)).reshape(-1, 1)
+
+    def multiply(self, other):
+        """
+        Element-wise product with itself, used for squared row sums
+        """
+        if other is not self:
+            raise NotImplementedError('BlockCSR only multiplies by itself')
+        return _SquaredBlockCSR(self)
+
+    def getnnz(self, axis=1):
+        """
+        Number of stored entries in each row. Only axis=1 is supported.
+        """
+        if axis != 1:
+            raise NotImplementedError('BlockCSR only supports row counts')
+        return self._rows(lambda block: np.diff(block.indptr),
+                          dtype='int64')
+
+    def diagonal(self):
+        return self._rows(
+            lambda block, start: block.diagonal(k=start), offset=True
+        )
+
+    def _rows(self, func, offset=False, dtype='float'):
+        out = np.empty(self.shape[0], dtype=dtype)
+        for start, stop, block in self.blocks():
+            args = (block, start) if offset else (block,)
+            out[start:stop] = np.asarray(func(*args)).flatten()
+        return out
+
+
+class _SquaredBlockCSR(object):
+
+    """Row sums of the squared weights of a BlockCSR"""
+
+    def __init__(self, W):
+        self.W = W
+
+    def sum(self, axis=1):
+        return self.W._rows(
+            lambda block: block.multiply(block).sum(axis=1)
+        ).reshape(-1, 1)
+
+
+class PreparedWeights(object):
+
+    """Sparse forms of a spatial weights object shared across estimators"""
+
+    def __init__(self, w):
+        """
+        Prepare the sparse representations used by the local statistics,
+        without copying or mutating w. Each representation is computed
+        the first time it is requested and then reused.
+
+        Arguments
+        ---------
+        w                : libpysal.weights.W or scipy.sparse matrix
+                           the connectivity structure describing
+                           the relationships between observed units,
+                           as currently transformed.
+
+        Attributes
+        ----------
+        n                : int
+                           number of observations
+        id_order         : list or range
+                           ids of the observations, in the order of
+                           the rows of the sparse forms (a range for
+                           positional weights)
+        transform        : str
+                           transformation of w when it was prepared
+        sparse           : scipy.sparse.csr_matrix
+                           weights as given
+        """
+        # weights of a transformed W as instantiated, read from it
+        # rather than by resetting its transform
+        self._original = None
+        if sparse.issparse(w):
+            self.sparse = sparse.csr_matrix(w, dtype='float')
+            self.id_order = range(self.sparse.shape[0])
+            self.transform = None
+        else:
+            self.sparse = w.sparse.tocsr().astype('float', copy=False)
+            self.id_order = w.id_order
+            self.transform = w.transform
+            if str(w.transform).upper() != 'O':
+                self._original = _original_sparse(w)
+        self.n = self.sparse.shape[0]
+
+    @classmethod
+    def from_npy(cls, path, block_size=100000, mmap_mode='r'):
+        """
+        Prepare weights stored as CSR arrays in path/indptr.npy,
+        path/indices.npy and path/data.npy, e.g. as written by to_npy.
+        The arrays are memory-mapped and every sparse form is a
+        BlockCSR, so statistics and permutation inference stream over
+        blocks of rows and peak memory is O(n + block edges).
+
+        Arguments
+        ---------
+        path             : str
+                           directory containing the .npy files
+        block_size       : int
+                           (default=100000)
+                           number of rows read at a time
+        mmap_mode        : None/str
+                           passed to numpy.load. If None, the arrays are
+                           read into memory but still used by block.
+
+        Returns
+        -------
+        PreparedWeights
+        """
+        arrays = [np.load(os.path.join(path, name + '.npy'),
+                          mmap_mode=mmap_mode)
+                  for name in ('indptr', 'indices', 'data')]
+        prepared = cls.__new__(cls)
+        prepared.sparse = BlockCSR(*arrays, block_size=block_size)
+        prepared.n = prepared.sparse.shape[0]
+        prepared.id_order = range(prepared.n)
+        prepared.transform = None
+        return prepared
+
+    @classmethod
+    def from_file(cls, path, cache=False):
+        """
+        Prepare weights read from a GAL or GWT file directly into CSR
+        arrays, without building a libpysal W. The ids are strings, in
+        the order libpysal reads them, and the arrays are those of
+        W.sparse, so that the estimators give the same results as with
+        the W.
+
+        Arguments
+        ---------
+        path             : str
+                           path to a .gal or .gwt file
+        cache            : bool/str
+                           (default=False)
+                           If True, the parsed arrays are stored in
+                           path + '.npz', next to the file; if a
+                           directory, in a .npz file of the same name
+                           in that directory. They are read from there
+                           as long as the modification time of the file
+                           is unchanged. The cache is skipped if it
+                           cannot be written.
+
+        Returns
+        -------
+        PreparedWeights
+        """
+        path = os.fspath(path)
+        mtime = os.path.getmtime(path)
+        if cache is True:
+            cache_path = path + '.npz'
+        elif cache:
+            cache_path = os.path.join(os.fspath(cache),
+                                      os.path.basename(path) + '.npz')
+        else:
+            cache_path = None
+        if cache_path is not None and os.path.exists(cache_path):
+            with np.load(cache_path, allow_pickle=False) as stored:
+                if stored['mtime'] == mtime:
+                    return cls._from_arrays(
+                        stored['indptr'], stored['indices'],
+                        stored['data'], stored['ids']
+                    )
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.gal':
+            ids, W = _read_gal(path)
+        elif extension == '.gwt':
+            ids, W = _read_gwt(path)
+        else:
+            raise NotImplementedError(f'Weights files of type {extension} '
+                                      'are not currently supported!')
+        if cache_path is not None:
+            try:
+                np.savez(cache_path, indptr=W.indptr, indices=W.indices,
+                         data=W.data, ids=ids, mtime=mtime)
+            except OSError:
+                pass
+        return cls._from_arrays(W.indptr, W.indices, W.data, ids)
+
+    @classmethod
+    def _from_arrays(cls, indptr, indices, data, ids):
+        """
+        Prepared weights of the CSR arrays of the weights between ids
+        """
+        prepared = cls(sparse.csr_matrix((data, indices, indptr),
+                                         shape=(len(ids), len(ids))))
+        prepared.id_order = ids.tolist()
+        return prepared
+
+    def to_npy(self, path):
+        """
+        Write the weights as CSR arrays to path/indptr.npy,
+        path/indices.npy and path/data.npy, to be read by from_npy
+
+        Arguments
+        ---------
+        path             : str
+                           directory to write the .npy files to. It is
+                           created if it does not exist.
+        """
+        os.makedirs(path, exist_ok=True)
+        W = self.sparse
+        for name in ('indptr', 'indices', 'data'):
+            np.save(os.path.join(path, name + '.npy'), getattr(W, name))
+
+    @property
+    def streaming(self):
+        """
+        True if the sparse forms are read in blocks of rows
+        """
+        return isinstance(self.sparse, BlockCSR)
+
+    @classmethod
+    def from_w(cls, w):
+        """
+        Return the prepared weights of w, reusing the cached ones if w
+        was prepared before and has not been re-transformed since
+
+        Arguments
+        ---------
+        w                : libpysal.weights.W, scipy.sparse matrix,
+                           PreparedWeights or path to a GAL or GWT file
+
+        Returns
+        -------
+        PreparedWeights for w. A PreparedWeights is returned as is, and
+        files are read with from_file, without caching. Files read
+        repeatedly are best prepared once with from_file and passed on.
+        """
+        if isinstance(w, cls):
+            return w
+        if isinstance(w, (str, os.PathLike)):
+            return cls.from_file(w)
+        if sparse.issparse(w):
+            return cls(w)
+        prepared = _CACHE.get(w)
+        if prepared is None or prepared.transform != w.transform:
+            prepared = cls(w)
+            _CACHE[w] = prepared
+        return prepared
+
+    def _cached(self, name, func):
+        if name not in self.__dict__:
+            self.__dict__[name] = func()
+        return self.__dict__[name]
+
+    def positions(self, ids):
+        """
+        Positions, in the rows of the sparse forms, of the
+        observations with the given ids
+
+        Arguments
+        ---------
+        ids              : list
+                           ids of observations, as in id_order
+
+        Returns
+        -------
+        (len(ids),) int64 array of positions
+        """
+        index = self._cached('_id_index', self._id_index)
+        if index is None:
+            # ids are the positions
+            positions = np.asarray(ids, dtype=np.int64).reshape(-1)
+            missing = (positions < 0) | (positions >= self.n)
+        else:
+            positions = index.get_indexer(np.asarray(ids, dtype=object)
+                                          .reshape(-1))
+            missing = positions < 0
+        if missing.any():
+            raise KeyError(f'Unknown ids: {np.asarray(ids)[missing]}')
+        return positions.astype(np.int64, copy=False)
+
+    def _id_index(self):
+        """
+        None if the ids are the positions 0, ..., n-1, as for sparse
+        and stored weights and for most integer-indexed W; otherwise,
+        a pandas.Index factorizing the ids once, to look up the
+        positions of many ids in a single vectorized call
+        """
+        id_order = self.id_order
+        if id_order == range(self.n):
+            return None
+        ids = np.asarray(id_order)
+        if (ids.dtype.kind in 'iu'
+                and np.array_equal(ids, np.arange(self.n))):
+            return None
+        return pd.Index(id_order)
+
+    def neighbors_of(self, positions):
+        """
+        Positions of the observations whose weights involve any of the
+        observations at the given positions, i.e. the rows with a
+        nonzero in their columns, together with those positions
+
+        Arguments
+        ---------
+        positions        : numpy.ndarray
+                           positions of observations
+
+        Returns
+        -------
+        sorted int64 array of unique positions
+        """
+        if self.streaming:
+            raise NotImplementedError('Neighbor lookups are not supported '
+                                      'for streamed weights')
+        columns = self._cached('_csc', lambda: self.sparse.tocsc())
+        positions = np.asarray(positions, dtype=np.int64)
+        return np.union1d(positions, columns[:, positions].indices)
+
+    def sparse_as(self, dtype, form='sparse'):
+        """
+        Weights as given, or in one of their forms (e.g.
+        'row_standardized'), with data of the given dtype, e.g.
+        'float32' for single precision kernels. Streaming weights are
+        always read in double precision and are returned as is.
+        """
+        dtype = np.dtype(dtype)
+        W = getattr(self, form)
+        if self.streaming or dtype == W.dtype:
+            return W
+        return self._cached('_' + form + '_' + dtype.name,
+                            lambda: W.astype(dtype))
+
+    @property
+    def zero_diagonal(self):
+        """
+        Weights with the diagonal (self-neighbors) removed
+        """
+        def build():
+            if self.streaming:
+                return self.sparse.with_transform('zero_diagonal')
+            if not self.sparse.diagonal().any():
+                return self.sparse
+            W = self.sparse.tolil()
+            W.setdiag(0)
+            W = W.tocsr()
+            W.eliminate_zeros()
+            return W
+        return self._cached('_zero_diagonal', build)
+
+    @property
+    def binary(self):
+        """
+        Binary weights with a zero diagonal, as used by the
+        local join counts
+        """
+        def build():
+            if self.streaming:
+                return self.sparse.with_transform('binary')
+            W = self.zero_diagonal.copy()
+            W.eliminate_zeros()
+            W.data = np.ones_like(W.data)
+            return W
+        return self._cached('_binary', build)
+
+    @property
+    def original(self):
+        """
+        Weights of a libpysal W as instantiated, whatever its current
+        transform, as W.transform = 'o' would give
+        """
+        return self.sparse if self._original is None else self._original
+
+    @property
+    def row_standardized(self):
+        """
+        Row-standardized weights, as used by the Local Geary.
+        Rows of islands are left empty. As W.transform = 'r' does,
+        the original weights are standardized, whatever the
+        transform of W.
+        """
+        def build():
+            if self.streaming:
+                return self.sparse.with_transform('row_standardized')
+            W = self.original.copy()
+            rowsum = np.asarray(W.sum(axis=1)).flatten()
+            # divide, rather than scale by 1/rowsum, to match
+            # the values of W.transform = 'r'
+            W.data = W.data / np.repeat(rowsum, np.diff(W.indptr))
+            return W
+        return self._cached('_row_standardized', build)
+
+    @property
+    def rowsum(self):
+        """
+        Row sums of the weights
+        """
+        return self._cached(
+            '_rowsum',
+            lambda: np.asarray(self.sparse.sum(axis=1)).flatten()
+        )
+
+    @property
+    def squared_rowsum(self):
+        """
+        Row sums of the squared weights
+        """
+        return self._cached(
+            '_squared_rowsum',
+            lambda: np.asarray(
+                self.sparse.multiply(self.sparse).sum(axis=1)
+            ).flatten()
+        )
+
+    @property
+    def cardinalities(self):
+        """
+        Number of neighbors of each observation, excluding itself
+        """
+        return self._cached(
+            '_cardinalities',
+            lambda: self.binary.getnnz(axis=1)
+        )
+
+
+def _original_sparse(w):
+    """
+    CSR weights of the libpysal W w as instantiated (transform 'O'),
+    built as W.sparse is, without re-transforming w
+    """
+    original = w.transformations['O']
+    offsets = w.neighbor_offsets
+    ids = w.id_order
+    cardinalities = [len(offsets[i]) for i in ids]
+    rows = np.repeat(np.arange(len(ids)), cardinalities)
+    columns = np.fromiter(itertools.chain.from_iterable(
+        offsets[i] for i in ids
+    ), dtype=np.int64, count=rows.size)
+    data = np.fromiter(itertools.chain.from_iterable(
+        original[i] for i in ids
+    ), dtype='float', count=rows.size)
+    return sparse.csr_matrix((data, (rows, columns)),
+                             shape=(len(ids), len(ids)))
+
+
+# --------------------------------------------------------------
+# Weights files
+# --------------------------------------------------------------
+
+# The body of the files is split into tokens in one call and parsed as
+# arrays, rather than line by line into dictionaries of neighbors.
+
+
+def _header_n(header):
+    """
+    Number of observations in the header line of a GAL or GWT file,
+    either "n" or "0 n [shapefile] [id variable]"
+    """
+    fields = header.split()
+    return int(fields[1] if len(fields) > 1 else fields[0])
+
+
+def _read_gal(path):
+    """
+    ids, in file order, and binary CSR weights of a GAL file
+    """
+    with open(path) as f:
+        n = _header_n(f.readline())
+        lines = f.read().split('\n')
+    # one line with the id and cardinality of each observation,
+    # then one with its neighbors, which is empty for islands
+    lines += [''] * max(0, 2 * n - len(lines))
+    heads = np.array(' '.join(lines[0:2 * n:2]).split()).reshape(n, 2)
+    neighbors = np.array(' '.join(lines[1:2 * n:2]).split())
+    ids = heads[:, 0]
+    cardinalities = heads[:, 1].astype(np.int64)
+    columns = pd.Index(ids).get_indexer(neighbors)
+    if (columns < 0).any() or len(columns) != cardinalities.sum():
+        raise ValueError(f'{path} does not describe {n} observations')
+    indptr = np.concatenate(([0], np.cumsum(cardinalities)))
+    W = sparse.csr_matrix(
+        (np.ones(len(columns)), columns, indptr), shape=(n, n)
+    )
+    W.sort_indices()
+    return ids, W
+
+
+def _read_gwt(path):
+    """
+    ids, in order of first appearance as origins, and CSR weights of
+    a GWT file
+    """
+    with open(path) as f:
+        n = _header_n(f.readline())
+        table = pd.read_csv(f, sep=r'\s+', header=None, usecols=[0, 1, 2],
+                            names=['i', 'j', 'w'])
+    # Integer ids are factorized as such, which is much faster than
+    # as strings, and only the unique ones are turned into strings
+    if not all(table[c].dtype.kind in 'iu' for c in ('i', 'j')):
+        table = table.astype({'i': str, 'j': str})
+    destinations = table['j'].to_numpy()
+    rows, ids = pd.factorize(table['i'].to_numpy())
+    ids = np.asarray(ids)
+    columns = pd.Index(ids).get_indexer(destinations)
+    if (columns < 0).any():
+        # neighbors that are never origins, i.e. with no neighbors
+        # of their own, come after the origins
+        extra, extra_ids = pd.factorize(destinations[columns < 0])
+        columns[columns < 0] = len(ids) + extra
+        ids = np.concatenate((ids, np.asarray(extra_ids)))
+    ids = ids.astype(str)
+    if len(ids) != n:
+        raise ValueError(f'{path} does not describe {n} observations')
+    W = sparse.csr_matrix(
+        (table['w'].to_numpy(dtype='float'), (rows, columns)), shape=(n, n)
+    )
+    W.sort_indices()
+    return ids, W
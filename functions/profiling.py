@@ -0,0 +1,158 @@
+"""
+Opt-in instrumentation of the fit of the local statistics.
+
+An estimator fitted with `profile=True` records the wall time, the memory
+allocated through Python (numpy arrays included, numba internals not) and
+the numba compilation time of each phase of its fit, together with the
+number of permutations performed, in a `fit_stats_` attribute:
+
+    {'phases': {'weights': {'seconds': ..., 'peak_bytes': ...,
+                            'retained_bytes': ..., 'compile_seconds': ...},
+                'statistic': {...}, 'inference': {...}, ...},
+     'seconds': ..., 'permutations': ...}
+
+The profiler is a context manager, so that tracing stops and the numba
+listener is unregistered even when the fit raises. Compilation in joblib
+workers (n_jobs != 1) is not seen by the profiler.
+"""
+
+import time
+import tracemalloc
+import numpy as np
+
+try:
+    from numba.core import event as _numba_event
+except (ModuleNotFoundError, ImportError):
+    _numba_event = None
+
+
+class FitProfiler(object):
+
+    """Wall time, memory and numba compilation time of the phases of a fit"""
+
+    def __init__(self, enabled=True):
+        """
+        Start profiling, if enabled. Otherwise, every method is a no-op,
+        so that estimators can call them unconditionally. Profiling
+        stops with stats, or on leaving a with block.
+
+        Arguments
+        ---------
+        enabled          : bool
+                           (default=True)
+                           whether to profile
+        """
+        self.enabled = enabled
+        self.phases = {}
+        self._running = enabled
+        if not enabled:
+            return
+        self._stop_tracing = not tracemalloc.is_tracing()
+        if self._stop_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self._memory = tracemalloc.get_traced_memory()[0]
+        self._compile = None
+        if _numba_event is not None:
+            self._compile = _numba_event.TimingListener()
+            _numba_event.register('numba:compile', self._compile)
+        self._compile_seconds = 0.0
+        self._time = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def stop(self):
+        """
+        Stop tracing memory, if the profiler started it, and listening
+        to numba compilation. Later calls are no-ops.
+        """
+        if not self._running:
+            return
+        self._running = False
+        if self._compile is not None:
+            _numba_event.unregister('numba:compile', self._compile)
+        if self._stop_tracing:
+            tracemalloc.stop()
+
+    def _compiled(self):
+        """
+        Total numba compilation time since the profiler started
+        """
+        if self._compile is None or not self._compile.done:
+            return 0.0
+        return self._compile.duration
+
+    def lap(self, name):
+        """
+        Record the phase `name` as the work done since the previous lap,
+        or since the profiler started. Repeated phases are accumulated.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        current, peak = tracemalloc.get_traced_memory()
+        compiled = self._compiled()
+        phase = self.phases.setdefault(name, dict(
+            seconds=0.0, peak_bytes=0, retained_bytes=0, compile_seconds=0.0
+        ))
+        phase['seconds'] += now - self._time
+        phase['peak_bytes'] = max(phase['peak_bytes'], peak - self._memory)
+        phase['retained_bytes'] += current - self._memory
+        phase['compile_seconds'] += compiled - self._compile_seconds
+        tracemalloc.reset_peak()
+        self._memory = current
+        self._compile_seconds = compiled
+        # the bookkeeping above is not charged to the next phase
+        self._time = time.perf_counter()
+
+    def stats(self, **counts):
+        """
+        Stop profiling and return the recorded phases
+
+        Arguments
+        ---------
+        counts           : int
+                           counts to report along with the phases,
+                           e.g. permutations
+
+        Returns
+        -------
+        dict with the phases, their total wall time and the counts, or
+        None if not enabled
+        """
+        if not self.enabled:
+            return None
+        self.stop()
+        seconds = sum(phase['seconds'] for phase in self.phases.values())
+        return dict(phases=self.phases, seconds=seconds, **counts)
+
+
+def permutations_run(p_sim, permutations, n_permutations=None):
+    """
+    Number of permutations performed for pseudo p-values p_sim, which
+    are NaN for the observations that were not randomised
+
+    Arguments
+    ---------
+    p_sim            : None/numpy.ndarray
+                       pseudo p-values, None if not computed
+    permutations     : int
+                       permutations per randomised observation
+    n_permutations   : None/numpy.ndarray
+                       permutations run per observation, if stopped
+                       early
+
+    Returns
+    -------
+    int
+    """
+    if n_permutations is not None:
+        return int(np.sum(n_permutations))
+    if p_sim is None:
+        return 0
+    return int(np.isfinite(p_sim).sum()) * int(permutations)
@@ -0,0 +1,78 @@
+import unittest
+import numpy as np
+from libpysal.weights.util import lat2W
+
+from ..crand import (crand, crand_nonzero, vec_permutations,
+                     _prepare_multivariate)
+from ..local_geary import _local_geary
+from ..local_join_count import _ljc_uni
+from ..prepared_weights import PreparedWeights
+
+
+class Crand_Tester(unittest.TestCase):
+    """Unit test for the conditional randomisation engine"""
+    def setUp(self):
+        self.n = 16
+        self.z = np.arange(self.n * 2, dtype='float').reshape(self.n, 2)
+
+    def test_vec_permutations(self):
+        """Test method"""
+        ids = vec_permutations(4, self.n, 99, 12345)
+        self.assertEqual(ids.shape, (99, 4))
+        self.assertTrue((ids >= 0).all() and (ids < self.n - 1).all())
+        for row in ids:
+            self.assertEqual(len(np.unique(row)), 4)
+        np.testing.assert_array_equal(ids, vec_permutations(4, self.n,
+                                                            99, 12345))
+
+    def test_prepare_multivariate(self):
+        """Random neighbors of i never include i"""
+        ids = vec_permutations(self.n - 1, self.n, 9, 12345)
+        weights_i = np.ones(self.n - 1)
+        for i in range(self.n):
+            zi, zrand = _prepare_multivariate(i, self.z, ids, weights_i)
+            np.testing.assert_array_equal(zi, self.z[i])
+            self.assertFalse((zrand[:, :, 0] == self.z[i, 0]).any())
+
+    def test_crand_chunks(self):
+        """p-values do not depend on n_jobs or chunk_size"""
+        w = PreparedWeights(lat2W(4, 4)).row_standardized
+        z = (self.z[:, 1] - self.z[:, 1].mean()) / self.z[:, 1].std()
+        observed = np.linspace(0, 2, self.n)
+        kwargs = dict(permutations=99, keep=True, stat_func=_local_geary,
+                      seed=12345)
+        p_sim, rlocals = crand(z, w, observed, n_jobs=1, **kwargs)
+        for n_jobs, chunk_size in ((1, 3), (1, 16), (2, 5)):
+            p_chunk, r_chunk = crand(z, w, observed, n_jobs=n_jobs,
+                                     chunk_size=chunk_size, **kwargs)
+            np.testing.assert_array_equal(p_sim, p_chunk)
+            np.testing.assert_array_equal(rlocals, r_chunk)
+
+    def test_crand_nonzero(self):
+        """Only nonzero statistics are randomised, as in a full run"""
+        w = PreparedWeights(lat2W(4, 4)).binary
+        x = np.zeros(self.n)
+        x[[0, 1, 5, 10]] = 1
+        observed = x * (w @ x)
+        p_sim, rlocals = crand(x, w, observed, 99, True, 1, _ljc_uni,
+                               seed=12345)
+        p_nz, r_nz = crand_nonzero(x, w, observed, 99, True, 1, _ljc_uni,
+                                   seed=12345)
+        nonzero = observed != 0
+        np.testing.assert_array_equal(p_nz[nonzero], p_sim[nonzero])
+        np.testing.assert_array_equal(r_nz[nonzero], rlocals[nonzero])
+        self.assertTrue(np.isnan(p_nz[~nonzero]).all())
+        self.assertTrue(np.isnan(r_nz[~nonzero]).all())
+
+
+suite = unittest.TestSuite()
+test_classes = [
+    Crand_Tester
+]
+for i in test_classes:
+    a = unittest.TestLoader().loadTestsFromTestCase(i)
+    suite.addTest(a)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
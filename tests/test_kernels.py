@@ -0,0 +1,92 @@
+import unittest
+import numpy as np
+from libpysal.weights.util import lat2W
+
+from .. import kernels
+from ..prepared_weights import BlockCSR
+
+
+class Kernels_Tester(unittest.TestCase):
+    """Unit test for the sparse local statistic kernels"""
+    def setUp(self):
+        np.random.seed(10)
+        self.w = lat2W(4, 4)
+        self.w.transform = 'r'
+        self.z = np.random.normal(size=16)
+
+    def test_local_geary(self):
+        """Expanded identity matches sum_j w_ij (z_i - z_j)^2"""
+        W = self.w.sparse.toarray()
+        expected = (W * (self.z[:, None] - self.z[None, :])**2).sum(axis=1)
+        np.testing.assert_allclose(kernels.local_geary(self.w, self.z),
+                                   expected)
+
+    def test_blocks(self):
+        """Local Geary of weights read by blocks of any size"""
+        W = self.w.sparse.tocsr()
+        Z = np.column_stack((self.z, self.z**3))
+        for z in (self.z, Z):
+            expected = kernels.local_geary(W, z)
+            for block_size in (1, 3, 7, 16):
+                blocks = BlockCSR(W.indptr, W.indices, W.data,
+                                  block_size=block_size)
+                np.testing.assert_allclose(kernels.local_geary(blocks, z),
+                                           expected)
+
+    def test_local_join_count(self):
+        """Test method"""
+        w = lat2W(4, 4)
+        x = np.ones(16)
+        x[0:8] = 0
+        assert np.array_equal(kernels.local_join_count(w, x),
+                              [0, 0, 0, 0, 0, 0, 0, 0, 2, 3, 3, 2, 2, 3, 3, 2])
+
+    def test_rows(self):
+        """Kernels restricted to a few rows match the full ones"""
+        rows = np.array([1, 6, 15])
+        np.testing.assert_array_equal(
+            kernels.local_geary(self.w, self.z, rows=rows),
+            kernels.local_geary(self.w, self.z)[rows]
+        )
+        x = (self.z > 0).astype('float')
+        np.testing.assert_array_equal(
+            kernels.local_join_count(self.w, x, rows=rows),
+            kernels.local_join_count(self.w, x)[rows]
+        )
+
+    def test_n_jobs(self):
+        """Threaded kernels match the scipy products"""
+        x = (self.z > 0).astype(np.uint8)
+        np.testing.assert_allclose(kernels.local_geary(self.w, self.z, n_jobs=2),
+                                   kernels.local_geary(self.w, self.z))
+        np.testing.assert_array_equal(
+            kernels.local_join_count(self.w, x, n_jobs=-1),
+            kernels.local_join_count(self.w, x)
+        )
+        Z = np.column_stack((self.z, self.z ** 2)).astype('float32')
+        lag = kernels.spatial_lag(self.w, Z, n_jobs=2)
+        self.assertEqual(lag.dtype, np.float32)
+        np.testing.assert_allclose(lag, self.w.sparse @ Z, rtol=1e-6)
+
+    def test_colocation(self):
+        """Packed bits match np.all, also across several bytes"""
+        X = (np.random.random_sample((11, 16)) < 0.9).astype('float')
+        packed = kernels.pack_binary(X)
+        self.assertEqual(packed.shape, (16, 2))
+        np.testing.assert_array_equal(kernels.colocation(packed),
+                                      np.all(X == 1, axis=0))
+        np.testing.assert_array_equal(kernels.colocation(packed[:, :1]),
+                                      np.all(X[:8] == 1, axis=0))
+
+
+suite = unittest.TestSuite()
+test_classes = [
+    Kernels_Tester
+]
+for i in test_classes:
+    a = unittest.TestLoader().loadTestsFromTestCase(i)
+    suite.addTest(a)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
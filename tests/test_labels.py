@@ -0,0 +1,64 @@
+import unittest
+import numpy as np
+import libpysal
+from libpysal.weights.util import lat2W
+
+from ..labels import local_labels
+from ..multiple_testing import threshold
+from ..local_geary import Local_Geary
+from ..local_geary_mv import Local_Geary_MV
+from ..local_join_count import Local_Join_Count
+from ..losh import LOSH
+
+
+class Labels_Tester(unittest.TestCase):
+    """Unit test for the labels and their significance thresholds"""
+    def setUp(self):
+        np.random.seed(10)
+        self.w = libpysal.io.open(libpysal.examples.get_path("stl.gal")).read()
+        f = libpysal.io.open(libpysal.examples.get_path("stl_hom.txt"))
+        self.y = np.array(f.by_col['HR8893'])
+
+    def test_local_labels(self):
+        p = np.array([0.01, 0.01, 0.01, 0.01, 0.5, np.nan])
+        stat = np.array([0., 0., 2., 1., 0., 3.])
+        x = np.array([2., 0., 0., 1., 0., 3.])
+        np.testing.assert_array_equal(local_labels(p, stat=stat, x=x),
+                                      [1, 2, 3, 0, 4, 0])
+        np.testing.assert_array_equal(local_labels(p, stat=stat),
+                                      [2, 2, 3, 0, 4, 0])
+        np.testing.assert_array_equal(local_labels(p), [2, 2, 2, 2, 4, 0])
+        labs = local_labels(np.column_stack((p, p[::-1])))
+        self.assertEqual(labs.dtype, np.uint8)
+        np.testing.assert_array_equal(labs[:, 1], local_labels(p[::-1]))
+
+    def test_estimator_labels(self):
+        lG = Local_Geary(connectivity=self.w, labels=True, seed=12345,
+                         correction='fdr_bh').fit(self.y)
+        cutoff = threshold(lG.p_sim, 0.05, 'fdr_bh')
+        self.assertEqual(lG.labs.dtype, np.uint8)
+        np.testing.assert_array_equal(lG.labs == 4, lG.p_sim > cutoff)
+        lG_mv = Local_Geary_MV(connectivity=self.w, labels=True,
+                               seed=12345).fit([self.y, self.y**2])
+        np.testing.assert_array_equal(lG_mv.labs == 4, lG_mv.p_sim > 0.05)
+        x = (self.y > np.mean(self.y)).astype(int)
+        ljc = Local_Join_Count(connectivity=self.w, labels=True,
+                               seed=12345).fit(x)
+        np.testing.assert_array_equal(ljc.labs == 0, np.isnan(ljc.p_sim))
+        np.testing.assert_array_equal(ljc.labs == 2, ljc.p_sim <= 0.05)
+        ls = LOSH(connectivity=lat2W(5, 5), inference='chi-square',
+                  labels=True).fit(np.random.normal(size=25))
+        np.testing.assert_array_equal(ls.labs == 4, ls.pval > 0.05)
+
+
+suite = unittest.TestSuite()
+test_classes = [
+    Labels_Tester
+]
+for i in test_classes:
+    a = unittest.TestLoader().loadTestsFromTestCase(i)
+    suite.addTest(a)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
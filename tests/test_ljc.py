@@ -20,6 +20,46 @@ class Local_Join_Counts_Tester(unittest.TestCase):
             np.random.seed(12345)
             ljc = Local_Join_Count(connectivity=self.w).fit(self.y)
             assert np.array_equal(ljc.LJC, [0, 0, 0, 0, 0, 0, 0, 0, 2, 3, 3, 2, 2, 3, 3, 2])
+
+    def test_Local_Join_Counts_fit_many(self):
+            """Test method"""
+            np.random.seed(12345)
+            X = np.column_stack((self.y, 1 - self.y))
+            ljc = Local_Join_Count(connectivity=self.w).fit_many(X)
+            assert ljc.LJC.shape == (16, 2)
+            assert np.array_equal(ljc.LJC[:, 0], [0, 0, 0, 0, 0, 0, 0, 0, 2, 3, 3, 2, 2, 3, 3, 2])
+            assert np.array_equal(ljc.LJC[:, 1], [2, 3, 3, 2, 2, 3, 3, 2, 0, 0, 0, 0, 0, 0, 0, 0])
+            assert np.isnan(ljc.p_sim[0, 0]) and np.isnan(ljc.p_sim[8, 1])
+
+    def test_Local_Join_Counts_chunk_size(self):
+            """p-values do not depend on the chunks nor the jobs"""
+            X = np.column_stack((self.y, 1 - self.y))
+            ljc = Local_Join_Count(connectivity=self.w, seed=12345).fit(self.y)
+            ljc_many = Local_Join_Count(connectivity=self.w, seed=12345).fit_many(X)
+            for chunk_size, n_jobs in ((1, 1), (3, 1), (100, 1), (3, 2)):
+                ljc_chunked = Local_Join_Count(connectivity=self.w, seed=12345, chunk_size=chunk_size, n_jobs=n_jobs)
+                np.testing.assert_array_equal(ljc_chunked.fit(self.y).p_sim, ljc.p_sim)
+                ljc_chunked = Local_Join_Count(connectivity=self.w, seed=12345, chunk_size=chunk_size, n_jobs=n_jobs)
+                np.testing.assert_array_equal(ljc_chunked.fit_many(X).p_sim, ljc_many.p_sim)
+
+    def test_Local_Join_Counts_analytic(self):
+            """Exact p-values match many permutations"""
+            ljc = Local_Join_Count(connectivity=self.w, inference='analytic').fit(self.y)
+            ljc_sim = Local_Join_Count(connectivity=self.w, permutations=9999, seed=12345).fit(self.y)
+            assert np.array_equal(ljc.LJC, ljc_sim.LJC)
+            assert not hasattr(ljc, 'p_sim')
+            np.testing.assert_array_almost_equal(ljc.p_analytic, ljc_sim.p_sim, decimal=2)
+
+    def test_Local_Join_Counts_update(self):
+            """Updated join counts match a refit"""
+            y = self.y.copy()
+            y[[5, 9]] = [1, 0]
+            for inference in ('permutation', 'analytic'):
+                ljc = Local_Join_Count(connectivity=self.w, seed=12345, inference=inference).fit(self.y)
+                ljc.update([5, 9], [1, 0])
+                ljc_refit = Local_Join_Count(connectivity=self.w, seed=12345, inference=inference).fit(y)
+                assert np.array_equal(ljc.LJC, ljc_refit.LJC)
+            np.testing.assert_array_equal(ljc.p_analytic, ljc_refit.p_analytic)
             
             
 suite = unittest.TestSuite()
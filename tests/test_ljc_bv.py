@@ -23,7 +23,21 @@ class Local_Join_Counts_BV_Tester(unittest.TestCase):
             ljc_bv_case2 = Local_Join_Count_BV(connectivity=self.w).fit(self.x, self.z, case="CLC")
             assert np.array_equal(ljc_bv_case1.LJC, [0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0])
             assert np.array_equal(ljc_bv_case2.LJC, [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 2, 2, 0, 0, 2, 2])
-            
+
+    def test_Local_Join_Counts_BV_analytic(self):
+            """Exact p-values match many permutations"""
+            for case in ("BJC", "CLC"):
+                ljc_bv = Local_Join_Count_BV(connectivity=self.w, inference='analytic').fit(self.x, self.z, case=case)
+                ljc_bv_sim = Local_Join_Count_BV(connectivity=self.w, permutations=9999, seed=12345).fit(self.x, self.z, case=case)
+                np.testing.assert_array_almost_equal(ljc_bv.p_analytic, ljc_bv_sim.p_sim, decimal=2)
+
+    def test_Local_Join_Counts_BV_chunk_size(self):
+            """p-values do not depend on the chunks nor the jobs"""
+            for case in ("BJC", "CLC"):
+                ljc_bv = Local_Join_Count_BV(connectivity=self.w, seed=12345).fit(self.x, self.z, case=case)
+                for chunk_size, n_jobs in ((1, 1), (3, 1), (100, 1), (3, 2)):
+                    ljc_bv_chunked = Local_Join_Count_BV(connectivity=self.w, seed=12345, chunk_size=chunk_size, n_jobs=n_jobs).fit(self.x, self.z, case=case)
+                    np.testing.assert_array_equal(ljc_bv_chunked.p_sim, ljc_bv.p_sim)
 
 suite = unittest.TestSuite()
 test_classes = [
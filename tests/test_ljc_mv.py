@@ -1,10 +1,12 @@
 # based off: https://github.com/pysal/esda/blob/master/tests/test_join_counts.py
 import unittest
+from unittest import mock
 import numpy as np
 from libpysal.weights.util import lat2W
 from libpysal.common import pandas
 
 from ..local_join_count_mv import Local_Join_Count_MV
+from .. import kernels
 
 PANDAS_EXTINCT = pandas is None
 
@@ -23,6 +25,50 @@ class Local_Join_Counts_MV_Tester(unittest.TestCase):
             np.random.seed(12345)
             ljc_mv = Local_Join_Count_MV(connectivity=self.w).fit([self.x, self.y, self.z])
             assert np.array_equal(ljc_mv.LJC, [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 1, 2])
+            assert ljc_mv.rjoins.shape == (16, 999)
+
+    def test_Local_Join_Counts_MV_no_simulations(self):
+            """Simulations are only stored when requested"""
+            ljc_mv = Local_Join_Count_MV(connectivity=self.w, keep_simulations=False).fit([self.x, self.y, self.z])
+            assert not hasattr(ljc_mv, 'rjoins')
+            assert np.isnan(ljc_mv.p_sim[0])
+
+    def test_Local_Join_Counts_MV_analytic(self):
+            """Exact p-values match many permutations"""
+            ljc_mv = Local_Join_Count_MV(connectivity=self.w, inference='analytic').fit([self.x, self.y, self.z])
+            ljc_mv_sim = Local_Join_Count_MV(connectivity=self.w, permutations=9999, seed=12345).fit([self.x, self.y, self.z])
+            np.testing.assert_array_almost_equal(ljc_mv.p_analytic, ljc_mv_sim.p_sim, decimal=2)
+
+    def test_Local_Join_Counts_MV_early_stopping(self):
+            """Significance is decided as with all permutations"""
+            ljc_mv = Local_Join_Count_MV(connectivity=self.w, seed=12345).fit([self.x, self.y, self.z])
+            ljc_mv_es = Local_Join_Count_MV(connectivity=self.w, seed=12345, early_stopping=0.1).fit([self.x, self.y, self.z])
+            np.testing.assert_array_equal(ljc_mv.p_sim <= 0.1, ljc_mv_es.p_sim <= 0.1)
+            assert ljc_mv_es.n_permutations.shape == (16,)
+
+    def test_Local_Join_Counts_MV_chunk_size(self):
+            """p-values do not depend on the chunks nor the jobs"""
+            variables = [self.x, self.y, self.z]
+            ljc_mv = Local_Join_Count_MV(connectivity=self.w, seed=12345).fit(variables)
+            for chunk_size, n_jobs in ((1, 1), (3, 1), (100, 1), (3, 2)):
+                ljc_mv_chunked = Local_Join_Count_MV(connectivity=self.w, seed=12345, chunk_size=chunk_size, n_jobs=n_jobs).fit(variables)
+                np.testing.assert_array_equal(ljc_mv_chunked.p_sim, ljc_mv.p_sim)
+
+    def test_Local_Join_Counts_MV_packed(self):
+            """Bit-packed and uint8 inputs give the same results"""
+            variables = [self.x, self.y, self.z]
+            ljc_mv = Local_Join_Count_MV(connectivity=self.w, seed=12345).fit(variables)
+            packed = kernels.pack_binary(variables)
+            assert packed.shape == (16, 1)
+            ljc_mv_packed = Local_Join_Count_MV(connectivity=self.w, seed=12345).fit(packed, packed=True)
+            ljc_mv_uint8 = Local_Join_Count_MV(connectivity=self.w, seed=12345).fit(np.array(variables, dtype=np.uint8))
+            for other in (ljc_mv_packed, ljc_mv_uint8):
+                np.testing.assert_array_equal(ljc_mv.LJC, other.LJC)
+                np.testing.assert_array_equal(ljc_mv.p_sim, other.p_sim)
+            # the co-location of the packed variables is found once
+            with mock.patch.object(kernels, 'colocation', wraps=kernels.colocation) as colocation:
+                Local_Join_Count_MV(connectivity=self.w, seed=12345).fit(variables)
+            assert colocation.call_count == 1
             
 suite = unittest.TestSuite()
 test_classes = [
@@ -19,6 +19,75 @@ class Local_Geary_Tester(unittest.TestCase):
         lG = Local_Geary(connectivity=self.w).fit(self.y)
         self.assertAlmostEqual(lG.localG[0], 0.696703432)
         self.assertAlmostEqual(lG.p_sim[0], 0.19)
+
+    def test_local_geary_fit_many(self):
+        X = np.column_stack((self.y, self.y**2))
+        lG_many = Local_Geary(connectivity=self.w).fit_many(X)
+        np.random.seed(10)
+        lG = Local_Geary(connectivity=self.w).fit(self.y**2)
+        self.assertEqual(lG_many.localG.shape, (78, 2))
+        self.assertAlmostEqual(lG_many.localG[0, 0], 0.696703432)
+        self.assertAlmostEqual(lG_many.p_sim[0, 0], 0.19)
+        np.testing.assert_array_equal(lG_many.localG[:, 1], lG.localG)
+
+    def test_local_geary_update(self):
+        ids = [self.w.id_order[3], self.w.id_order[40]]
+        y = self.y.copy()
+        y[[3, 40]] = [3.0, 2.0]
+        lG = Local_Geary(connectivity=self.w, seed=12345).fit(self.y)
+        lG.update(ids, [3.0, 2.0])
+        lG_refit = Local_Geary(connectivity=self.w, seed=12345).fit(y)
+        np.testing.assert_allclose(lG.localG, lG_refit.localG)
+        # p-values of the changed units and their neighbors are exact
+        neighbors = [self.w.id2i[j] for j in self.w.neighbors[ids[0]]]
+        for i in [3, 40] + neighbors:
+            self.assertEqual(lG.p_sim[i], lG_refit.p_sim[i])
+
+    def test_local_geary_early_stopping(self):
+        lG = Local_Geary(connectivity=self.w, seed=12345).fit(self.y)
+        lG_es = Local_Geary(connectivity=self.w, seed=12345,
+                            early_stopping=0.05).fit(self.y)
+        # significance at 0.05 is decided as with all permutations
+        np.testing.assert_array_equal(lG.p_sim <= 0.05, lG_es.p_sim <= 0.05)
+        self.assertTrue((lG_es.n_permutations < 999).any())
+        full = lG_es.n_permutations == 999
+        np.testing.assert_array_equal(lG.p_sim[full], lG_es.p_sim[full])
+        self.assertTrue(np.isnan(lG_es.rlocalG[~full, -1]).all())
+        # stopped units are marked, and only decided at 0.05
+        np.testing.assert_array_equal(lG_es.stopped, ~full)
+        self.assertTrue((lG_es.p_sim[lG_es.stopped] > 0.05).all())
+        self.assertTrue((lG.p_sim[lG_es.stopped] > 0.05).all())
+
+    def test_local_geary_chunk_size(self):
+        """p-values do not depend on the chunks nor the jobs"""
+        lG = Local_Geary(connectivity=self.w, seed=12345).fit(self.y)
+        X = np.column_stack((self.y, self.y**2))
+        lG_many = Local_Geary(connectivity=self.w, seed=12345).fit_many(X)
+        lG_es = Local_Geary(connectivity=self.w, seed=12345,
+                            early_stopping=0.05).fit(self.y)
+        for chunk_size, n_jobs in ((1, 1), (7, 1), (100, 1), (7, 2)):
+            kwargs = dict(connectivity=self.w, seed=12345,
+                          chunk_size=chunk_size, n_jobs=n_jobs)
+            np.testing.assert_array_equal(
+                Local_Geary(**kwargs).fit(self.y).p_sim, lG.p_sim
+            )
+            np.testing.assert_array_equal(
+                Local_Geary(**kwargs).fit_many(X).p_sim, lG_many.p_sim
+            )
+            np.testing.assert_array_equal(
+                Local_Geary(early_stopping=0.05, **kwargs).fit(self.y).p_sim,
+                lG_es.p_sim
+            )
+
+    def test_local_geary_float32(self):
+        lG = Local_Geary(connectivity=self.w, seed=12345).fit(self.y)
+        lG_32 = Local_Geary(connectivity=self.w, seed=12345,
+                            dtype='float32').fit(self.y)
+        self.assertEqual(lG_32.localG.dtype, np.float32)
+        self.assertEqual(lG_32.rlocalG.dtype, np.float32)
+        np.testing.assert_allclose(lG_32.localG, lG.localG, rtol=1e-5)
+        # draws within rounding of the observed value may flip
+        np.testing.assert_allclose(lG_32.p_sim, lG.p_sim, atol=0.005)
         
 suite = unittest.TestSuite()
 test_classes = [
@@ -1,3 +1,5 @@
+import shutil
+import tempfile
 import unittest
 import libpysal
 from libpysal.common import pandas, RTOL, ATOL
@@ -7,6 +9,7 @@ import numpy as np
 PANDAS_EXTINCT = pandas is None
 
 from ..local_geary_mv import Local_Geary_MV
+from ..prepared_weights import PreparedWeights
 
 class Local_Geary_MV_Tester(unittest.TestCase):
     def setUp(self):
@@ -18,9 +21,44 @@ class Local_Geary_MV_Tester(unittest.TestCase):
 
     def test_local_geary_mv(self):
         lG_mv = Local_Geary_MV(connectivity=self.w).fit([self.y1, self.y2])
-        print(lG_mv.p_sim[0])
         self.assertAlmostEqual(lG_mv.localG[0], 0.4096931479581422)
-        self.assertAlmostEqual(lG_mv.p_sim[0], 0.211)
+        self.assertAlmostEqual(lG_mv.p_sim[0], 0.208)
+        # the weights are not kept on the fitted estimator
+        self.assertFalse(hasattr(lG_mv, 'w'))
+
+    def test_local_geary_mv_n_jobs(self):
+        lG_mv = Local_Geary_MV(connectivity=self.w, seed=12345,
+                               keep_simulations=False).fit([self.y1, self.y2])
+        lG_mv_par = Local_Geary_MV(connectivity=self.w, seed=12345,
+                                   n_jobs=2).fit([self.y1, self.y2])
+        np.testing.assert_array_equal(lG_mv.p_sim, lG_mv_par.p_sim)
+        self.assertFalse(hasattr(lG_mv, 'rlocalG'))
+        self.assertEqual(lG_mv_par.rlocalG.shape, (78, 999))
+
+    def test_local_geary_mv_float32(self):
+        lG_mv = Local_Geary_MV(connectivity=self.w,
+                               seed=12345).fit([self.y1, self.y2])
+        lG_mv_32 = Local_Geary_MV(connectivity=self.w, seed=12345,
+                                  dtype='float32').fit([self.y1, self.y2])
+        self.assertEqual(lG_mv_32.localG.dtype, np.float32)
+        self.assertEqual(lG_mv_32.rlocalG.dtype, np.float32)
+        np.testing.assert_allclose(lG_mv_32.localG, lG_mv.localG, rtol=1e-5)
+        np.testing.assert_allclose(lG_mv_32.p_sim, lG_mv.p_sim, atol=0.005)
+
+    def test_local_geary_mv_memory_mapped(self):
+        path = tempfile.mkdtemp()
+        try:
+            PreparedWeights(self.w).to_npy(path)
+            w_mm = PreparedWeights.from_npy(path, block_size=10)
+            lG_mv = Local_Geary_MV(connectivity=self.w,
+                                   seed=12345).fit([self.y1, self.y2])
+            lG_mv_mm = Local_Geary_MV(connectivity=w_mm,
+                                      seed=12345).fit([self.y1, self.y2])
+            np.testing.assert_array_equal(lG_mv.localG, lG_mv_mm.localG)
+            np.testing.assert_array_equal(lG_mv.p_sim, lG_mv_mm.p_sim)
+            del w_mm, lG_mv_mm
+        finally:
+            shutil.rmtree(path)
         
 suite = unittest.TestSuite()
 test_classes = [
@@ -0,0 +1,104 @@
+import unittest
+import numpy as np
+import libpysal
+from libpysal.weights.util import lat2W
+
+from ..local_null import LocalPool
+from ..permutation_pool import PermutationPool
+from ..local_geary import Local_Geary
+from ..local_join_count import Local_Join_Count
+from ..local_join_count_bv import Local_Join_Count_BV
+from ..local_join_count_mv import Local_Join_Count_MV
+
+
+class LocalNull_Tester(unittest.TestCase):
+    """Unit test for the spatially-constrained null"""
+    def setUp(self):
+        self.w = libpysal.io.open(libpysal.examples.get_path("stl.gal")).read()
+        f = libpysal.io.open(libpysal.examples.get_path("stl_hom.txt"))
+        self.y = np.array(f.by_col['HR8893'])
+        self.x = (self.y > np.mean(self.y)).astype(int)
+
+    def test_local_pool(self):
+        pool = LocalPool(lat2W(3, 3), order=2, reorder=False)
+        # corner, edge and center of a 3x3 rook lattice
+        np.testing.assert_array_equal(pool.cardinalities[[0, 1, 4]],
+                                      [5, 6, 8])
+        np.testing.assert_array_equal(pool.indices[:5], [1, 2, 3, 4, 6])
+        pool = LocalPool(self.w, order=2)
+        np.testing.assert_array_equal(np.sort(pool.order), np.arange(78))
+        np.testing.assert_array_equal(pool.order[pool.inverse],
+                                      np.arange(78))
+
+    def test_local_geary(self):
+        """Results do not depend on the order nor the chunks"""
+        lG = Local_Geary(connectivity=self.w, seed=12345,
+                         local_pool=2).fit(self.y)
+        unordered = LocalPool(self.w, order=2, reorder=False)
+        lG_unordered = Local_Geary(connectivity=self.w, seed=12345,
+                                   local_pool=unordered).fit(self.y)
+        np.testing.assert_array_equal(lG.p_sim, lG_unordered.p_sim)
+        np.testing.assert_array_equal(lG.rlocalG, lG_unordered.rlocalG)
+        full = Local_Geary(connectivity=self.w, seed=12345).fit(self.y)
+        np.testing.assert_array_equal(lG.localG, full.localG)
+        self.assertFalse(np.array_equal(lG.p_sim, full.p_sim))
+        y = self.y.copy()
+        y[0] = y[0] * 2
+        lG.update([self.w.id_order[0]], [y[0]])
+        refit = Local_Geary(connectivity=self.w, seed=12345,
+                            local_pool=unordered).fit(y)
+        changed = np.flatnonzero(lG.p_sim != lG_unordered.p_sim)
+        self.assertTrue(changed.size)
+        np.testing.assert_array_equal(lG.p_sim[changed],
+                                      refit.p_sim[changed])
+        with self.assertRaises(NotImplementedError):
+            Local_Geary(connectivity=self.w, local_pool=2,
+                        early_stopping=0.05).fit(self.y)
+        with self.assertRaises(NotImplementedError):
+            Local_Geary(connectivity=self.w,
+                        local_pool=2).fit_many(np.column_stack((y, y)))
+        with self.assertRaises(ValueError):
+            Local_Geary(connectivity=self.w, local_pool=2).fit(
+                self.y, pool=PermutationPool.from_weights(self.w)
+            )
+
+    def test_local_join_counts(self):
+        ljc = Local_Join_Count(connectivity=self.w, seed=12345,
+                               local_pool=2).fit(self.x)
+        np.testing.assert_array_equal(np.isnan(ljc.p_sim), ljc.LJC == 0)
+        # the random neighbors are among the candidates, so a unit
+        # whose candidates are all ones always has all of its joins
+        pool = LocalPool(self.w, order=1, reorder=False)
+        ljc_first = Local_Join_Count(connectivity=self.w, seed=12345,
+                                     local_pool=pool).fit(self.x)
+        cardinalities = np.asarray(
+            [len(self.w.neighbors[i]) for i in self.w.id_order]
+        )
+        full = ljc_first.LJC == cardinalities
+        np.testing.assert_array_equal(ljc_first.rjoins[full],
+                                      np.repeat(ljc_first.LJC[full, None],
+                                                999, axis=1))
+        Local_Join_Count_BV(connectivity=self.w, seed=12345,
+                            local_pool=2).fit(self.x, 1 - self.x)
+        Local_Join_Count_MV(connectivity=self.w, seed=12345,
+                            local_pool=2).fit([self.x, self.x])
+        with self.assertRaises(ValueError):
+            Local_Join_Count(connectivity=self.w,
+                             local_pool=LocalPool(lat2W(1, 78))).fit(self.x)
+        with self.assertRaises(NotImplementedError):
+            Local_Join_Count(connectivity=self.w, local_pool=2).fit_many(
+                np.column_stack((self.x, 1 - self.x))
+            )
+
+
+suite = unittest.TestSuite()
+test_classes = [
+    LocalNull_Tester
+]
+for i in test_classes:
+    a = unittest.TestLoader().loadTestsFromTestCase(i)
+    suite.addTest(a)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
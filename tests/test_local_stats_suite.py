@@ -0,0 +1,70 @@
+import unittest
+import libpysal
+import numpy as np
+
+from ..local_stats_suite import LocalStatsSuite
+from ..local_geary import Local_Geary
+from ..local_join_count import Local_Join_Count
+from ..losh import LOSH
+
+
+class LocalStatsSuite_Tester(unittest.TestCase):
+    def setUp(self):
+        self.w = libpysal.io.open(libpysal.examples.get_path("stl.gal")).read()
+        f = libpysal.io.open(libpysal.examples.get_path("stl_hom.txt"))
+        self.y = np.array(f.by_col['HR8893'])
+        self.threshold = self.y.mean()
+
+    def test_local_stats_suite(self):
+        suite = LocalStatsSuite(connectivity=self.w, threshold=self.threshold,
+                                seed=12345).fit(self.y)
+        lG = Local_Geary(connectivity=self.w, seed=12345).fit(self.y)
+        ls = LOSH(connectivity=self.w, inference='permutation',
+                  seed=12345).fit(self.y)
+        ljc = Local_Join_Count(connectivity=self.w, seed=12345).fit(
+            (self.y > self.threshold).astype('float')
+        )
+        self.assertEqual(suite.p_sim.shape, (78, 3))
+        self.assertEqual(suite.rlocals.shape, (78, 999, 3))
+        np.testing.assert_allclose(suite.localG, lG.localG)
+        np.testing.assert_allclose(suite.Hi, ls.Hi)
+        np.testing.assert_allclose(suite.VarHi, ls.VarHi)
+        np.testing.assert_array_equal(suite.LJC, ljc.LJC)
+        # the same permuted neighbors as the individual estimators
+        np.testing.assert_array_equal(suite.p_sim[:, 0], lG.p_sim)
+        np.testing.assert_array_equal(suite.p_sim[:, 1], ls.pval)
+        np.testing.assert_array_equal(suite.p_sim[:, 2], ljc.p_sim)
+
+    def test_local_stats_suite_subset(self):
+        suite = LocalStatsSuite(connectivity=self.w,
+                                statistics=('LOSH', 'Local_Geary'),
+                                seed=12345, n_jobs=2).fit(self.y)
+        lG = Local_Geary(connectivity=self.w, seed=12345).fit(self.y)
+        self.assertFalse(hasattr(suite, 'LJC'))
+        np.testing.assert_array_equal(suite.p_sim[:, 1], lG.p_sim)
+        with self.assertRaises(NotImplementedError):
+            LocalStatsSuite(connectivity=self.w,
+                            statistics=('Moran',)).fit(self.y)
+
+    def test_local_stats_suite_default_a(self):
+        """a=None is the LOSH default of 2"""
+        suite = LocalStatsSuite(connectivity=self.w, statistics=('LOSH',),
+                                a=None, seed=12345).fit(self.y)
+        ls = LOSH(connectivity=self.w, inference='permutation', a=None,
+                  seed=12345).fit(self.y)
+        np.testing.assert_allclose(suite.Hi, ls.Hi)
+        np.testing.assert_allclose(suite.VarHi, ls.VarHi)
+        np.testing.assert_array_equal(suite.p_sim[:, 0], ls.pval)
+
+
+suite = unittest.TestSuite()
+test_classes = [
+    LocalStatsSuite_Tester
+]
+for i in test_classes:
+    a = unittest.TestLoader().loadTestsFromTestCase(i)
+    suite.addTest(a)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
@@ -1,4 +1,5 @@
 # based off: https://github.com/pysal/esda/blob/master/tests/test_moran.py#L96
+import os
 import unittest
 import libpysal
 from libpysal.common import pandas, RTOL, ATOL
@@ -7,6 +8,17 @@ import numpy as np
 
 PANDAS_EXTINCT = pandas is None
 
+try:
+    import geopandas
+except ImportError:
+    geopandas = None
+
+# Denver neighborhoods, with the LOSH of spdep on their rented units
+DATA = os.path.join(os.path.dirname(__file__), '..', 'validation', 'data')
+DENVER_EXTINCT = geopandas is None or not os.path.exists(
+    os.path.join(DATA, 'spdep_denver_losh.csv')
+)
+
 from ..losh import LOSH
 
 class Losh_Tester(unittest.TestCase):
@@ -20,6 +32,77 @@ class Losh_Tester(unittest.TestCase):
         ls = LOSH(connectivity=self.w, inference="chi-square").fit(self.y)
         self.assertAlmostEqual(ls.Hi[0], 0.77613471)
         self.assertAlmostEqual(ls.pval[0], 0.22802201)
+
+    def test_losh_permutation(self):
+        ls = LOSH(connectivity=self.w, inference="permutation", a=1,
+                  seed=12345).fit(self.y)
+        self.assertAlmostEqual(ls.Hi[0], 1.36397010)
+        self.assertAlmostEqual(ls.pval[0], 0.156)
+        self.assertEqual(ls.rHi.shape, (78, 999))
+
+    def test_losh_fit_many(self):
+        X = np.column_stack((self.y, self.y ** 2))
+        ls = LOSH(connectivity=self.w, inference="chi-square")
+        with self.assertWarns(UserWarning):
+            ls.fit_many(X, a=[1, 2])
+        self.assertEqual(ls.Hi.shape, (78, 2, 2))
+        ls_2 = LOSH(connectivity=self.w, inference="chi-square").fit(self.y)
+        np.testing.assert_allclose(ls.Hi[:, 0, 1], ls_2.Hi)
+        np.testing.assert_allclose(ls.pval[:, 0, 1], ls_2.pval)
+        self.assertTrue(np.isnan(ls.pval[:, :, 0]).all())
+
+    def test_losh_log_pval(self):
+        # With 2 degrees of freedom, log(pval) = -Zi/2
+        Hi = np.array([1.0, 50.0, 1000.0])
+        pval, log_pval = LOSH._chi_square(Hi, np.ones(3))
+        np.testing.assert_allclose(pval[:2], np.exp(-Hi[:2]))
+        self.assertEqual(pval[2], 0)
+        np.testing.assert_allclose(log_pval, -Hi)
+
+    def test_losh_float32(self):
+        ls = LOSH(connectivity=self.w, inference="chi-square").fit(self.y)
+        ls_32 = LOSH(connectivity=self.w, inference="chi-square",
+                     dtype='float32').fit(self.y)
+        self.assertEqual(ls_32.Hi.dtype, np.float32)
+        np.testing.assert_allclose(ls_32.Hi, ls.Hi, rtol=1e-5)
+        np.testing.assert_allclose(ls_32.pval, ls.pval, atol=1e-5)
+        ls = LOSH(connectivity=self.w, inference="permutation",
+                  seed=12345).fit(self.y)
+        ls_32 = LOSH(connectivity=self.w, inference="permutation",
+                     seed=12345, dtype='float32').fit(self.y)
+        self.assertEqual(ls_32.rHi.dtype, np.float32)
+        np.testing.assert_allclose(ls_32.pval, ls.pval, atol=0.005)
+
+    @unittest.skipIf(DENVER_EXTINCT, 'geopandas or validation data missing')
+    def test_losh_float32_denver(self):
+        """float32 and float64 both match spdep on the Denver data"""
+        denver = geopandas.read_file(os.path.join(DATA, 'denver',
+                                                  'denver.gpkg'))
+        spdep = pandas.read_csv(os.path.join(DATA, 'spdep_denver_losh.csv'))
+        # spdep's poly2nb neighbors are queen contiguity
+        w = libpysal.weights.Queen.from_dataframe(denver, use_index=False)
+        y = denver['HU_RENTED'].values
+        ls = LOSH(connectivity=w, inference="chi-square").fit(y)
+        ls_32 = LOSH(connectivity=w, inference="chi-square",
+                     dtype='float32').fit(y)
+        self.assertEqual(ls_32.Hi.dtype, np.float32)
+        np.testing.assert_allclose(ls.Hi, spdep['Hi'], rtol=1e-10)
+        np.testing.assert_allclose(ls.VarHi, spdep['Var.Hi'], rtol=1e-10)
+        np.testing.assert_allclose(ls.pval, spdep['Pr()'], rtol=1e-10)
+        np.testing.assert_allclose(ls_32.Hi, spdep['Hi'], rtol=1e-5)
+        np.testing.assert_allclose(ls_32.VarHi, spdep['Var.Hi'], rtol=1e-5)
+        np.testing.assert_allclose(ls_32.pval, spdep['Pr()'], atol=1e-5)
+
+    def test_losh_update(self):
+        ids = [self.w.id_order[3], self.w.id_order[40]]
+        y = self.y.copy()
+        y[[3, 40]] = [3.0, 2.0]
+        ls = LOSH(connectivity=self.w, inference="chi-square").fit(self.y)
+        ls.update(ids, [3.0, 2.0])
+        ls_refit = LOSH(connectivity=self.w, inference="chi-square").fit(y)
+        for attr in ('Hi', 'ylag', 'yresid', 'VarHi', 'pval'):
+            np.testing.assert_allclose(getattr(ls, attr),
+                                       getattr(ls_refit, attr))
         
 suite = unittest.TestSuite()
 test_classes = [
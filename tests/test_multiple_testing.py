@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import libpysal
+
+from ..multiple_testing import threshold, adjust
+from ..local_geary import Local_Geary
+from ..local_join_count import Local_Join_Count
+from ..losh import LOSH
+
+
+def _bh(p):
+    # Reference Benjamini-Hochberg adjustment, by sorting
+    tested = np.flatnonzero(~np.isnan(p))
+    order = tested[np.argsort(p[tested])]
+    m = order.size
+    adjusted = p[order] * m / np.arange(1, m + 1)
+    adjusted = np.minimum(np.minimum.accumulate(adjusted[::-1])[::-1], 1)
+    q = np.full(p.shape, np.nan)
+    q[order] = adjusted
+    return q
+
+
+class Multiple_Testing_Tester(unittest.TestCase):
+    """Unit test for the multiple testing corrections"""
+    def setUp(self):
+        np.random.seed(10)
+        self.p = np.round(np.random.uniform(size=200)**2, 3)
+        self.p[::7] = np.nan
+
+    def test_threshold(self):
+        p = np.array([0.01, 0.04, 0.03, np.nan, 0.001, 0.5])
+        self.assertEqual(threshold(p, 0.05), 0.05)
+        self.assertEqual(threshold(p, 0.05, 'bonferroni'), 0.01)
+        # largest p_(k) <= 0.05 k / 5, and 0.05 k / (5 * 2.283)
+        self.assertEqual(threshold(p, 0.05, 'fdr_bh'), 0.04)
+        self.assertEqual(threshold(p, 0.05, 'fdr_by'), 0.001)
+        self.assertEqual(threshold([0.9, 0.8], 0.05, 'fdr_bh'), -np.inf)
+        with self.assertRaises(NotImplementedError):
+            threshold(p, 0.05, 'holm')
+
+    def test_adjust(self):
+        """Adjusted p-values, with ties and NaN, agree with thresholds"""
+        m = np.sum(~np.isnan(self.p))
+        np.testing.assert_allclose(adjust(self.p), _bh(self.p))
+        np.testing.assert_allclose(adjust(self.p, 'bonferroni'),
+                                   np.minimum(self.p * m, 1))
+        np.testing.assert_allclose(
+            adjust(self.p, 'fdr_by'),
+            np.minimum(_bh(self.p) * np.sum(1 / np.arange(1, m + 1)), 1)
+        )
+        for correction in ('bonferroni', 'fdr_bh', 'fdr_by'):
+            np.testing.assert_array_equal(
+                adjust(self.p, correction) <= 0.05,
+                self.p <= threshold(self.p, 0.05, correction)
+            )
+        np.testing.assert_allclose(adjust(self.p.reshape(20, 10)),
+                                   _bh(self.p).reshape(20, 10))
+
+    def test_adjust_chunked(self):
+        """Memory-mapped p-values adjusted by chunks"""
+        path = tempfile.mkdtemp()
+        try:
+            p = np.lib.format.open_memmap(os.path.join(path, 'p.npy'),
+                                          mode='w+', shape=self.p.shape)
+            p[:] = self.p
+            out = np.lib.format.open_memmap(os.path.join(path, 'q.npy'),
+                                            mode='w+', shape=self.p.shape)
+            for correction in ('bonferroni', 'fdr_bh', 'fdr_by'):
+                self.assertIs(adjust(p, correction, chunk_size=32, out=out),
+                              out)
+                np.testing.assert_allclose(out, adjust(self.p, correction))
+            del p, out
+        finally:
+            shutil.rmtree(path)
+
+    def test_fit_adjust(self):
+        w = libpysal.io.open(libpysal.examples.get_path("stl.gal")).read()
+        f = libpysal.io.open(libpysal.examples.get_path("stl_hom.txt"))
+        y = np.array(f.by_col['HR8893'])
+        lG = Local_Geary(connectivity=w, seed=12345, labels=True,
+                         correction='fdr_bh').fit(y)
+        np.testing.assert_allclose(lG.p_adjusted, _bh(lG.p_sim))
+        np.testing.assert_array_equal(lG.labs == 4, lG.p_adjusted > 0.05)
+        lG.update([w.id_order[0]], [y[0] * 2])
+        np.testing.assert_allclose(lG.p_adjusted, _bh(lG.p_sim))
+        np.testing.assert_array_equal(lG.labs == 4, lG.p_adjusted > 0.05)
+        X = np.column_stack((y, y**2))
+        lG_many = Local_Geary(connectivity=w, seed=12345, labels=True,
+                              correction='fdr_bh').fit_many(X)
+        for j in range(2):
+            np.testing.assert_allclose(lG_many.p_adjusted[:, j],
+                                       _bh(lG_many.p_sim[:, j]))
+        x = (y > y.mean()).astype(int)
+        ljc = Local_Join_Count(connectivity=w, seed=12345, labels=True,
+                               correction='fdr_by').fit(x)
+        np.testing.assert_array_equal(np.isnan(ljc.p_adjusted),
+                                      np.isnan(ljc.p_sim))
+        np.testing.assert_array_equal(ljc.labs == 2, ljc.p_adjusted <= 0.05)
+        ljc_many = Local_Join_Count(connectivity=w, seed=12345,
+                                    correction='fdr_by').fit_many(
+            np.column_stack((x, 1 - x))
+        )
+        np.testing.assert_allclose(ljc_many.p_adjusted[:, 0],
+                                   ljc.p_adjusted)
+        ls = LOSH(connectivity=w, inference='chi-square',
+                  correction='bonferroni').fit(y)
+        np.testing.assert_allclose(ls.p_adjusted, np.minimum(ls.pval * 78, 1))
+        self.assertFalse(hasattr(LOSH(connectivity=w,
+                                      inference='chi-square').fit(y),
+                                 'p_adjusted'))
+
+suite = unittest.TestSuite()
+test_classes = [
+    Multiple_Testing_Tester
+]
+for i in test_classes:
+    a = unittest.TestLoader().loadTestsFromTestCase(i)
+    suite.addTest(a)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import libpysal
+
+from ..permutation_pool import PermutationPool
+from ..local_geary import Local_Geary
+from ..local_geary_mv import Local_Geary_MV
+from ..local_join_count import Local_Join_Count
+from ..losh import LOSH
+
+
+class PermutationPool_Tester(unittest.TestCase):
+    """Unit test for the reusable permuted neighbor ids"""
+    def setUp(self):
+        self.w = libpysal.io.open(libpysal.examples.get_path("stl.gal")).read()
+        f = libpysal.io.open(libpysal.examples.get_path("stl_hom.txt"))
+        self.y = np.array(f.by_col['HR8893'])
+
+    def test_seed(self):
+        """A pool drawn for the fit randomises as its seed does"""
+        pool = PermutationPool.from_weights(self.w, 99, seed=12345)
+        self.assertEqual(pool.permuted_ids.shape, (99, 9))
+        lG = Local_Geary(connectivity=self.w, permutations=99,
+                         seed=12345).fit(self.y)
+        lG_pool = Local_Geary(connectivity=self.w,
+                              permutations=99).fit(self.y, pool=pool)
+        np.testing.assert_array_equal(lG_pool.p_sim, lG.p_sim)
+        x = (self.y > self.y.mean()).astype(int)
+        ljc = Local_Join_Count(connectivity=self.w, permutations=99,
+                               seed=12345).fit(x)
+        ljc_pool = Local_Join_Count(connectivity=self.w,
+                                    permutations=99).fit(x, pool=pool)
+        np.testing.assert_array_equal(ljc_pool.p_sim, ljc.p_sim)
+        X = np.column_stack((self.y, self.y**2))
+        lG_many = Local_Geary(connectivity=self.w,
+                              permutations=99).fit_many(X, pool=pool)
+        np.testing.assert_array_equal(lG_many.p_sim[:, 0], lG.p_sim)
+        ljc_many = Local_Join_Count(connectivity=self.w,
+                                    permutations=99).fit_many(
+            np.column_stack((x, 1 - x)), pool=pool
+        )
+        np.testing.assert_array_equal(ljc_many.p_sim[:, 0], ljc.p_sim)
+
+    def test_reuse(self):
+        """A memory-mapped pool is shared by fits and updates"""
+        path = tempfile.mkdtemp()
+        try:
+            PermutationPool.from_weights(self.w, 199, seed=1).to_npy(path)
+            pool = PermutationPool.from_npy(path)
+            self.assertIsInstance(pool.permuted_ids, np.memmap)
+            self.assertEqual((pool.n, pool.seed), (78, 1))
+            lG = Local_Geary(connectivity=self.w, permutations=99)
+            p_sim = lG.fit(self.y, pool=pool).p_sim
+            np.testing.assert_array_equal(
+                Local_Geary(connectivity=self.w,
+                            permutations=99).fit(self.y, pool=pool).p_sim,
+                p_sim
+            )
+            y = self.y.copy()
+            y[0] = y[0] * 2
+            lG.update([self.w.id_order[0]], [y[0]])
+            refit = Local_Geary(connectivity=self.w,
+                                permutations=99).fit(y, pool=pool)
+            changed = np.flatnonzero(lG.p_sim != p_sim)
+            np.testing.assert_array_equal(lG.p_sim[changed],
+                                          refit.p_sim[changed])
+            Local_Geary_MV(connectivity=self.w, permutations=199).fit(
+                [self.y, self.y**2], pool=pool
+            )
+            LOSH(connectivity=self.w, inference='permutation',
+                 permutations=50).fit(self.y, pool=pool)
+            del pool, lG
+        finally:
+            shutil.rmtree(path)
+
+    def test_take(self):
+        pool = PermutationPool(78, 99, 10, seed=1)
+        self.assertEqual(pool.take(78, 50, 4).shape, (50, 4))
+        with self.assertRaises(ValueError):
+            pool.take(77, 50, 4)
+        with self.assertRaises(ValueError):
+            pool.take(78, 100, 4)
+        with self.assertRaises(ValueError):
+            Local_Geary(connectivity=self.w,
+                        permutations=999).fit(self.y, pool=pool)
+
+
+suite = unittest.TestSuite()
+test_classes = [
+    PermutationPool_Tester
+]
+for i in test_classes:
+    a = unittest.TestLoader().loadTestsFromTestCase(i)
+    suite.addTest(a)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import libpysal
+from libpysal import weights
+from libpysal.weights.util import lat2W
+
+from ..prepared_weights import PreparedWeights, BlockCSR
+from ..local_geary import Local_Geary
+
+
+class PreparedWeights_Tester(unittest.TestCase):
+    """Unit test for the prepared weights cache"""
+    def setUp(self):
+        self.w = lat2W(4, 4, rook=False)
+
+    def test_prepared_weights(self):
+        """Sparse forms match the transformed W, which is left as is"""
+        pw = PreparedWeights.from_w(self.w)
+        wb = weights.util.fill_diagonal(self.w, val=0)
+        wb.transform = 'b'
+        wr = lat2W(4, 4, rook=False)
+        wr.transform = 'r'
+        np.testing.assert_array_equal(pw.binary.toarray(),
+                                      wb.sparse.toarray())
+        np.testing.assert_array_equal(pw.row_standardized.toarray(),
+                                      wr.sparse.toarray())
+        np.testing.assert_array_equal(pw.cardinalities,
+                                      [3, 5, 5, 3, 5, 8, 8, 5,
+                                       5, 8, 8, 5, 3, 5, 5, 3])
+        np.testing.assert_array_equal(pw.squared_rowsum, pw.rowsum)
+        self.assertEqual(self.w.transform, 'O')
+
+    def test_transformed(self):
+        """The original weights of a transformed W are standardized"""
+        rng = np.random.RandomState(0)
+        neighbors = self.w.neighbors
+        original = {i: list(rng.uniform(1, 10, len(neighbors[i])))
+                    for i in self.w.id_order}
+        expected = weights.W(neighbors, original)
+        expected.transform = 'r'
+        y = rng.normal(size=16)
+        lG = Local_Geary(connectivity=expected, permutations=0).fit(y)
+        for transform in ('b', 'v', 'd', 'r'):
+            w = weights.W(neighbors, original)
+            w.transform = transform
+            # row sums are reduced in another order than libpysal's
+            np.testing.assert_allclose(
+                PreparedWeights(w).row_standardized.toarray(),
+                expected.sparse.toarray(), rtol=1e-12
+            )
+            np.testing.assert_allclose(
+                Local_Geary(connectivity=w, permutations=0).fit(y).localG,
+                lG.localG, rtol=1e-12
+            )
+            self.assertEqual(w.transform, transform.upper())
+
+    def test_cache(self):
+        """Prepared weights are reused until W is re-transformed"""
+        pw = PreparedWeights.from_w(self.w)
+        self.assertIs(PreparedWeights.from_w(self.w), pw)
+        self.assertIs(PreparedWeights.from_w(pw), pw)
+        self.w.transform = 'r'
+        self.assertIsNot(PreparedWeights.from_w(self.w), pw)
+
+    def test_from_npy(self):
+        """Memory-mapped weights read by block match the in-memory forms"""
+        path = tempfile.mkdtemp()
+        try:
+            pw = PreparedWeights(self.w)
+            pw.to_npy(path)
+            self.assertTrue(os.path.exists(os.path.join(path, 'data.npy')))
+            pw_mm = PreparedWeights.from_npy(path, block_size=3)
+            self.assertTrue(pw_mm.streaming)
+            self.assertIsInstance(pw_mm.binary, BlockCSR)
+            x = np.arange(16, dtype='float')
+            for form in ('sparse', 'binary', 'row_standardized'):
+                np.testing.assert_array_equal(getattr(pw_mm, form) @ x,
+                                              getattr(pw, form) @ x)
+            for attr in ('rowsum', 'squared_rowsum', 'cardinalities'):
+                np.testing.assert_array_equal(getattr(pw_mm, attr),
+                                              getattr(pw, attr))
+            np.testing.assert_array_equal(pw_mm.sparse.diagonal(),
+                                          np.zeros(16))
+            del pw_mm
+        finally:
+            shutil.rmtree(path)
+
+    def test_positions(self):
+        """Positions of integer, shuffled and string ids"""
+        pw = PreparedWeights(self.w)
+        self.assertIsNone(pw._id_index())
+        np.testing.assert_array_equal(pw.positions([3, 0, 15]), [3, 0, 15])
+        w = weights.W(self.w.neighbors, id_order=self.w.id_order[::-1])
+        np.testing.assert_array_equal(PreparedWeights(w).positions([15, 0]),
+                                      [0, 15])
+        names = {i: 'unit%d' % i for i in self.w.id_order}
+        w = weights.W({names[i]: [names[j] for j in neighbors]
+                       for i, neighbors in self.w.neighbors.items()})
+        pw = PreparedWeights(w)
+        np.testing.assert_array_equal(pw.positions(['unit3', 'unit0']),
+                                      [w.id2i['unit3'], w.id2i['unit0']])
+        with self.assertRaises(KeyError):
+            pw.positions(['unit16'])
+        with self.assertRaises(KeyError):
+            PreparedWeights(self.w).positions([16])
+
+    def test_from_file(self):
+        """GAL and GWT files are read as libpysal does, then from cache"""
+        path = tempfile.mkdtemp()
+        try:
+            for name in ('stl.gal', 'baltim_k4.gwt'):
+                file = shutil.copy(libpysal.examples.get_path(name), path)
+                w = libpysal.io.open(file).read()
+                pw = PreparedWeights.from_file(file)
+                self.assertFalse(os.path.exists(file + '.npz'))
+                PreparedWeights.from_file(file, cache=True)
+                self.assertTrue(os.path.exists(file + '.npz'))
+                cached = PreparedWeights.from_file(file, cache=True)
+                cache_dir = os.path.join(path, 'cache')
+                os.mkdir(cache_dir)
+                PreparedWeights.from_file(file, cache=cache_dir)
+                in_dir = PreparedWeights.from_file(file, cache=cache_dir)
+                shutil.rmtree(cache_dir)
+                for prepared in (pw, cached, in_dir):
+                    for attr in ('indptr', 'indices', 'data'):
+                        np.testing.assert_array_equal(
+                            getattr(prepared.sparse, attr),
+                            getattr(w.sparse.tocsr(), attr)
+                        )
+                    self.assertEqual(list(prepared.id_order), w.id_order)
+            # estimators accept the path in place of W
+            w = libpysal.io.open(os.path.join(path, 'stl.gal')).read()
+            y = np.arange(78, dtype='float')
+            os.remove(os.path.join(path, 'stl.gal.npz'))
+            lG = Local_Geary(connectivity=os.path.join(path, 'stl.gal'),
+                             permutations=0).fit(y)
+            self.assertFalse(os.path.exists(os.path.join(path,
+                                                         'stl.gal.npz')))
+            np.testing.assert_allclose(
+                lG.localG, Local_Geary(connectivity=w, permutations=0).fit(y).localG
+            )
+        finally:
+            shutil.rmtree(path)
+
+
+suite = unittest.TestSuite()
+test_classes = [
+    PreparedWeights_Tester
+]
+for i in test_classes:
+    a = unittest.TestLoader().loadTestsFromTestCase(i)
+    suite.addTest(a)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
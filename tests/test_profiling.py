@@ -0,0 +1,90 @@
+import unittest
+import tracemalloc
+import numpy as np
+from libpysal.weights.util import lat2W
+
+from ..profiling import FitProfiler, permutations_run
+from ..local_geary import Local_Geary
+from ..local_join_count import Local_Join_Count
+from ..local_join_count_bv import Local_Join_Count_BV
+from ..local_join_count_mv import Local_Join_Count_MV
+from ..losh import LOSH
+
+
+class Profiling_Tester(unittest.TestCase):
+    """Unit test for the fit instrumentation"""
+    def setUp(self):
+        np.random.seed(10)
+        self.w = lat2W(5, 5)
+        self.y = np.random.normal(size=25)
+
+    def test_profiler(self):
+        profiler = FitProfiler()
+        a = np.ones(100000)
+        profiler.lap('allocate')
+        del a
+        profiler.lap('free')
+        profiler.lap('free')
+        stats = profiler.stats(permutations=3)
+        self.assertEqual(list(stats['phases']), ['allocate', 'free'])
+        self.assertGreaterEqual(stats['phases']['allocate']['peak_bytes'],
+                                800000)
+        self.assertLess(stats['phases']['free']['retained_bytes'], 0)
+        self.assertEqual(stats['permutations'], 3)
+        self.assertIsNone(FitProfiler(enabled=False).stats())
+
+    def test_permutations_run(self):
+        p_sim = np.array([0.1, np.nan, 0.2])
+        self.assertEqual(permutations_run(p_sim, 99), 198)
+        self.assertEqual(permutations_run(p_sim, 99, np.array([99, 0, 20])),
+                         119)
+        self.assertEqual(permutations_run(None, 99), 0)
+
+    def test_fit_stats(self):
+        lG = Local_Geary(connectivity=self.w, labels=True,
+                         permutations=99).fit(self.y, profile=True)
+        self.assertEqual(list(lG.fit_stats_['phases']),
+                         ['weights', 'statistic', 'inference', 'labels'])
+        self.assertEqual(lG.fit_stats_['permutations'], 25 * 99)
+        ljc = Local_Join_Count(connectivity=self.w, permutations=99).fit(
+            (self.y > 0).astype('float'), profile=True
+        )
+        self.assertEqual(ljc.fit_stats_['permutations'],
+                         np.isfinite(ljc.p_sim).sum() * 99)
+        ls = LOSH(connectivity=self.w, inference='chi-square').fit(
+            self.y, profile=True
+        )
+        self.assertEqual(ls.fit_stats_['permutations'], 0)
+        self.assertFalse(hasattr(Local_Geary(connectivity=self.w)
+                                 .fit(self.y), 'fit_stats_'))
+
+    def test_fit_raises(self):
+        """A failed fit stops tracing"""
+        self.assertFalse(tracemalloc.is_tracing())
+        x = (self.y > 0).astype('float')
+        with self.assertRaises(NotImplementedError):
+            Local_Join_Count_BV(connectivity=self.w).fit(
+                x, 1 - x, case='BLC', profile=True
+            )
+        self.assertFalse(tracemalloc.is_tracing())
+        with self.assertRaises(NotImplementedError):
+            Local_Join_Count_MV(connectivity=self.w,
+                                inference='exact').fit([x, x], profile=True)
+        self.assertFalse(tracemalloc.is_tracing())
+        with FitProfiler() as profiler:
+            profiler.lap('phase')
+            profiler.stats()
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+suite = unittest.TestSuite()
+test_classes = [
+    Profiling_Tester
+]
+for i in test_classes:
+    a = unittest.TestLoader().loadTestsFromTestCase(i)
+    suite.addTest(a)
+
+if __name__ == "__main__":
+    runner = unittest.TextTestRunner()
+    runner.run(suite)